@@ -0,0 +1,180 @@
+'''Windowed aggregation of numeric JSON streams.
+
+Reads a time window of a JSON stream, picks numeric fields out of each entry (dotted
+paths, e.g. ``pose.position.0``) and computes count/min/max/mean/last for each time
+bucket. Entries are decoded in bulk with one ``orjson.loads`` per page and the buckets
+are reduced with numpy, so a chart can get a few KB of stats instead of every entry.
+
+Buckets are aligned to multiples of the bucket width (not to the window start), so
+completed buckets (ones that ended before the newest entry) can be cached and shared
+between overlapping requests.
+'''
+from __future__ import annotations
+import os
+from collections import OrderedDict
+import orjson
+import numpy as np
+
+from redis_streamer import utils
+from redis_streamer.core import ctx
+from redis_streamer.jsonfilter import compile_path, get_path
+
+AGG_PAGE_SIZE = int(os.getenv('AGG_PAGE_SIZE') or 2000)
+AGG_MAX_BUCKETS = int(os.getenv('AGG_MAX_BUCKETS') or 10000)
+AGG_CACHE_SIZE = int(os.getenv('AGG_CACHE_SIZE') or 100000)
+
+STATS = ('count', 'min', 'max', 'mean', 'last')
+
+# {(stream_id, bucket width, fields, bucket index): {field: {stat: value}}|None}
+_cache: OrderedDict = OrderedDict()
+
+
+def decode_docs(entries: list) -> list:
+    '''Decode the JSON payloads of a page of entries (``None`` for ones that aren't JSON).'''
+    try:
+        # one parse for the whole page
+        docs = orjson.loads(b'[' + b','.join(x[b'd'] for _, x in entries) + b']')
+        if len(docs) == len(entries):  # a payload like b'1,2' would shift the rest
+            return docs
+    except orjson.JSONDecodeError:
+        pass
+    docs = []
+    for _, x in entries:
+        try:
+            docs.append(orjson.loads(x[b'd']))
+        except orjson.JSONDecodeError:
+            docs.append(None)
+    return docs
+
+
+def decode_page(entries: list, fields: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    '''Get the times (ms) and the field values (NaN if missing or not a number) of a page of entries.'''
+    ms = np.array([utils.parse_entry_id(t)[0] for t, _ in entries], dtype=np.int64)
+    docs = decode_docs(entries)
+    paths = [compile_path(f) for f in fields]
+    values = np.full((len(docs), len(fields)), np.nan)
+    for i, doc in enumerate(docs):
+        for j, path in enumerate(paths):
+            v = get_path(doc, path)
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                values[i, j] = v
+    return ms, values
+
+
+def reduce_buckets(ms: np.ndarray, values: np.ndarray, width: float) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    '''Compute the stats of each non-empty bucket. ``ms`` must be sorted.
+
+    Returns the bucket indices, and each stat as a (buckets, fields) array.
+    '''
+    idx = np.floor(ms / width).astype(np.int64)
+    starts = np.flatnonzero(np.diff(idx, prepend=idx[:1] - 1))
+    valid = ~np.isnan(values)
+    count = np.add.reduceat(valid.astype(np.int64), starts, axis=0)
+    total = np.add.reduceat(np.where(valid, values, 0), starts, axis=0)
+    # the position of the last valid value in each bucket
+    pos = np.maximum.reduceat(np.where(valid, np.arange(len(ms))[:, None], -1), starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats = {
+            'count': count,
+            'min': np.fmin.reduceat(values, starts, axis=0),
+            'max': np.fmax.reduceat(values, starts, axis=0),
+            'mean': total / count,
+            'last': np.where(pos >= 0, np.take_along_axis(values, np.maximum(pos, 0), axis=0), np.nan),
+        }
+    return idx[starts], stats
+
+
+def _bucket(stats: dict, i: int, fields: list[str]) -> dict:
+    return {
+        f: {k: (None if np.isnan(v) else float(v)) if k != 'count' else int(v) for k, v in ((k, stats[k][i, j]) for k in STATS)}
+        for j, f in enumerate(fields)
+    }
+
+
+async def _read(r, sid: str, start: str, end: str, fields: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    ms, values = [np.zeros(0, dtype=np.int64)], [np.zeros((0, len(fields)))]
+    while True:
+        entries = await r.xrange(sid, start, end, count=AGG_PAGE_SIZE)
+        if not entries:
+            break
+        m, v = decode_page(entries, fields)
+        ms.append(m)
+        values.append(v)
+        if len(entries) < AGG_PAGE_SIZE:
+            break
+        start = f'({utils.maybe_decode(entries[-1][0])}'
+    return np.concatenate(ms), np.concatenate(values)
+
+
+async def aggregate(sid: str, fields: list[str], bucket: float, start: str|None=None, end: str|None=None, consistency: str|None=None) -> dict:
+    '''Aggregate numeric fields of a JSON stream by time bucket.
+
+    Arguments:
+        sid: The stream.
+        fields: Dotted paths to numeric fields (list items by index).
+        bucket: The bucket width in milliseconds.
+        start, end: The window, as entry IDs or millisecond times. Defaults to the whole stream.
+
+    Returns ``{"buckets": [bucket start ms, ...], "fields": {field: {stat: [value, ...]}}}`` with
+    only the buckets that have entries. Stats are count, min, max, mean and last.
+    '''
+    if not fields:
+        raise ValueError("Give at least one field.")
+    if not bucket or bucket <= 0:
+        raise ValueError("The bucket width must be positive.")
+    fields = list(fields)
+    primary = ctx.shard(sid)
+    r = ctx.reader(primary, consistency)
+    head = await r.xrevrange(sid, count=1)
+    if not head:
+        return {'buckets': [], 'fields': {f: {k: [] for k in STATS} for f in fields}}
+    head_ms = utils.parse_entry_id(head[0][0])[0]
+    if start is None or start == '-':
+        first = await r.xrange(sid, count=1)
+        start = utils.maybe_decode(first[0][0])
+        start_ms = int(utils.parse_entry_id(start)[0] // bucket * bucket)  # nothing before it anyway
+    else:
+        start_ms = utils.parse_entry_id(start)[0]
+    end_ms = head_ms if end is None or end in ('+', '$') else utils.parse_entry_id(end)[0]
+    first_bucket, last_bucket = int(start_ms // bucket), int(end_ms // bucket)
+    if last_bucket - first_bucket + 1 > AGG_MAX_BUCKETS:
+        raise ValueError(f"Too many buckets ({last_bucket - first_bucket + 1}, max {AGG_MAX_BUCKETS}). Use a wider bucket or a shorter window.")
+
+    def edge(b):  # the first millisecond of a bucket
+        return int(np.ceil(b * bucket))
+
+    key = (sid, bucket, tuple(fields))
+    out: dict[int, dict|None] = {}
+
+    async def read(b0, b1):
+        '''Read and reduce buckets b0 to b1 (inclusive), clipped to the window.'''
+        ms, values = await _read(r, sid, f'{max(start_ms, edge(b0))}-0', f'{min(end_ms, edge(b1 + 1) - 1)}-{2**64 - 1}', fields)
+        if len(ms):
+            idx, stats = reduce_buckets(ms, values, bucket)
+            for i, bi in enumerate(idx.tolist()):
+                out[bi] = _bucket(stats, i, fields)
+
+    # a window that starts mid-bucket gets its own read, since that bucket is partial
+    b = first_bucket
+    if start_ms > edge(first_bucket):
+        await read(b, b)
+        b += 1
+    # then use cached buckets, and only read the rest
+    while b <= last_bucket and edge(b + 1) - 1 <= end_ms and (key + (b,)) in _cache:
+        out[b] = _cache[key + (b,)]
+        _cache.move_to_end(key + (b,))
+        b += 1
+    if b <= last_bucket:
+        await read(b, last_bucket)
+        # a bucket is complete once a newer entry exists (entry IDs only increase)
+        for bi in range(b, min(last_bucket + 1, int(head_ms // bucket))):
+            if edge(bi + 1) - 1 <= end_ms:
+                _cache[key + (bi,)] = out.get(bi)
+        while len(_cache) > AGG_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    buckets = sorted(bi for bi, x in out.items() if x is not None)
+    return {
+        'buckets': [edge(bi) for bi in buckets],
+        'fields': {f: {k: [out[bi][f][k] for bi in buckets] for k in STATS} for f in fields},
+    }
@@ -0,0 +1,41 @@
+'''Jobs that only one worker should run at a time (derived streams, shared-memory rings).
+
+Each job has an owner key in redis holding the worker ID. A worker claims the jobs nobody
+owns and renews the ones it already owns every claim interval, so if a worker dies its
+jobs are picked up by another one once its keys expire.
+'''
+from __future__ import annotations
+import asyncio
+
+from redis_streamer import metrics
+from redis_streamer.core import ctx
+
+
+async def own(key: str, interval: float) -> bool:
+    '''Take ownership of a job, or renew it if we already own it. Returns whether we own it.'''
+    ttl = int(interval * 3) + 1
+    if await ctx.r.set(key, metrics.WORKER_ID, nx=True, ex=ttl):
+        return True
+    return (await ctx.r.get(key) or b'').decode('utf-8') == metrics.WORKER_ID and bool(await ctx.r.expire(key, ttl))
+
+
+class Claimer:
+    '''Calls ``claim`` every ``interval`` seconds in the background, logging failures.'''
+    def __init__(self, claim, interval: float, name: str):
+        self.claim = claim
+        self.interval = interval
+        self.name = name
+        self.task: asyncio.Task|None = None
+
+    async def claim_forever(self):
+        while True:
+            try:
+                await self.claim()
+            except Exception as e:
+                print(f"{self.name} claim failed:", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> asyncio.Task:
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.claim_forever())
+        return self.task
@@ -1,10 +1,18 @@
 import os
 
 DEVICE_META_PREFIX = ':devices:meta'
-DEVICES_CONNECTED_KEY = ':devices:connected'
+DEVICES_PRESENCE_KEY = ':devices:presence'
 DEVICES_SEEN_KEY = ':devices:seen'
 EVENT_PREFIX = ':event'
 STREAM_META_PREFIX = ':stream:meta'
+STREAM_REGISTRY_KEY = ':stream:registry'
+METRICS_KEY = ':metrics'
+METRICS_GAUGE_PREFIX = ':metrics:gauges'
+CONSUMERS_PREFIX = ':consumers'
+SHM_RINGS_KEY = ':shm:rings'
+DERIVED_KEY = ':derived'
+KEYFRAME_PREFIX = ':keyframes'
+INDEX_PREFIX = ':index'
 
 DEFAULT_DEVICE = 'default'
 
@@ -2,20 +2,102 @@ from __future__ import annotations
 import os
 import time
 import asyncio
+from typing import Literal
+import orjson
 from redis import asyncio as aioredis
 
-from redis_streamer import utils
+from redis_streamer import utils, metrics, tracing
+from redis_streamer.sharding import HashRing, shard_key
+from redis_streamer.config import EVENT_PREFIX, STREAM_REGISTRY_KEY
+
+Consistency = Literal['primary', 'replica']
+CONSISTENCY_LEVELS = ('primary', 'replica')
+
+def check_consistency(consistency: str|None):
+    if consistency is not None and consistency not in CONSISTENCY_LEVELS:
+        raise ValueError(f"Invalid consistency {consistency!r}. Expected one of {CONSISTENCY_LEVELS}.")
+
 
 class Context:
     stream_maxlen = int(os.getenv('REDIS_STREAM_MAXLEN') or 1000)
+    read_consistency = os.getenv('REDIS_READ_CONSISTENCY') or 'replica'
     async def init(self):
-        url = os.getenv('REDIS_URL') or 'redis://127.0.0.1:6789'
+        check_consistency(self.read_consistency)
+        urls = [u.strip() for u in (os.getenv('REDIS_URLS') or '').split(',') if u.strip()]
+        urls = urls or [os.getenv('REDIS_URL') or 'redis://127.0.0.1:6789']
+        # replicas for each shard, e.g. "redis://a-replica1,redis://a-replica2;redis://b-replica1"
+        replica_urls = [
+            [u.strip() for u in xs.split(',') if u.strip()]
+            for xs in (os.getenv('REDIS_REPLICA_URLS') or '').split(';')]
         max_connections = int(os.getenv('REDIS_MAX_CONNECTIONS') or 9000)
-        print("Connecting to", url, '...')
-        self.r = await aioredis.from_url(url=url, max_connections=max_connections)
-        print("Connected?", await self.r.ping())
+        shards = {}
+        for url in urls:
+            print("Connecting to", url, '...')
+            shards[url] = r = await aioredis.from_url(url=url, max_connections=max_connections)
+            print("Connected?", await r.ping())
+        replicas = {
+            url: [aioredis.from_url(url=u, max_connections=max_connections) for u in xs]
+            for url, xs in zip(urls, replica_urls) if xs
+        }
+        self.set_shards(shards, replicas)
+
+    def set_shards(self, shards: dict[str, aioredis.Redis], replicas: dict[str, list[aioredis.Redis]]|None=None):
+        '''Use these redis clients (by name/url). The first one also holds the control-plane keys.'''
+        self.shards = list(shards.values())
+        self.r = self.shards[0]
+        self.ring = HashRing(list(shards))
+        self.replicas = {shards[k]: xs for k, xs in (replicas or {}).items()}
+        self.healthy_replicas: set[aioredis.Redis] = set()  # updated by replicas.monitor
+        self._next_replica = 0
+
+    def shard(self, sid: str) -> aioredis.Redis:
+        '''Get the redis instance that holds a stream.'''
+        if len(self.shards) == 1 or sid.startswith(':'):
+            return self.r
+        return self.shards[self.ring.get(shard_key(sid))]
+
+    def group_by_shard(self, sids) -> dict[aioredis.Redis, list[str]]:
+        groups: dict[aioredis.Redis, list[str]] = {}
+        for sid in sids:
+            groups.setdefault(self.shard(sid), []).append(sid)
+        return groups
+
+    def reader(self, r: aioredis.Redis, consistency: str|None=None) -> aioredis.Redis:
+        '''Get the client to read from for a shard. Use ``consistency="primary"`` to read your own
+        writes, otherwise a healthy replica is picked (round-robin), falling back to the primary.'''
+        check_consistency(consistency)
+        if not self.replicas or (consistency or self.read_consistency) == 'primary':
+            return r
+        healthy = [x for x in self.replicas.get(r, ()) if x in self.healthy_replicas]
+        if not healthy:
+            return r
+        self._next_replica += 1
+        return healthy[self._next_replica % len(healthy)]
 ctx = Context()
 
+REPLICA_ERRORS = (aioredis.ConnectionError, aioredis.TimeoutError)
+
+async def pipeline_by_shard(sids: list[str], add, raise_on_error: bool=True, consistency: str|None='primary') -> list:
+    '''Queue one command per stream (using ``add(pipeline, sid)``) on each stream's
+    shard, run the shards concurrently, and return the results in the order of ``sids``.'''
+    groups = ctx.group_by_shard(sids)
+    async def run(r, keys, primary=None):
+        try:
+            async with r.pipeline() as p:
+                for sid in keys:
+                    add(p, sid)
+                return await p.execute(raise_on_error=raise_on_error)
+        except REPLICA_ERRORS:
+            if primary is None or primary is r:
+                raise
+            ctx.healthy_replicas.discard(r)
+            return await run(primary, keys)
+    results = await asyncio.gather(*(run(ctx.reader(r, consistency), keys, r) for r, keys in groups.items()))
+    out = {}
+    for keys, xs in zip(groups.values(), results):
+        out.update(zip(keys, xs))
+    return [out[sid] for sid in sids]
+
 META_PREFIX = 'XMETA'
 
 
@@ -24,6 +106,7 @@ class Agent:
     '''Redis streaming agent'''
     def __init__(self, ws=None) -> None:
         self._ws = ws
+        self._waiting: dict = {}  # blocking shard reads kept for the next read, see _read_shards
 
     @property
     def ws(self):
@@ -35,21 +118,59 @@ class Agent:
     #                               Running commands                               #
     # ---------------------------------------------------------------------------- #
 
-    async def run_commands(self, query, cmd=None):
+    async def run_commands(self, query, cmd=None, data=b''):
+        '''Run a batch of commands, using one pipeline per shard.
+
+        ``query`` is a command dict (or a list of them) like ``{"cmd": "xrange", "sid": ...}``.
+        XADD payloads can be given inline (``data``), or as ``size`` bytes taken in order from
+        ``data``, otherwise they're received from the websocket.
+        '''
         squeeze = isinstance(query, dict)
-        async with ctx.r.pipeline() as p:
-            for q in [query] if squeeze else query:
-                if cmd:
-                    q['cmd'] = cmd
-                ack = q.pop('ack', False)
-                await self.run_command(p, **query)
-                if ack:
-                    await self.ws.send_text('')
-            xs = await p.execute()
+        view = memoryview(data)
+        start = 0
+        queries = []
+        groups: dict[aioredis.Redis, list[int]] = {}
+        for i, q in enumerate([query] if squeeze else query):
+            q = dict(q, cmd=(cmd or q.get('cmd') or '').lower())
+            if not hasattr(self, f'cmd__{q["cmd"]}'):
+                raise ValueError(f"Unknown command: {q['cmd']!r}")
+            if q['cmd'] == 'xadd' and 'size' in q:
+                size = q.pop('size')
+                q['data'] = view[start:start + size]
+                start += size
+            shards = {ctx.shard(s) for s in q.get('sids') or [q.get('sid') or '']}
+            if len(shards) != 1:
+                raise ValueError("All streams in a command must be on the same shard.")
+            groups.setdefault(shards.pop(), []).append(i)
+            queries.append(q)
+        # check tensor streams before anything is written
+        from redis_streamer import tensors, indexing  # (they import this module)
+        await tensors.validate((q['sid'], q['data']) for q in queries if q['cmd'] == 'xadd' and q.get('data') is not None)
+
+        async def run(r, idx):
+            async with r.pipeline() as p:
+                for i in idx:
+                    q = dict(queries[i])
+                    ack = q.pop('ack', False)
+                    await self.run_command(p, **q)
+                    if ack:
+                        await self.ws.send_text('')
+                return await p.execute(raise_on_error=False)
+        results = await asyncio.gather(*(run(r, idx) for r, idx in groups.items()))
+        xs = [None] * len(queries)
+        for idx, rs in zip(groups.values(), results):
+            for i, x in zip(idx, rs):
+                xs[i] = x
+        added = [
+            (q['sid'], x, q['data']) for q, x in zip(queries, xs)
+            if q['cmd'] == 'xadd' and q.get('data') is not None and isinstance(x, (bytes, str))]
+        if added:
+            await indexing.after_write(*zip(*added))
+        await register_streams({q['sid'] for q in queries if q['cmd'] == 'xadd'})
         return xs[0] if squeeze else xs
 
     async def run_command(self, p, cmd, **query):
-        return getattr(self, f'cmd__{cmd}')(p, **query)
+        return await getattr(self, f'cmd__{cmd}')(p, **query)
 
     # ---------------------------------------------------------------------------- #
     #                                Redis Commands                                #
@@ -69,8 +190,9 @@ class Agent:
     async def cmd__xlen(self, p, sid):
         return self.xlen(p, sid)
 
-    async def cmd__xadd(self, p, sid, **kw):
-        data = await self.ws.recv_bytes()
+    async def cmd__xadd(self, p, sid, data=None, **kw):
+        if data is None:
+            data = await self.ws.receive_bytes()
         return self.xadd(p, sid, data, **kw)
 
     # ----- These are synchronous because they can be used with a transaction ---- #
@@ -96,7 +218,7 @@ class Agent:
         return p.xlen(sid)
 
     def xadd(self, p, sid, data, time='*', metadata=None):
-        return p.xadd(sid, {b'd': data, **(metadata or {})}, time or '*')
+        return p.xadd(sid, {b'd': data, **(metadata or {})}, time or '*', maxlen=ctx.stream_maxlen, approximate=True)
 
 
     # ---------------------------------------------------------------------------- #
@@ -106,11 +228,36 @@ class Agent:
     async def add_entry(self, p, sid, t, data, meta=None):
         return p.xadd(sid, {b'd': data, **(meta or {})}, t or '*', maxlen=ctx.stream_maxlen, approximate=True)
 
-    async def add_entries(self, entries):
-        async with ctx.r.pipeline() as p:
+    async def add_entries(self, entries, raise_on_error=True):
+        t0 = time.perf_counter()
+        entries = list(entries)
+        if len(ctx.shards) == 1:
+            result = await self._add_entries(ctx.r, entries, raise_on_error)
+        else:
+            # write each shard's entries in its own pipeline, concurrently
+            groups: dict = {}
+            for i, (sid, t, entry) in enumerate(entries):
+                groups.setdefault(ctx.shard(sid), []).append(i)
+            results = await asyncio.gather(*(
+                self._add_entries(r, [entries[i] for i in idx], raise_on_error) for r, idx in groups.items()))
+            result = [None] * len(entries)
+            for idx, xs in zip(groups.values(), results):
+                for i, x in zip(idx, xs):
+                    result[i] = x
+        metrics.add_seconds.observe(time.perf_counter() - t0)
+        await register_streams({sid for sid, _, _ in entries})
+        return result
+
+    async def _add_entries(self, r, entries, raise_on_error=True):
+        async with r.pipeline() as p:
             for sid, t, entry in entries:
                 await self.add_entry(p, sid, t, entry)
-            return await p.execute()
+                metrics.entries_in.inc(sid)
+                metrics.bytes_in.inc(sid, value=len(entry))
+            with tracing.span('add_entries.execute'):
+                result = await p.execute(raise_on_error=raise_on_error)
+        metrics.pipeline_size.observe(len(result))
+        return result
             
 
     # ---------------------------------------------------------------------------- #
@@ -135,24 +282,130 @@ class Agent:
     def update_cursor(self, sids: dict[str, str], data: list[str|tuple]) -> dict[str, str]:
         for s, ts in data:
             if ts:
-                sids[s] = max(t for t, x in ts)
+                # batches are in order (xread ascending, xrevrange descending), so
+                # the newest entry is at one of the ends
+                sids[s] = max(ts[0][0], ts[-1][0], key=utils.parse_entry_id)
         return sids
 
-    async def read(self, sids, latest=False, block=None, **kw) -> tuple[list, dict[str, str]]:#tuple[list[str|list[tuple[str|list[bytes]]]], dict[str, str]]
-        if latest:
-            async with ctx.r.pipeline() as p:
-                for sid, t in sids.items():
-                    self.xrevrange(p, sid, t, **kw)
-                data = list(zip(sids, await p.execute()))
-            if not any(x for s, x in data):
-                data = await self.xread(ctx.r, sids, block=block, **kw)
+    async def read(self, sids, latest=False, block=None, consistency=None, **kw) -> tuple[list, dict[str, str]]:#tuple[list[str|list[tuple[str|list[bytes]]]], dict[str, str]]
+        t0 = time.perf_counter()
+        groups = ctx.group_by_shard(sids)
+        if len(groups) <= 1:
+            r = next(iter(groups), ctx.r)
+            data = await self._read(ctx.reader(r, consistency), sids, latest=latest, block=block, primary=r, **kw)
         else:
-            data = await self.xread(ctx.r, sids, block=block, **kw)
+            data = await self._read_shards([
+                (ctx.reader(r, consistency), r, {s: sids[s] for s in keys})
+                for r, keys in groups.items()
+            ], latest=latest, block=block, **kw)
+
+        metrics.read_seconds.observe(time.perf_counter() - t0, latest)
 
         # decode stream IDs and timestamps
-        data = decode_xread_format(data)
+        with tracing.span('read.decode_xread_format'):
+            data = decode_xread_format(data)
+        for sid, xs in data:
+            metrics.entries_read.inc(sid, value=len(xs))
         return data, self.update_cursor(sids, data)
 
+    async def _read(self, r, sids, latest=False, block=None, primary=None, **kw) -> list:
+        try:
+            if latest:
+                with tracing.span('read.xrevrange'):
+                    async with r.pipeline() as p:
+                        for sid, t in sids.items():
+                            self.xrevrange(p, sid, t, **kw)
+                        data = list(zip(sids, await p.execute()))
+                if not any(x for s, x in data):
+                    with tracing.span('read.xread'):
+                        data = await self.xread(r, sids, block=block, **kw)
+            else:
+                with tracing.span('read.xread'):
+                    data = await self.xread(r, sids, block=block, **kw)
+        except REPLICA_ERRORS:
+            # the replica went away - stop using it until the monitor says it's back
+            if primary is None or primary is r:
+                raise
+            ctx.healthy_replicas.discard(r)
+            return await self._read(primary, sids, latest=latest, block=block, **kw)
+        return data
+
+    async def _read_shards(self, groups, latest=False, block=None, **kw) -> list:
+        '''Read streams that live on different shards concurrently and merge the results.
+        ``groups`` is a list of (reader, primary, cursor).
+
+        Blocking reads that are still waiting when another shard returns data aren't
+        cancelled (redis-py drops the connection of a cancelled read). They're kept for the
+        next call, and reused if that shard's cursor hasn't moved.
+        '''
+        waiting, self._waiting = self._waiting, {}
+        key = tuple(sorted(kw.items()))
+        tasks = {}
+        for r, p, c in groups:
+            prev = waiting.pop(p, None)
+            if prev is not None and prev[0] == (r, c, key):
+                tasks[p] = prev[1]
+        for _, task in waiting.values():  # the cursor moved - let it finish on its own
+            task.add_done_callback(_discard_result)
+
+        # check the other shards without blocking first, so data on any shard is returned right away
+        fresh = [(r, p, c) for r, p, c in groups if p not in tasks]
+        results = await asyncio.gather(*(self._read(r, c, latest=latest, primary=p, **kw) for r, p, c in fresh))
+        data = [x for xs in results for x in xs if x[1]]
+        if not data and block:
+            # then block on all of them and return as soon as one has something
+            for r, p, c in fresh:
+                tasks[p] = asyncio.create_task(self._read(r, c, block=block, primary=p, **kw))
+            await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_COMPLETED)
+        cursors = {p: (r, c, key) for r, p, c in groups}
+        for p, task in tasks.items():
+            if task.done():
+                data.extend(x for x in task.result() or () if x[1])
+            else:
+                self._waiting[p] = (cursors[p], task)
+        return data
+
+
+def _discard_result(task: asyncio.Task):
+    if not task.cancelled():
+        task.exception()  # so it isn't logged as never retrieved
+
+
+# ---------------------------------------------------------------------------- #
+#                                Stream registry                               #
+# ---------------------------------------------------------------------------- #
+
+STREAM_CREATED_EVENT = f'{EVENT_PREFIX}:stream.created'
+STREAM_REGISTRY_REFRESH = float(os.getenv('STREAM_REGISTRY_REFRESH') or 60)
+_registered: dict[str, float] = {}
+
+async def register_streams(sids) -> list[str]:
+    '''Add streams to the registry and fire ``stream.created`` for ones we haven't seen before.
+    
+    Streams are remembered per worker, so this only talks to redis the first time a worker
+    writes to a stream (and every ``STREAM_REGISTRY_REFRESH`` seconds after that).
+    '''
+    now = time.time()
+    sids = sorted(s for s in sids if now - _registered.get(s, 0) > STREAM_REGISTRY_REFRESH)
+    if not sids:
+        return []
+    async with ctx.r.pipeline() as p:
+        for sid in sids:
+            p.sadd(STREAM_REGISTRY_KEY, sid)
+        added = await p.execute()
+    _registered.update({sid: now for sid in sids})
+    created = [sid for sid, new in zip(sids, added) if new]
+    if created:
+        async with ctx.r.pipeline() as p:
+            for sid in created:
+                p.xadd(STREAM_CREATED_EVENT, {b'd': orjson.dumps({"stream_id": sid})}, maxlen=ctx.stream_maxlen, approximate=True)
+            await p.execute()
+    return created
+
+async def unregister_stream(sid: str):
+    _registered.pop(sid, None)
+    return await ctx.r.srem(STREAM_REGISTRY_KEY, sid)
+
 
 def decode_xread_format(data):
     return [
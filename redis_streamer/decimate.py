@@ -0,0 +1,84 @@
+'''Time-bucketed decimation.
+
+Only the first entry in each time bucket (e.g. 1000 ms for a 1 Hz view) is read. A
+script seeks straight to the start of the next bucket with XRANGE, so the entries in
+between are never sent from redis.
+
+The cursor is moved to the end of the bucket of the last entry sent, so it can be
+passed back as ``last_entry_id`` like any other entry ID.
+'''
+from __future__ import annotations
+import math
+import time
+
+from redis_streamer import metrics
+from redis_streamer.core import ctx, Agent, decode_xread_format
+
+MAX_SEQ = 2**64 - 1
+
+# ARGV: bucket width (ms), count, then a cursor (exclusive) for each key
+DECIMATE_SCRIPT = '''
+local width = tonumber(ARGV[1])
+local count = tonumber(ARGV[2])
+local out = {}
+for i, key in ipairs(KEYS) do
+    local start = ARGV[i + 2] == '-' and '-' or '(' .. ARGV[i + 2]
+    local xs = {}
+    for n = 1, count do
+        local x = redis.call('XRANGE', key, start, '+', 'COUNT', 1)[1]
+        if not x then break end
+        xs[n] = x
+        local ms = tonumber(string.match(x[1], '^(%d+)'))
+        start = string.format('%d-0', math.ceil((math.floor(ms / width) + 1) * width))
+    end
+    out[i] = {key, xs}
+end
+return out
+'''
+
+
+def bucket_width(hz: float|None=None, bucket: float|None=None) -> float|None:
+    '''Get the bucket width in milliseconds from a target rate or width.'''
+    if hz is not None and bucket is not None:
+        raise ValueError("Give either hz or bucket, not both.")
+    for name, x in (('hz', hz), ('bucket', bucket)):
+        if x is not None and not x > 0:
+            raise ValueError(f"{name} must be positive, got {x}.")
+    if hz:
+        return 1000 / hz
+    return bucket or None
+
+
+def bucket_end(tid: str, width: float) -> str:
+    '''The last possible entry ID in the bucket of ``tid``.'''
+    ms = int(str(tid).split('-', 1)[0])
+    return f'{math.ceil((math.floor(ms / width) + 1) * width) - 1}-{MAX_SEQ}'
+
+
+def _parse(data) -> list:
+    return [
+        (sid, [(t, dict(zip(fields[::2], fields[1::2]))) for t, fields in xs])
+        for sid, xs in data
+    ]
+
+
+async def read(agent: Agent, sids: dict[str, str], width: float, count: int=1, block: int|None=None, consistency: str|None=None) -> tuple[list, dict[str, str]]:
+    '''Like ``Agent.read``, but only the first entry of each ``width`` ms bucket.'''
+    t0 = time.perf_counter()
+    data = []
+    for r, keys in ctx.group_by_shard(sids).items():
+        # the script only reads, but scripts run on the primary
+        data.extend(_parse(await r.eval(DECIMATE_SCRIPT, len(keys), *keys, width, count or 1, *(sids[s] for s in keys))))
+    data = decode_xread_format(data)
+    if not any(xs for _, xs in data) and block is not None:
+        # nothing yet - the next entry after the cursor is the first of a new bucket, so
+        # a regular blocking read of one entry gives us exactly what we want
+        data, _ = await agent.read(dict(sids), count=1, block=block, consistency=consistency)
+    else:
+        metrics.read_seconds.observe(time.perf_counter() - t0, False)
+        for sid, xs in data:
+            metrics.entries_read.inc(sid, value=len(xs))
+    for sid, xs in data:
+        if xs:
+            sids[sid] = bucket_end(xs[-1][0], width)
+    return [(s, xs) for s, xs in data if xs], sids
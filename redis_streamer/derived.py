@@ -0,0 +1,244 @@
+'''Derived streams: transforms that turn input streams into an output stream.
+
+A transform is a plain Python function, referenced either by name through the
+``redis_streamer.transforms`` entry point group or as ``package.module:function``, for
+modules listed in ``DERIVED_TRANSFORM_MODULES`` (so a mutation can't run arbitrary code).
+It gets a batch of entries and returns the payloads to add to the output stream:
+
+    def thumbnail(entries: list[tuple[str, str, bytes]]) -> list[bytes]:
+        return [make_thumbnail(data) for stream_id, entry_id, data in entries]
+
+Transforms run in a process pool (``DERIVED_WORKERS`` processes), so they can use all
+cores without blocking the event loop. Each derived stream is run by one worker at a
+time (claimed with a lock in redis, like shared-memory rings). That worker reads the
+inputs in batches of up to ``batch`` entries and keeps at most ``DERIVED_QUEUE_SIZE``
+batches in flight. When the transform can't keep up, reading stops until it does.
+Outputs are written in input order. The input cursor is saved after every batch, so
+another worker can pick up where this one stopped (batches that were in flight are
+transformed again, so delivery is at least once).
+'''
+from __future__ import annotations
+import os
+import time
+import asyncio
+import importlib
+import multiprocessing
+from importlib.metadata import entry_points
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import orjson
+
+from redis_streamer import metrics, claims
+from redis_streamer.indexing import after_write
+from redis_streamer.core import ctx, Agent
+from redis_streamer.config import DERIVED_KEY
+
+DERIVED_WORKERS = int(os.getenv('DERIVED_WORKERS') or os.cpu_count() or 1)
+DERIVED_QUEUE_SIZE = int(os.getenv('DERIVED_QUEUE_SIZE') or 4)
+DERIVED_BATCH = int(os.getenv('DERIVED_BATCH') or 16)
+DERIVED_CLAIM_INTERVAL = float(os.getenv('DERIVED_CLAIM_INTERVAL') or 2)
+DERIVED_BLOCK_MS = int(os.getenv('DERIVED_BLOCK_MS') or 1000)
+DERIVED_START_METHOD = os.getenv('DERIVED_START_METHOD') or 'spawn'
+DERIVED_TRANSFORM_MODULES = [m.strip() for m in (os.getenv('DERIVED_TRANSFORM_MODULES') or '').split(',') if m.strip()]
+ENTRY_POINT_GROUP = 'redis_streamer.transforms'
+
+derived_in = metrics.Counter('derived_entries_in_total', 'Entries read by derived stream transforms.', ('derived',))
+derived_out = metrics.Counter('derived_entries_out_total', 'Entries written by derived stream transforms.', ('derived',))
+derived_errors = metrics.Counter('derived_errors_total', 'Batches that a derived stream transform failed on.', ('derived',))
+derived_seconds = metrics.Histogram('derived_batch_seconds', 'Time spent transforming a batch (in the process pool).', ('derived',))
+derived_queue = metrics.Gauge('derived_queue_depth', 'Batches waiting for a derived stream transform.', ('derived',))
+
+
+# ---------------------------------------------------------------------------- #
+#                                  Transforms                                  #
+# ---------------------------------------------------------------------------- #
+
+_transforms: dict = {}
+
+def resolve(spec: str):
+    '''Load a transform from ``module:function`` or an entry point name.'''
+    func = _transforms.get(spec)
+    if func is None:
+        if ':' in spec:
+            module, _, name = spec.partition(':')
+            func = importlib.import_module(module)
+            for attr in name.split('.'):
+                func = getattr(func, attr)
+        else:
+            eps = [ep for ep in entry_points(group=ENTRY_POINT_GROUP) if ep.name == spec]
+            if not eps:
+                raise ValueError(f"No transform called {spec!r} (entry point group {ENTRY_POINT_GROUP!r}).")
+            func = eps[0].load()
+        if not callable(func):
+            raise ValueError(f"Transform {spec!r} isn't callable.")
+        _transforms[spec] = func
+    return func
+
+
+def check_allowed(spec: str):
+    '''Only allow ``module:function`` transforms from the modules (or packages) in DERIVED_TRANSFORM_MODULES.'''
+    if ':' not in spec:
+        return  # entry points are installed by the admin
+    module = spec.partition(':')[0]
+    if not any(module == m or module.startswith(f'{m}.') for m in DERIVED_TRANSFORM_MODULES):
+        raise ValueError(
+            f"Transform module {module!r} isn't allowed. Register it in the {ENTRY_POINT_GROUP!r} "
+            "entry point group or add it to DERIVED_TRANSFORM_MODULES.")
+
+
+def run_transform(spec: str, entries: list[tuple[str, str, bytes]]) -> tuple[list[bytes], float]:
+    '''Runs in the process pool. Returns the outputs and how long it took.'''
+    t0 = time.perf_counter()
+    out = resolve(spec)(entries) or []
+    return [x.encode('utf-8') if isinstance(x, str) else bytes(x) for x in out], time.perf_counter() - t0
+
+
+_pool: ProcessPoolExecutor|None = None
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(DERIVED_WORKERS, mp_context=multiprocessing.get_context(DERIVED_START_METHOD))
+    return _pool
+
+def reset_pool(broken: ProcessPoolExecutor):
+    '''Start a new pool next time, e.g. after a transform crashed its process. Only the
+    first caller for a broken pool resets it, so the replacement isn't shut down too.'''
+    global _pool
+    if _pool is broken:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+def submit(loop, *args) -> tuple[asyncio.Future, ProcessPoolExecutor]:
+    '''Run a transform in the pool. Returns the future and the pool it runs in.'''
+    pool = get_pool()
+    try:
+        return loop.run_in_executor(pool, run_transform, *args), pool
+    except BrokenProcessPool:  # it broke since the last batch
+        reset_pool(pool)
+        pool = get_pool()
+        return loop.run_in_executor(pool, run_transform, *args), pool
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Running                                   #
+# ---------------------------------------------------------------------------- #
+
+def cursor_key(name: str) -> str:
+    return f'{DERIVED_KEY}:cursor:{name}'
+
+
+async def run(name: str, config: dict):
+    '''Read the inputs, transform them in the pool, and write the outputs, in order.'''
+    check_allowed(config['transform'])
+    agent = Agent()
+    loop = asyncio.get_running_loop()
+    saved = await ctx.r.hgetall(cursor_key(name))
+    cursor = agent.init_cursor({
+        s: saved.get(s.encode(), b'$').decode('utf-8') for s in config['inputs']})
+    q: asyncio.Queue = asyncio.Queue(DERIVED_QUEUE_SIZE)
+
+    async def read():
+        nonlocal cursor
+        while True:
+            results, cursor = await agent.read(cursor, count=config.get('batch') or DERIVED_BATCH, block=DERIVED_BLOCK_MS)
+            entries = [(sid, t, x[b'd']) for sid, xs in results for t, x in xs]
+            if not entries:
+                continue
+            derived_in.inc(name, value=len(entries))
+            fut, pool = submit(loop, config['transform'], entries)
+            # blocks once DERIVED_QUEUE_SIZE batches are in flight - that's the backpressure
+            await q.put((fut, pool, dict(cursor)))
+            derived_queue.set(name, value=q.qsize())
+
+    async def write():
+        while True:
+            fut, pool, batch_cursor = await q.get()
+            derived_queue.set(name, value=q.qsize())
+            try:
+                out, seconds = await fut
+            except BrokenProcessPool as e:
+                reset_pool(pool)
+                derived_errors.inc(name)
+                print(f"Derived stream {name}: a transform process died:", e)
+                out = []
+            except Exception as e:
+                derived_errors.inc(name)
+                print(f"Derived stream {name}: transform failed:", type(e).__name__, e)
+                out = []
+            else:
+                derived_seconds.observe(seconds, name)
+            if out:
+                ids = await agent.add_entries([(config['output'], None, x) for x in out])
+                await after_write([config['output']] * len(out), ids, out)
+                derived_out.inc(name, value=len(out))
+            await ctx.r.hset(cursor_key(name), mapping=batch_cursor)
+
+    tasks = [asyncio.create_task(read()), asyncio.create_task(write())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for t in done:
+            t.result()
+    except Exception as e:
+        print(f"Derived stream {name} stopped:", type(e).__name__, e)
+        raise
+    finally:
+        for t in tasks:
+            t.cancel()
+        derived_queue.set(name, value=0)
+
+
+# ---------------------------------------------------------------------------- #
+#                                 Registration                                 #
+# ---------------------------------------------------------------------------- #
+
+runners: dict[str, tuple[asyncio.Task, bytes]] = {}
+
+
+async def create(name: str, transform: str, inputs: list[str], output: str, batch: int=DERIVED_BATCH) -> dict:
+    if output in inputs:
+        raise ValueError("A derived stream can't be one of its own inputs.")
+    check_allowed(transform)
+    resolve(transform)  # fail early if it can't be loaded
+    config = {'transform': transform, 'inputs': list(inputs), 'output': output, 'batch': batch}
+    await ctx.r.hset(DERIVED_KEY, name, orjson.dumps(config))
+    await claim()
+    return config
+
+
+async def delete(name: str) -> bool:
+    removed = await ctx.r.hdel(DERIVED_KEY, name)
+    await ctx.r.delete(cursor_key(name))
+    await claim()
+    return bool(removed)
+
+
+async def get_all() -> dict[str, dict]:
+    return {
+        name.decode('utf-8'): orjson.loads(config)
+        for name, config in (await ctx.r.hgetall(DERIVED_KEY)).items()
+    }
+
+
+async def claim():
+    '''Run the derived streams that no other worker is running.'''
+    configs = await ctx.r.hgetall(DERIVED_KEY)
+    for name, config in configs.items():
+        name = name.decode('utf-8')
+        owner = await claims.own(f'{DERIVED_KEY}:owner:{name}', DERIVED_CLAIM_INTERVAL)
+        task, running_config = runners.get(name, (None, None))
+        if task is not None and (not owner or task.done() or running_config != config):
+            task.cancel()
+            runners.pop(name)
+            task = None
+        if owner and task is None:
+            runners[name] = (asyncio.create_task(run(name, orjson.loads(config))), config)
+    # stop deleted ones
+    for name in set(runners) - {n.decode('utf-8') for n in configs}:
+        runners.pop(name)[0].cancel()
+
+
+_claimer = claims.Claimer(claim, DERIVED_CLAIM_INTERVAL, "Derived stream")
+
+def start():
+    return _claimer.start()
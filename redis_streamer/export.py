@@ -0,0 +1,285 @@
+'''Columnar export of stream history.
+
+Reads a range of a stream in XRANGE pages (``EXPORT_PAGE_SIZE`` entries) and turns each
+page into columns:
+
+ - ``ms``, ``seq``: the entry ID (int64).
+ - ``data``: the payload (binary). NPZ can't hold variable length bytes without pickle,
+   so there the payloads are concatenated into a uint8 array, with the end offset of
+   each one in ``data_offsets`` (like the pull header).
+ - one column per JSON field (``fields``, dotted paths). Fields are float64 (NaN if
+   missing or not a number), or strings with a ``:str`` suffix (e.g. ``label:str``).
+ - one column per entry field besides the payload (``meta``, e.g. ``g`` for frame
+   groups), as strings.
+
+Arrow IPC (the stream format, needs ``pyarrow``) is written one record batch per page,
+so it's sent while the range is still being read. NPZ needs the length of each column
+up front, so the columns are spilled to temporary files as the range is read (in
+``EXPORT_SPILL_DIR``) and then the zip is sent one column at a time, without holding
+the range in memory.
+'''
+from __future__ import annotations
+import io
+import os
+import struct
+import zipfile
+import tempfile
+import orjson
+import numpy as np
+
+from redis_streamer import utils, decimate
+from redis_streamer.core import ctx, Agent
+from redis_streamer.aggregate import decode_docs
+from redis_streamer.keyframes import entry_id_before
+from redis_streamer.jsonfilter import compile_path, get_path
+
+EXPORT_PAGE_SIZE = int(os.getenv('EXPORT_PAGE_SIZE') or 1000)
+EXPORT_SPILL_DIR = os.getenv('EXPORT_SPILL_DIR') or None  # the system temp dir by default
+NPZ_CHUNK_SIZE = 1 << 20
+
+FORMATS = {
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'npz': ('application/octet-stream', 'npz'),
+}
+FIELD_TYPES = ('float', 'str')
+
+
+def parse_fields(fields: list[str]|None) -> list[tuple[str, tuple, str]]:
+    '''Parse ``path`` / ``path:type`` field specs into (name, path, type).'''
+    out = []
+    for f in fields or ():
+        name, _, kind = f.partition(':')
+        kind = kind or 'float'
+        if kind not in FIELD_TYPES:
+            raise ValueError(f"Unknown field type {kind!r} in {f!r}. Expected one of {FIELD_TYPES}.")
+        out.append((name, compile_path(name), kind))
+    return out
+
+
+def _as_str(v):
+    if v is None:
+        return None
+    return v if isinstance(v, str) else orjson.dumps(v).decode('utf-8')
+
+
+def page_columns(entries: list, fields: list, meta: list[str], payload: bool=True) -> dict[str, object]:
+    '''Turn a page of ``(entry_id, entry)`` into columns. Strings are lists (with ``None``
+    for missing values), everything else is a numpy array.'''
+    ids = np.array([utils.parse_entry_id(t) for t, _ in entries], dtype=np.int64).reshape(-1, 2)
+    cols: dict[str, object] = {'ms': ids[:, 0], 'seq': ids[:, 1]}
+    if payload:
+        cols['data'] = [bytes(x[b'd']) for _, x in entries]
+    if fields:
+        docs = decode_docs(entries)
+        for name, path, kind in fields:
+            values = [get_path(doc, path) for doc in docs]
+            if kind == 'str':
+                cols[name] = [_as_str(v) for v in values]
+            else:
+                cols[name] = np.array([
+                    v if isinstance(v, (int, float)) and not isinstance(v, bool) else np.nan
+                    for v in values], dtype=np.float64)
+    for name in meta:
+        key = name.encode('utf-8')
+        cols[name] = [utils.maybe_decode(x.get(key)) for _, x in entries]
+    return cols
+
+
+def _end_id(end: str|None) -> tuple[float, float]:
+    if end is None or end == '+':
+        return (float('inf'), 0)
+    ms, _, seq = str(end).partition('-')
+    return (int(ms), int(seq) if seq else decimate.MAX_SEQ)
+
+
+async def read_pages(sid: str, start: str|None=None, end: str|None=None, width: float|None=None, count: int|None=None, consistency: str|None=None):
+    '''Yield pages of ``(entry_id, entry)`` from ``start`` to ``end`` (inclusive). With
+    ``width``, only the first entry of each ``width`` ms bucket (see ``decimate``).'''
+    start = start or '-'
+    left = count
+    if width:
+        agent = Agent()
+        cursor = {sid: start if start == '-' else entry_id_before(start)}
+        end_id = _end_id(end)
+    else:
+        r = ctx.reader(ctx.shard(sid), consistency)
+    while left is None or left > 0:
+        n = EXPORT_PAGE_SIZE if left is None else min(left, EXPORT_PAGE_SIZE)
+        if width:
+            results, cursor = await decimate.read(agent, cursor, width, count=n, consistency=consistency)
+            entries = [e for _, xs in results for e in xs]
+            more = len(entries) == n
+            if entries and utils.parse_entry_id(entries[-1][0]) > end_id:
+                entries = [(t, x) for t, x in entries if utils.parse_entry_id(t) <= end_id]
+                more = False
+        else:
+            entries = [(utils.maybe_decode(t), x) for t, x in await r.xrange(sid, start, end or '+', count=n)]
+            more = len(entries) == n
+            if entries:
+                start = f'({entries[-1][0]}'
+        if entries:
+            yield entries
+            if left is not None:
+                left -= len(entries)
+        if not more:
+            break
+
+
+class _Chunks(io.RawIOBase):
+    '''A write-only (unseekable) file that hands out what was written since the last ``take``.'''
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        b = bytes(b)
+        self.chunks.append(b)
+        return len(b)
+
+    def take(self) -> bytes:
+        out, self.chunks = b''.join(self.chunks), []
+        return out
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+    except ImportError:
+        raise ValueError("Arrow export needs pyarrow (pip install pyarrow). Use format=npz instead.") from None
+    return pyarrow
+
+
+async def write_arrow(pages, fields: list, meta: list[str], payload: bool=True):
+    '''Write pages as an Arrow IPC stream, one record batch per page.'''
+    pa = _pyarrow()
+    types = {'ms': pa.int64(), 'seq': pa.int64()}
+    if payload:
+        types['data'] = pa.binary()
+    types.update({name: pa.string() if kind == 'str' else pa.float64() for name, _, kind in fields})
+    types.update({name: pa.string() for name in meta})
+    schema = pa.schema(list(types.items()))
+    out = _Chunks()
+    with pa.ipc.new_stream(out, schema) as writer:
+        yield out.take()
+        async for entries in pages:
+            cols = page_columns(entries, fields, meta, payload)
+            writer.write_batch(pa.record_batch([pa.array(cols[k], type=t) for k, t in types.items()], schema=schema))
+            yield out.take()
+    yield out.take()
+
+
+_u32 = struct.Struct('<I')
+
+class _Spill:
+    '''A column written to a temporary file as pages come in. ``dtype=None`` is a string
+    column: the strings are stored length-prefixed, since the width of the numpy string
+    type is only known at the end.'''
+    def __init__(self, dtype=None):
+        self.file = tempfile.TemporaryFile(dir=EXPORT_SPILL_DIR)
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        self.n = 0
+        self.width = 1
+
+    def append(self, values):
+        if self.dtype is None:
+            for v in values:
+                v = v or ''
+                b = v.encode('utf-8')
+                self.file.write(_u32.pack(len(b)) + b)
+                self.width = max(self.width, len(v))
+            self.n += len(values)
+        else:
+            values = np.asarray(values, dtype=self.dtype)
+            self.file.write(values.tobytes())
+            self.n += len(values)
+
+    def header(self) -> bytes:
+        dtype = self.dtype if self.dtype is not None else np.dtype(f'<U{self.width}')
+        d = np.lib.format.header_data_from_array_1_0(np.empty(0, dtype))
+        d['shape'] = (self.n,)
+        f = io.BytesIO()
+        np.lib.format.write_array_header_1_0(f, d)
+        return f.getvalue()
+
+    def chunks(self):
+        '''Yield the ``.npy`` data, about NPZ_CHUNK_SIZE bytes at a time.'''
+        self.file.seek(0)
+        if self.dtype is not None:
+            while chunk := self.file.read(NPZ_CHUNK_SIZE):
+                yield chunk
+            return
+        step = max(NPZ_CHUNK_SIZE // (4 * self.width), 1)
+        for i in range(0, self.n, step):
+            strings = []
+            for _ in range(min(step, self.n - i)):
+                size, = _u32.unpack(self.file.read(_u32.size))
+                strings.append(self.file.read(size).decode('utf-8'))
+            yield np.array(strings, dtype=f'<U{self.width}').tobytes()
+
+    def close(self):
+        self.file.close()
+
+
+async def write_npz(pages, fields: list, meta: list[str], payload: bool=True):
+    '''Write pages as a NumPy ``.npz`` file (loadable with ``np.load``).'''
+    spills = {'ms': _Spill(np.int64), 'seq': _Spill(np.int64)}
+    if payload:
+        spills['data'] = _Spill(np.uint8)
+        spills['data_offsets'] = _Spill(np.int64)
+    spills.update({name: _Spill(None if kind == 'str' else np.float64) for name, _, kind in fields})
+    spills.update({name: _Spill(None) for name in meta})
+    try:
+        size = 0
+        async for entries in pages:
+            for k, v in page_columns(entries, fields, meta, payload).items():
+                if k == 'data':
+                    spills['data'].append(np.frombuffer(b''.join(v), dtype=np.uint8))
+                    offsets = size + np.cumsum([len(x) for x in v], dtype=np.int64)
+                    spills['data_offsets'].append(offsets)
+                    size = int(offsets[-1]) if len(offsets) else size
+                else:
+                    spills[k].append(v)
+
+        out = _Chunks()
+        with zipfile.ZipFile(out, 'w') as z:
+            for name, spill in spills.items():
+                with z.open(f'{name}.npy', 'w', force_zip64=True) as f:
+                    f.write(spill.header())
+                    for chunk in spill.chunks():
+                        f.write(chunk)
+                        yield out.take()
+                yield out.take()
+        yield out.take()
+    finally:
+        for spill in spills.values():
+            spill.close()
+
+
+def export(sid: str, format: str='arrow', fields: list[str]|None=None, meta: list[str]|None=None, payload: bool=True,
+           start: str|None=None, end: str|None=None, width: float|None=None, count: int|None=None, consistency: str|None=None):
+    '''Export a range of a stream as a columnar file. Returns an async iterator of bytes.
+
+    Arguments:
+        sid: The stream.
+        format: ``arrow`` (Arrow IPC stream) or ``npz``.
+        fields: JSON fields to add as columns (dotted paths, ``:str`` for strings).
+        meta: Entry fields (besides the payload) to add as columns.
+        payload: Include the payload column.
+        start, end: The range (inclusive), as entry IDs or millisecond times. Defaults to the whole stream.
+        width: Only export the first entry of each ``width`` ms bucket.
+        count: The maximum number of entries.
+    '''
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}. Expected one of {tuple(FORMATS)}.")
+    fields = parse_fields(fields)
+    meta = list(meta or ())
+    names = ['ms', 'seq'] + (['data', 'data_offsets'] if payload else []) + [name for name, _, _ in fields] + meta
+    if len(set(names)) != len(names):
+        raise ValueError(f"Column names must be unique: {names}")
+    if format == 'arrow':
+        _pyarrow()  # fail before anything is sent
+    pages = read_pages(sid, start, end, width, count, consistency)
+    return (write_arrow if format == 'arrow' else write_npz)(pages, fields, meta, payload)
@@ -0,0 +1,138 @@
+'''Share a single redis read loop between many subscribers of the same streams.
+
+Each worker keeps one reader per stream set. Subscribers attach a queue to
+the reader and receive the same decoded batches, so N browser tabs watching
+the same streams cost one blocking XREAD instead of N.
+'''
+from __future__ import annotations
+import os
+import asyncio
+from contextlib import asynccontextmanager
+
+from redis_streamer.core import Agent
+from redis_streamer.patterns import PatternCursor, is_pattern
+from redis_streamer.lag import Consumer
+
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv('SUBSCRIBER_QUEUE_SIZE') or 256)
+SHARED_READER_BLOCK = int(os.getenv('SHARED_READER_BLOCK') or 5000)
+
+
+class SharedReader:
+    '''Reads a set of streams once and broadcasts each batch to every subscriber queue.'''
+    def __init__(self, cursor: dict[str, str], latest: bool=False, count: int=1, block: int=SHARED_READER_BLOCK, consistency: str|None=None):
+        self.cursor = cursor
+        self.latest = latest
+        self.count = count
+        self.consistency = consistency
+        self.block = block
+        self.queues: set[asyncio.Queue] = set()
+        self.task: asyncio.Task|None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+        return self
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _run(self):
+        agent = Agent()
+        consumer = Consumer('subscription', streams=list(self.cursor))
+        patterns = [s for s in self.cursor if is_pattern(s)]
+        watcher = PatternCursor(patterns, latest=self.latest) if patterns else None
+        try:
+            cursor = {s: t for s, t in self.cursor.items() if s not in patterns}
+            if watcher:
+                cursor = await watcher.init(cursor)
+            cursor = agent.init_cursor(cursor)
+            while True:
+                result, cursor = await agent.read(cursor, latest=self.latest, count=self.count, block=self.block, consistency=self.consistency)
+                if watcher:
+                    result = await watcher.update(cursor, result)
+                if result:
+                    self.broadcast(result)
+                    consumer.delivered(result)
+                await consumer.check_lag(cursor)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # wake up subscribers so they can raise instead of hanging
+            self.broadcast(e)
+            raise
+        finally:
+            await consumer.close()
+
+    def broadcast(self, item):
+        for q in self.queues:
+            if q.full():  # slow subscriber - drop their oldest batch
+                q.get_nowait()
+            q.put_nowait(item)
+
+    @asynccontextmanager
+    async def subscribe(self):
+        q = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.queues.add(q)
+        try:
+            yield q
+        finally:
+            self.queues.discard(q)
+
+
+readers: dict[tuple, SharedReader] = {}
+
+
+@asynccontextmanager
+async def subscribe(cursor: dict[str, str], latest: bool=False, count: int=1, block: int=SHARED_READER_BLOCK, consistency: str|None=None):
+    '''Attach to the shared reader for these streams, creating it if needed.
+
+    Readers starting from an explicit entry ID are not shared, because a late
+    joiner would otherwise silently skip the entries the reader already passed.
+    A reader that stopped (e.g. on an error) is replaced rather than joined, since
+    its subscribers were already told.
+    '''
+    shareable = all(t == '$' for t in cursor.values())
+    key = (tuple(sorted(cursor)), latest, count, block, consistency)
+    reader = readers.get(key) if shareable else None
+    if reader is not None and reader.task is not None and reader.task.done():
+        del readers[key]
+        reader = None
+    if reader is None:
+        reader = SharedReader(dict(cursor), latest=latest, count=count, block=block, consistency=consistency).start()
+        if shareable:
+            readers[key] = reader
+    try:
+        async with reader.subscribe() as q:
+            yield q
+    finally:
+        if not reader.queues:
+            if readers.get(key) is reader:
+                del readers[key]
+            reader.stop()
+
+
+async def receive(q: asyncio.Queue, window: float=0) -> list[tuple[str, list]]:
+    '''Get the next batch from a subscriber queue. If ``window`` (in seconds)
+    is given, keep collecting batches until it elapses and merge them by stream.'''
+    result = await _get(q)
+    if not window:
+        return result
+    merged: dict[str, list] = {}
+    for sid, xs in result:
+        merged.setdefault(sid, []).extend(xs)
+    deadline = asyncio.get_running_loop().time() + window
+    while (remaining := deadline - asyncio.get_running_loop().time()) > 0:
+        try:
+            result = await asyncio.wait_for(_get(q), remaining)
+        except asyncio.TimeoutError:
+            break
+        for sid, xs in result:
+            merged.setdefault(sid, []).extend(xs)
+    return list(merged.items())
+
+
+async def _get(q: asyncio.Queue):
+    item = await q.get()
+    if isinstance(item, Exception):
+        raise item
+    return item
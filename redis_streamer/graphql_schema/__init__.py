@@ -1,3 +1,4 @@
+import asyncio
 import strawberry
 from ..core import ctx
 from . import devices
@@ -19,7 +20,7 @@ class Query(_Query):
 class Mutation(_Mutation):
     @strawberry.mutation
     async def flush(self) -> int:
-        return await ctx.r.flushdb()
+        return all(await asyncio.gather(*(r.flushdb() for r in ctx.shards)))
 
 @strawberry.type
 class Subscription(streams.StreamSubscription):
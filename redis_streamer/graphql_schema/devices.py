@@ -1,11 +1,12 @@
 from __future__ import annotations
+import time
 import typing
 import base64
 
 import strawberry
 from strawberry.scalars import JSON, Base64
 import orjson
-from redis_streamer import utils, ctx
+from redis_streamer import utils, ctx, presence
 from . import streams
 from redis_streamer.config import *
 
@@ -35,12 +36,12 @@ class Device:
         return await streams.get_stream_ids(prefix=f'{self.id or DEFAULT_DEVICE}:')
 
     @strawberry.field
-    async def streams(self) -> list[streams.Stream]:
-        return await streams.get_streams(prefix=f'{self.id or DEFAULT_DEVICE}:')
+    async def streams(self, consistency: str|None=None) -> list[streams.Stream]:
+        return await streams.get_streams(prefix=f'{self.id or DEFAULT_DEVICE}:', consistency=consistency)
 
     @strawberry.field
-    async def stream(self, stream_id: str) -> streams.Stream:
-        return await streams.get_stream(f'{self.id or DEFAULT_DEVICE}:{stream_id}')
+    async def stream(self, stream_id: str, consistency: str|None=None) -> streams.Stream:
+        return await streams.get_stream(f'{self.id or DEFAULT_DEVICE}:{stream_id}', consistency=consistency)
 
 
 
@@ -60,7 +61,7 @@ async def get_devices(ids: list[str]|None=None, include_all: bool=False):
     return await (get_all_devices() if include_all else get_connected_devices())
 
 async def get_connected_devices():
-    return [Device(id=x.decode('utf-8')) for x in await ctx.r.smembers(DEVICES_CONNECTED_KEY)]
+    return [Device(id=x) for x in await presence.get_connected_device_ids()]
 
 async def get_all_devices():
     return [Device(id=x.decode('utf-8')) for x in await ctx.r.smembers(DEVICES_SEEN_KEY)]
@@ -71,7 +72,7 @@ async def get_all_devices():
 
 async def connect_device(device_id: str, meta: dict[str, typing.Any]) -> dict[str, int]:
     async with ctx.r.pipeline() as p:
-        p.sadd(DEVICES_CONNECTED_KEY, device_id).sismember(DEVICES_CONNECTED_KEY, device_id)
+        p.zadd(DEVICES_PRESENCE_KEY, {device_id: time.time()}).zscore(DEVICES_PRESENCE_KEY, device_id)
         p.sadd(DEVICES_SEEN_KEY, device_id)
         p.set(f'{DEVICE_META_PREFIX}:{device_id}', orjson.dumps(meta or {}))
         p.xadd(f'{EVENT_PREFIX}:device.connected', {b'd': orjson.dumps({ "device_id": device_id, "connected": True, "meta": meta })})
@@ -88,9 +89,13 @@ async def update_device_meta(device_id: str, meta: dict[str, typing.Any]) -> dic
             ['meta_set', 'fired:device.meta'], 
             map(bool, await p.execute(raise_on_error=False))))
 
+async def heartbeat(device_id: str) -> dict[str, int]:
+    return {'connection_status_changed': await presence.heartbeat(device_id, force=True)}
+
 async def disconnect_device(device_id: str) -> dict[str, int]:
     async with ctx.r.pipeline() as p:
-        p.rem(DEVICES_CONNECTED_KEY, device_id).sismember(DEVICES_CONNECTED_KEY, device_id)
+        presence.forget(device_id)
+        p.zrem(DEVICES_PRESENCE_KEY, device_id).zscore(DEVICES_PRESENCE_KEY, device_id)
         p.xadd(f'{EVENT_PREFIX}:device.connected', {b'd': orjson.dumps({ "device_id": device_id, "connected": False })})
         return dict(zip(
             ['connection_status_changed', 'connected', 'fired:device.connected'], 
@@ -106,6 +111,10 @@ class DeviceMutation:
     async def update_device_meta(self, device_id: str, meta: JSON) -> JSON:
         return await update_device_meta(device_id, meta)
 
+    @strawberry.mutation(description="Mark a device as alive. Pushing data does this implicitly.")
+    async def heartbeat(self, device_id: str) -> JSON:
+        return await heartbeat(device_id)
+
     @strawberry.mutation
     async def disconnect_device(self, device_id: str) -> JSON:
         return await disconnect_device(device_id)
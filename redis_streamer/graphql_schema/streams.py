@@ -11,6 +11,9 @@ import asyncio
 import orjson
 from redis import asyncio as aioredis
 from redis_streamer import utils, ctx, Agent
+from redis_streamer import fanout, lag, shm, aggregate, derived, keyframes, tensors, jsonindex, streammeta
+from redis_streamer.jsonfilter import JsonFilter
+from redis_streamer.core import unregister_stream, pipeline_by_shard
 from redis_streamer.config import *
 
 
@@ -36,39 +39,43 @@ Utf8 = strawberry.scalar(
 async def get_stream_ids(match: str|None=None, search_meta: bool=False, prefix: str='') -> list[str]:
     if prefix:
         match = f'{prefix}{match or "*"}'
-    keys = {x.decode('utf-8') async for x in ctx.r.scan_iter(match=match or None, _type='stream')}
+    keys = set()
+    for r in ctx.shards:
+        keys.update([x.decode('utf-8') async for x in r.scan_iter(match=match or None, _type='stream')])
     if search_meta:
         meta_prefix = f'{STREAM_META_PREFIX}:'
         keys.update({
             k[len(meta_prefix):].decode('utf-8') 
             # async for k in ctx.r.scan_iter(f'{meta_prefix}*', _type='hash')
-            async for k in ctx.r.scan_iter(f'{meta_prefix}*', _type='string')
+            async for k in ctx.r.scan_iter(f'{meta_prefix}{match or "*"}', _type='string')
         })
     if prefix:
         keys = {k[len(prefix):] for k in keys}
     return sorted(keys)
 
-async def get_streams(ids: list[str]|None=None, match: str|None=None, prefix: str='') -> list[Stream]:
+async def get_streams(ids: list[str]|None=None, match: str|None=None, prefix: str='', consistency: str|None=None) -> list[Stream]:
     # get list of stream IDs
     ids = ids or await get_stream_ids(match=match, search_meta=True, prefix=prefix)
     # query stream info and meta
     async with ctx.r.pipeline() as p:
         for sid in ids:
-            # p.hgetall(f'{STREAM_META_PREFIX}:{prefix or ""}{sid}').xinfo_stream(f'{prefix or ""}{sid}')
-            p.get(f'{STREAM_META_PREFIX}:{prefix or ""}{sid}').xinfo_stream(f'{prefix or ""}{sid}')
-        res = await p.execute(raise_on_error=False)
+            # p.hgetall(f'{STREAM_META_PREFIX}:{prefix or ""}{sid}')
+            p.get(f'{STREAM_META_PREFIX}:{prefix or ""}{sid}')
+        metas = await p.execute(raise_on_error=False)
+    infos = await pipeline_by_shard(
+        [f'{prefix or ""}{sid}' for sid in ids], 
+        lambda p, sid: p.xinfo_stream(sid), raise_on_error=False, consistency=consistency)
     # create stream objects
     return [
         Stream.from_info_meta(sid, info, orjson.loads(meta) if isinstance(meta, bytes) else meta)
-        for sid, meta, info in zip(ids, res[::2], res[1::2])
+        for sid, meta, info in zip(ids, metas, infos)
     ]
 
-async def get_stream(id: str) -> Stream:
+async def get_stream(id: str, consistency: str|None=None) -> Stream:
     # query stream info and meta
-    async with ctx.r.pipeline() as pipe:
-        # pipe.hgetall(f'{STREAM_META_PREFIX}:{id}').xinfo_stream(id)
-        pipe.get(f'{STREAM_META_PREFIX}:{id}').xinfo_stream(id)
-        meta, info = await pipe.execute(raise_on_error=False)
+    meta, (info,) = await asyncio.gather(
+        ctx.r.get(f'{STREAM_META_PREFIX}:{id}'),
+        pipeline_by_shard([id], lambda p, sid: p.xinfo_stream(sid), raise_on_error=False, consistency=consistency))
     meta = orjson.loads(meta) if isinstance(meta, bytes) else meta
     # create stream object
     return Stream.from_info_meta(id, info, meta)
@@ -175,11 +182,30 @@ STREAMS_BY_FORMAT = {
     DEFAULT_STREAM_FORMAT: Stream,
 }
 
+async def get_consumers(stream_id: str|None=None) -> JSON:
+    '''Pull sockets and subscription readers, with their delivery latency and how far behind the head of each stream they are.'''
+    return await lag.get_consumers(stream_id)
+
+async def get_aggregate(
+        stream_id: str, fields: list[str], bucket: float, start: str|None=None, end: str|None=None,
+        device_id: str=DEFAULT_DEVICE, consistency: str|None=None) -> JSON:
+    '''Count, min, max, mean and last of numeric JSON fields (dotted paths) for each bucket (in milliseconds).'''
+    if ENABLE_MULTI_DEVICE_PREFIXING:
+        stream_id = f'{device_id or DEFAULT_DEVICE}:{stream_id}'
+    return await aggregate.aggregate(stream_id, fields, bucket, start, end, consistency=consistency)
+
+async def get_derived_streams() -> JSON:
+    '''Derived streams and their transforms.'''
+    return await derived.get_all()
+
 @strawberry.type
 class Streams:
     streamIds: list[str] = strawberry.field(resolver=get_stream_ids)
     streams: list[Stream] = strawberry.field(resolver=get_streams)
     stream: Stream = strawberry.field(resolver=get_stream)
+    consumers: JSON = strawberry.field(resolver=get_consumers)
+    aggregate: JSON = strawberry.field(resolver=get_aggregate)
+    derivedStreams: JSON = strawberry.field(resolver=get_derived_streams)
 
 
 
@@ -201,25 +227,34 @@ async def update_stream_meta(stream_id: str, meta: JSON, device_id: str=DEFAULT_
         stream_id = f'{device_id or DEFAULT_DEVICE}:{stream_id}'
     # return await ctx.r.hset(f'{STREAM_META_PREFIX}:{sid}', mapping=meta)
     if update:
-        previous = await ctx.r.get(stream_id)
+        previous = await ctx.r.get(f'{STREAM_META_PREFIX}:{stream_id}')
         if previous:
             meta = {**orjson.loads(previous), **meta}
-    return {
+    tensors.parse_spec(meta)  # check dtype and shape
+    jsonindex.parse_index(meta)  # and indexed fields
+    result = {
         "meta_set": await ctx.r.set(f'{STREAM_META_PREFIX}:{stream_id}', orjson.dumps(meta))
     }
+    streammeta.invalidate(stream_id)
+    return result
 
 async def delete_stream(stream_id: str, device_id: str=DEFAULT_DEVICE) -> dict[str, bool]:
     # return await ctx.r.xdel(f'{STREAM_META_PREFIX}:{sid}', mapping=meta)
-    async with ctx.r.pipeline() as p:
-        if ENABLE_MULTI_DEVICE_PREFIXING:
-            stream_id = f'{device_id or DEFAULT_DEVICE}:{stream_id}'
+    if ENABLE_MULTI_DEVICE_PREFIXING:
+        stream_id = f'{device_id or DEFAULT_DEVICE}:{stream_id}'
+    async with ctx.shard(stream_id).pipeline() as p:
         p.xtrim(stream_id, 0, approximate=False)
-        p.delete(f'{STREAM_META_PREFIX}:{stream_id}')
         p.delete(stream_id)
-        return dict(zip(
-            ['data_deleted', 'meta_deleted', 'stream_deleted'],
-            map(bool, await p.execute(raise_on_error=False))
-        ))
+        data_deleted, stream_deleted = await p.execute(raise_on_error=False)
+    meta_deleted = await ctx.r.delete(f'{STREAM_META_PREFIX}:{stream_id}')
+    await ctx.r.delete(keyframes.index_key(stream_id))
+    await jsonindex.drop(stream_id)
+    result = dict(zip(
+        ['data_deleted', 'meta_deleted', 'stream_deleted'],
+        map(bool, [data_deleted, meta_deleted, stream_deleted])
+    ))
+    await unregister_stream(stream_id)
+    return result
 
 
 @strawberry.type
@@ -232,6 +267,32 @@ class StreamMutation:
     async def delete_stream(self, stream_id: str, device_id: str=DEFAULT_DEVICE) -> JSON:
         return await delete_stream(stream_id, device_id)
 
+    @strawberry.mutation(description="Create a shared-memory ring that local processes can write the stream's entries to. Returns its path.")
+    async def attach_shared_memory(self, stream_id: str, device_id: str=DEFAULT_DEVICE, capacity: int=shm.SHM_DEFAULT_CAPACITY) -> JSON:
+        if ENABLE_MULTI_DEVICE_PREFIXING:
+            stream_id = f'{device_id or DEFAULT_DEVICE}:{stream_id}'
+        return await shm.attach(stream_id, capacity)
+
+    @strawberry.mutation(description="Run a transform (a redis_streamer.transforms entry point, or module:function from DERIVED_TRANSFORM_MODULES) on input streams, writing to an output stream.")
+    async def create_derived_stream(
+            self, name: str, transform: str, input_stream_ids: list[str], output_stream_id: str,
+            device_id: str=DEFAULT_DEVICE, batch: int=derived.DERIVED_BATCH) -> JSON:
+        if ENABLE_MULTI_DEVICE_PREFIXING:
+            prefix = f'{device_id or DEFAULT_DEVICE}:'
+            input_stream_ids = [f'{prefix}{s}' for s in input_stream_ids]
+            output_stream_id = f'{prefix}{output_stream_id}'
+        return await derived.create(name, transform, input_stream_ids, output_stream_id, batch=batch)
+
+    @strawberry.mutation
+    async def delete_derived_stream(self, name: str) -> bool:
+        return await derived.delete(name)
+
+    @strawberry.mutation
+    async def detach_shared_memory(self, stream_id: str, device_id: str=DEFAULT_DEVICE) -> bool:
+        if ENABLE_MULTI_DEVICE_PREFIXING:
+            stream_id = f'{device_id or DEFAULT_DEVICE}:{stream_id}'
+        return await shm.detach(stream_id)
+
 
 # ---------------------------------------------------------------------------- #
 #                                 Subscriptions                                #
@@ -244,19 +305,34 @@ class StreamSubscription:
     async def streams(
         self, stream_ids: JSON, device: str|None, count: int=0, block: int=5000,
         latest: bool=False,
+        window: int=0,
+        consistency: str|None=None,
+        fields: list[str]|None=None,
+        where: list[str]|None=None,
     ) -> AsyncGenerator[DataPayloads|DataPayload, None]:
-        agent = Agent()
-        cursor = agent.init_cursor(stream_ids, prefix=f'{device}:')
-        while True:
-            result, cursor = await agent.read(cursor, count=count or 1, block=block, latest=latest)
-            for sid, xs in result:
-                if count:
-                    ts, xs = list(zip(*xs)) or ((),())
-                    yield DataPayloads(stream_id=sid, time=list(ts), data=[x[b'd'] for x in xs])
-                else:
-                    for t, x in xs:
-                        yield DataPayload(stream_id=sid, time=t, data=x[b'd'])
-                        # , meta={k.decode('utf-8'): v.decode('utf-8') for k, v in x.items() if k != b'd'}
+        """Subscribe to stream entries. Subscriptions to the same streams share a single
+        reader per worker. Set ``window`` (milliseconds) to receive all entries that
+        arrived during the window as one ``DataPayloads`` per stream. Reads go to a replica
+        if there is one, unless ``consistency`` is ``"primary"``. ``fields`` and ``where``
+        project and filter JSON entries (see ``jsonfilter``)."""
+        jsonfilter = JsonFilter(fields, where)
+        prefix = f'{device or DEFAULT_DEVICE}:' if ENABLE_MULTI_DEVICE_PREFIXING else ''
+        if isinstance(stream_ids, list):
+            stream_ids = {s: '$' for s in stream_ids}
+        cursor = {f'{prefix}{s}': t for s, t in stream_ids.items()}
+        async with fanout.subscribe(cursor, latest=latest, count=count or 1, block=block, consistency=consistency) as q:
+            while True:
+                result = await fanout.receive(q, window / 1000)
+                if jsonfilter:
+                    result = [(sid, xs) for sid, xs in jsonfilter.apply(result) if xs]
+                for sid, xs in result:
+                    if count or window:
+                        ts, entries = list(zip(*xs)) or ((),())
+                        yield DataPayloads(stream_id=sid, time=list(ts), data=[x[b'd'] for x in entries], entries=list(entries))
+                    else:
+                        for t, x in xs:
+                            yield DataPayload(stream_id=sid, time=t, data=x[b'd'], entry=x)
+                            # , meta={k.decode('utf-8'): v.decode('utf-8') for k, v in x.items() if k != b'd'}
 
 
 
@@ -273,6 +349,7 @@ class DataPayload:
     stream_id: Utf8
     time: Utf8
     data: Base64
+    entry: strawberry.Private[dict|None]=None
 
     @strawberry.field
     def string(self, format: str='utf-8') -> str:
@@ -280,7 +357,7 @@ class DataPayload:
 
     @strawberry.field
     def json(self) -> JSON:
-        return orjson.loads(self.data)
+        return utils.entry_json(self.entry) if self.entry is not None else orjson.loads(self.data)
 
 
 @strawberry.type
@@ -288,6 +365,7 @@ class DataPayloads:
     stream_id: Utf8
     time: list[Utf8]
     data: list[Base64]
+    entries: strawberry.Private[list[dict]|None]=None
 
     @strawberry.field
     def string(self, format: str='utf-8') -> list[str]:
@@ -295,4 +373,6 @@ class DataPayloads:
 
     @strawberry.field
     def json(self) -> list[JSON]:
+        if self.entries is not None:
+            return [utils.entry_json(x) for x in self.entries]
         return [orjson.loads(x) for x in self.data]
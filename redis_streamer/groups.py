@@ -0,0 +1,116 @@
+'''Frame groups: entries on several streams that belong to the same capture instant.
+
+Push with ``group=true`` and every batch (e.g. RGB + depth + pose) is written by one
+script, so it's atomic and all of its entries share the same entry ID. Each entry also
+stores the streams in its group under the ``g`` field.
+
+Pull with ``complete=true`` to only receive groups once every entry of the group (out
+of the streams you're pulling) has arrived, so consumers don't need to match
+timestamps themselves.
+'''
+from __future__ import annotations
+import os
+import time
+
+from redis_streamer import utils, metrics
+from redis_streamer.core import ctx, register_streams
+
+GROUP_BUFFER_SIZE = int(os.getenv('GROUP_BUFFER_SIZE') or 256)
+
+# writes ARGV[3:] to KEYS with one ID that is newer than the last entry of every stream
+GROUP_SCRIPT = '''
+local now = redis.call('TIME')
+local ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local seq = 0
+for i, key in ipairs(KEYS) do
+    local last = redis.call('XREVRANGE', key, '+', '-', 'COUNT', 1)
+    if last[1] then
+        local lms, lseq = string.match(last[1][1], '(%d+)-(%d+)')
+        lms, lseq = tonumber(lms), tonumber(lseq)
+        if lms > ms or (lms == ms and lseq >= seq) then
+            ms, seq = lms, lseq + 1
+        end
+    end
+end
+local id = string.format('%d-%d', ms, seq)
+for i, key in ipairs(KEYS) do
+    redis.call('XADD', key, 'MAXLEN', '~', ARGV[1], id, 'd', ARGV[i + 2], 'g', ARGV[2])
+end
+return id
+'''
+
+
+def check_group(sids: list[str]):
+    '''Make sure streams can be written as a frame group: different streams, on the same shard.'''
+    if len(set(sids)) != len(sids):
+        raise ValueError("A frame group can only have one entry per stream.")
+    if len(ctx.group_by_shard(sids)) != 1:
+        raise ValueError("All streams in a frame group must be on the same shard (i.e. the same device).")
+
+
+async def add_group(entries) -> str:
+    '''Atomically add one entry to each stream with a shared entry ID. ``entries`` is a list
+    of (stream_id, data). The streams must be different and live on the same shard.'''
+    t0 = time.perf_counter()
+    entries = list(entries)
+    sids = [sid for sid, _ in entries]
+    check_group(sids)
+    r = ctx.shard(sids[0])
+    t = await r.eval(GROUP_SCRIPT, len(sids), *sids, ctx.stream_maxlen, '+'.join(sids), *(d for _, d in entries))
+    for sid, d in entries:
+        metrics.entries_in.inc(sid)
+        metrics.bytes_in.inc(sid, value=len(d))
+    metrics.add_seconds.observe(time.perf_counter() - t0)
+    await register_streams(set(sids))
+    return utils.maybe_decode(t)
+
+
+class GroupBuffer:
+    '''Hold back grouped entries until the rest of their group arrives.
+
+    Entries that aren't part of a group are passed straight through. A group is dropped
+    once one of its streams has moved past it without it (e.g. it was trimmed or skipped
+    by ``latest``), or once more than ``size`` groups are waiting.
+    '''
+    def __init__(self, sids, size: int=GROUP_BUFFER_SIZE):
+        self.sids = set(sids)
+        self.size = size
+        self.pending: dict[str, dict[str, tuple]] = {}  # {entry_id: {sid: entry}}
+        self.members: dict[str, set[str]] = {}  # {entry_id: the streams we're waiting for}
+        self.last: dict[str, tuple[int, int]] = {}  # the last entry ID seen on each stream
+        self.dropped = 0
+
+    def add(self, results: list) -> list:
+        '''Take read results and return the ones that are ready, in the same format.'''
+        ready = []
+        for sid, xs in results:
+            for t, x in xs:
+                g = x.get(b'g')
+                if g is None:
+                    ready.append((t, sid, x))
+                    continue
+                if t not in self.pending:
+                    self.pending[t] = {}
+                    self.members[t] = set(utils.maybe_decode(g).split('+')) & self.sids
+                self.pending[t][sid] = (t, x)
+            if xs:
+                self.last[sid] = max(self.last.get(sid, (0, 0)), utils.parse_entry_id(xs[-1][0]))
+
+        for t in sorted(self.pending, key=utils.parse_entry_id):
+            entries, members = self.pending[t], self.members[t]
+            tid = utils.parse_entry_id(t)
+            if len(entries) >= len(members):
+                ready.extend((t, sid, x) for sid, (_, x) in entries.items())
+            elif any(self.last.get(s, (0, 0)) >= tid for s in members - set(entries)):
+                self.dropped += 1  # a stream moved past this group without it
+            elif len(self.pending) > self.size:
+                self.dropped += 1
+            else:
+                continue
+            del self.pending[t], self.members[t]
+
+        # back to [(sid, [(t, x), ...]), ...], in entry ID order
+        out: dict[str, list] = {}
+        for t, sid, x in sorted(ready, key=lambda e: utils.parse_entry_id(e[0])):
+            out.setdefault(sid, []).append((t, x))
+        return list(out.items())
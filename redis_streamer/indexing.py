@@ -0,0 +1,27 @@
+'''The indexes kept alongside streams: keyframes (``keyframes``) and JSON fields (``jsonindex``).
+
+Every path that writes entries to redis (pushes, the write-ahead log, frame groups,
+batched commands, the direct relay, shared-memory rings, derived streams) calls
+``after_write`` with what it wrote, so the indexes don't miss any entries.
+'''
+from __future__ import annotations
+
+from redis_streamer import keyframes, jsonindex
+
+
+async def after_write(sids: list[str], ids: list, entries: list, metas: list|None=None):
+    '''Index entries that were just written to redis. Entries that weren't written (their
+    ID is an error or None) are skipped. The entries are already stored, so indexing
+    errors are logged rather than raised.'''
+    ok = [i for i, t in enumerate(ids) if t and not isinstance(t, Exception)]
+    if len(ok) < len(ids):
+        sids, ids, entries = ([xs[i] for i in ok] for xs in (sids, ids, entries))
+        metas = [metas[i] for i in ok] if metas else None
+    if not ids:
+        return
+    try:
+        if metas and any(metas):
+            await keyframes.add(sids, ids, metas)
+        await jsonindex.add(sids, ids, entries)
+    except Exception as e:
+        print("Indexing failed:", type(e).__name__, e)
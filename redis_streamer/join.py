@@ -0,0 +1,99 @@
+'''Align entries from several streams by timestamp.
+
+The first stream is the reference. For each of its entries, the joiner picks one entry
+from each of the other streams, within ``tolerance`` milliseconds:
+
+ - ``nearest``: the entry closest in time (before or after).
+ - ``asof``: the latest entry at or before it.
+
+A reference entry is held until every other stream has moved past it (so nothing
+better can still arrive), or until any stream is more than ``tolerance`` ahead of it,
+in which case the best match so far is used. Reference entries without a match on
+every stream are dropped.
+
+Aligned tuples are returned in the usual ``[(stream_id, [(entry_id, entry)])]`` format,
+one item per stream in stream order, so each tuple is ``len(sids)`` consecutive items.
+'''
+from __future__ import annotations
+import os
+from collections import deque
+
+from redis_streamer import utils
+
+JOIN_BUFFER_SIZE = int(os.getenv('JOIN_BUFFER_SIZE') or 256)
+JOIN_MODES = ('nearest', 'asof')
+
+
+class Joiner:
+    def __init__(self, sids: list[str], mode: str='nearest', tolerance: float=50, size: int=JOIN_BUFFER_SIZE):
+        if mode not in JOIN_MODES:
+            raise ValueError(f"Unknown join mode {mode!r}. Expected one of {JOIN_MODES}.")
+        if len(sids) < 2:
+            raise ValueError("Joining needs at least two streams.")
+        self.sids = list(sids)
+        self.ref, *self.others = self.sids
+        self.mode = mode
+        self.tolerance = tolerance
+        self.size = size
+        # (entry ID tuple, entry ID, entry) for each stream, oldest first
+        self.buffers: dict[str, deque] = {s: deque(maxlen=size) for s in self.sids}
+        self.clock = (0, 0)  # the newest entry ID seen on any stream
+        self.dropped = 0
+
+    def add(self, results: list, flush: bool=False) -> list:
+        '''Take read results and return the aligned tuples that are ready. With ``flush``,
+        don't wait for better matches - e.g. for one-off requests.'''
+        for sid, xs in results:
+            buf = self.buffers.get(sid)
+            if buf is None:
+                continue
+            for t, x in xs:
+                tid = utils.parse_entry_id(t)
+                if not buf or tid > buf[-1][0]:  # ignore anything out of order (e.g. from latest)
+                    buf.append((tid, t, x))
+                    self.clock = max(self.clock, tid)
+
+        out = []
+        ref = self.buffers[self.ref]
+        while ref:
+            tid, t, x = ref[0]
+            expired = flush or self.clock[0] - tid[0] > self.tolerance
+            matches = []
+            for s in self.others:
+                match, settled = self._match(self.buffers[s], tid)
+                if not settled and not expired:
+                    return self._emit(out)
+                matches.append((s, match))
+            ref.popleft()
+            self._trim(tid)
+            if any(m is None for _, m in matches):
+                self.dropped += 1
+                continue
+            out.append([(self.ref, (t, x))] + [(s, (m[1], m[2])) for s, m in matches])
+        return self._emit(out)
+
+    def _match(self, buf: deque, tid: tuple) -> tuple[tuple|None, bool]:
+        '''Find the best entry for a reference time. Also returns whether it's final.'''
+        before = after = None
+        for e in buf:
+            if e[0] <= tid:
+                before = e
+            else:
+                after = e
+                break
+        settled = after is not None or (self.mode == 'nearest' and before is not None and before[0] == tid)
+        candidates = [before] if self.mode == 'asof' else [before, after]
+        best = min(
+            (e for e in candidates if e is not None and abs(tid[0] - e[0][0]) <= self.tolerance),
+            key=lambda e: abs(tid[0] - e[0][0]), default=None)
+        return best, settled
+
+    def _trim(self, tid: tuple):
+        # entries further back than the tolerance can't match this or any later reference entry
+        for s in self.others:
+            buf = self.buffers[s]
+            while buf and tid[0] - buf[0][0][0] > self.tolerance:
+                buf.popleft()
+
+    def _emit(self, tuples: list) -> list:
+        return [(s, [e]) for row in tuples for s, e in row]
@@ -0,0 +1,152 @@
+'''Field projection and filtering for JSON streams.
+
+Filters are simple predicates on dotted field paths (list items by index), and all of
+them must match:
+
+    confidence > 0.5
+    label in ["person", "car"]
+    box.0 >= 100
+    track_id exists
+
+Values are JSON (``"car"``, ``0.5``, ``[1, 2]``, ``null``). A bare word is taken as a
+string. Projections pick fields out of each entry. The result is a flat object keyed by
+path, e.g. ``{"label": "car", "box.0": 120}``.
+
+Everything is parsed once per subscription into a ``JsonFilter``. Each entry only costs
+a json decode (shared between subscribers through ``utils.entry_json``) and a few
+lookups.
+'''
+from __future__ import annotations
+import re
+import operator
+import orjson
+
+from redis_streamer import utils
+
+PREDICATE = re.compile(r'^\s*([^\s<>=!]+)\s*(>=|<=|==|!=|>|<|=|not\s+in|in|exists|missing)\s*(.*?)\s*$')
+
+
+def compile_path(path: str) -> tuple:
+    return tuple(int(k) if k.lstrip('-').isdigit() else k for k in path.split('.'))
+
+_MISSING = object()
+
+def get_path(x, keys: tuple, default=None):
+    '''Get a value from nested dicts and lists, e.g. ``get_path(doc, ('box', 0))``.'''
+    for k in keys:
+        try:
+            x = x[k]
+        except (KeyError, IndexError, TypeError):
+            if isinstance(x, dict) and isinstance(k, int):  # a numeric dict key
+                x = x.get(str(k), _MISSING)
+                if x is not _MISSING:
+                    continue
+            return default
+    return x
+
+
+def _compare(op):
+    def compare(a, b):
+        try:
+            return op(a, b)
+        except TypeError:  # e.g. a string and a number
+            return False
+    return compare
+
+OPS = {
+    '>': _compare(operator.gt),
+    '>=': _compare(operator.ge),
+    '<': _compare(operator.lt),
+    '<=': _compare(operator.le),
+    '==': operator.eq,
+    '=': operator.eq,
+    '!=': operator.ne,
+}
+
+
+def parse_predicate(expr: str) -> tuple[str, str, object]:
+    '''Split ``"confidence > 0.5"`` into its path, operator and (decoded) value.'''
+    m = PREDICATE.match(expr)
+    if m is None:
+        raise ValueError(f"Invalid filter {expr!r}. Expected e.g. 'confidence > 0.5' or 'label in [\"car\"]'.")
+    path, op, value = m.groups()
+    op = ' '.join(op.split())
+    if op in ('exists', 'missing'):
+        if value:
+            raise ValueError(f"Invalid filter {expr!r}. '{op}' doesn't take a value.")
+        return path, op, None
+    if not value:
+        raise ValueError(f"Invalid filter {expr!r}. Missing a value.")
+    try:
+        value = orjson.loads(value)
+    except orjson.JSONDecodeError:
+        pass  # a bare word
+    if op in ('in', 'not in') and not isinstance(value, list):
+        raise ValueError(f"Invalid filter {expr!r}. '{op}' needs a list.")
+    return path, op, value
+
+
+def compile_predicate(expr: str):
+    '''Turn ``"confidence > 0.5"`` into a function of a document.'''
+    path, op, value = parse_predicate(expr)
+    keys = compile_path(path)
+    if op in ('exists', 'missing'):
+        present = op == 'exists'
+        return lambda doc: (get_path(doc, keys, _MISSING) is not _MISSING) == present
+    if op in ('in', 'not in'):
+        try:
+            value = frozenset(value)
+        except TypeError:  # unhashable items - keep the list
+            pass
+        inside = op == 'in'
+        def predicate(doc):
+            try:
+                return (get_path(doc, keys, _MISSING) in value) == inside
+            except TypeError:  # an unhashable value
+                return not inside
+        return predicate
+    compare = OPS[op]
+    def predicate(doc):
+        x = get_path(doc, keys, _MISSING)
+        return x is not _MISSING and compare(x, value)
+    return predicate
+
+
+class JsonFilter:
+    '''A compiled projection and filter for one subscription.'''
+    def __init__(self, fields: list[str]|None=None, where: list[str]|None=None):
+        self.fields = [(f, compile_path(f)) for f in fields or ()]
+        self.predicates = [compile_predicate(w) for w in where or ()]
+
+    def __bool__(self):
+        return bool(self.fields or self.predicates)
+
+    def match(self, doc) -> bool:
+        return all(p(doc) for p in self.predicates)
+
+    def project(self, doc) -> dict:
+        return {f: get_path(doc, keys) for f, keys in self.fields}
+
+    def apply(self, results: list) -> list:
+        '''Filter and project read results (``[(stream_id, [(entry_id, entry), ...]), ...]``).
+        Entries that aren't JSON don't match any filter, and aren't projected.'''
+        out = []
+        for sid, xs in results:
+            ys = []
+            for t, x in xs:
+                try:
+                    doc = utils.entry_json(x)
+                except orjson.JSONDecodeError:
+                    if not self.predicates:
+                        ys.append((t, x))
+                    continue
+                if not self.match(doc):
+                    continue
+                if self.fields:
+                    doc = self.project(doc)
+                    x = {k: v for k, v in x.items() if k != utils.JSON_CACHE_KEY}
+                    x[b'd'] = orjson.dumps(doc)
+                    x[utils.JSON_CACHE_KEY] = doc
+                ys.append((t, x))
+            out.append((sid, ys))
+        return out
@@ -0,0 +1,258 @@
+'''Secondary indexes over JSON stream fields.
+
+Finding the entries with ``label == "person"`` normally means reading every entry in
+the window. A stream can instead declare fields to index in its meta (e.g. with the
+``updateStreamMeta`` mutation):
+
+    {"index": ["label", "track_id"]}
+
+New entries of the stream are then indexed as they're written. For each field value
+there is a sorted set of the entry IDs that have it (scored by their millisecond
+time), and ``search`` reads only the matching IDs and entries. Fields holding lists are
+indexed by each item. Entries written before the index was declared aren't indexed.
+
+Searches page through the postings of the most selective filter (``INDEX_PAGE_SIZE``
+IDs at a time, with ``ZRANGE ... BYSCORE LIMIT``) and check the other filters with
+``ZMSCORE``, so they stop once ``count`` entries are found.
+
+The postings are trimmed in step with the stream: every ``INDEX_TRIM_INTERVAL``
+seconds, a write starts a background task (one per stream at a time) that removes the
+IDs older than the stream's first entry (``INDEX_TRIM_BATCH`` postings keys per script
+call, so large indexes don't block redis). Index fields with
+few distinct values (labels, IDs, states), not continuous ones (positions, scores).
+'''
+from __future__ import annotations
+import os
+import time
+import asyncio
+import orjson
+
+from redis_streamer import utils
+from redis_streamer.core import ctx
+from redis_streamer.config import INDEX_PREFIX
+from redis_streamer.streammeta import MetaCache
+from redis_streamer.jsonfilter import JsonFilter, compile_path, get_path, parse_predicate, _MISSING
+
+INDEX_TRIM_INTERVAL = float(os.getenv('INDEX_TRIM_INTERVAL') or 10)
+INDEX_MAX_RESULTS = int(os.getenv('INDEX_MAX_RESULTS') or 10000)
+INDEX_PAGE_SIZE = int(os.getenv('INDEX_PAGE_SIZE') or 1000)
+INDEX_TRIM_BATCH = int(os.getenv('INDEX_TRIM_BATCH') or 100)
+
+# KEYS: the set of a stream's postings keys. ARGV: the first millisecond to keep, the
+# SSCAN cursor and how many keys to scan. Returns {postings removed, next cursor}
+TRIM_SCRIPT = '''
+local removed = 0
+local scan = redis.call('SSCAN', KEYS[1], ARGV[2], 'COUNT', ARGV[3])
+for _, key in ipairs(scan[2]) do
+    removed = removed + redis.call('ZREMRANGEBYSCORE', key, '-inf', '(' .. ARGV[1])
+    if redis.call('EXISTS', key) == 0 then
+        redis.call('SREM', KEYS[1], key)
+    end
+end
+return {removed, scan[1]}
+'''
+
+
+def parse_index(meta: dict|None) -> tuple[tuple[str, tuple], ...]|None:
+    '''Get the indexed fields from stream meta (``None`` if there aren't any).'''
+    fields = meta.get('index') if isinstance(meta, dict) else None
+    if fields is None:
+        return None
+    if not isinstance(fields, list) or not all(isinstance(f, str) and f for f in fields):
+        raise ValueError(f"Invalid index {fields!r}. Expected a list of field paths, e.g. [\"label\"].")
+    return tuple((f, compile_path(f)) for f in fields) or None
+
+
+_indexes = MetaCache(parse_index)
+
+
+def keys_key(sid: str) -> str:
+    return f'{INDEX_PREFIX}:{sid}'
+
+def postings_key(sid: str, field: str, value) -> str:
+    return f'{INDEX_PREFIX}:{sid}:{field}={encode_value(value)}'
+
+
+def encode_value(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # so 3 and 3.0 match
+    return orjson.dumps(value).decode('utf-8')
+
+
+def _values(x):
+    if isinstance(x, list):
+        return [v for v in x if not isinstance(v, (dict, list))]
+    if x is _MISSING or isinstance(x, dict):
+        return []
+    return [x]
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Indexing                                   #
+# ---------------------------------------------------------------------------- #
+
+_trimmed: dict[str, float] = {}
+_trimming: dict[str, asyncio.Task] = {}
+
+async def add(sids: list[str], ids: list, datas: list) -> int:
+    '''Index new entries of streams that have an index. Returns the number of postings added.'''
+    indexes = await _indexes.get(sids)
+    if not any(indexes.values()):
+        return 0
+    n = 0
+    touched = set()
+    async with ctx.r.pipeline(transaction=False) as p:
+        for sid, t, data in zip(sids, ids, datas):
+            fields = indexes[sid]
+            if not fields or not t:
+                continue
+            try:
+                doc = orjson.loads(data)
+            except orjson.JSONDecodeError:
+                continue
+            t = utils.maybe_decode(t)
+            ms = utils.parse_entry_id(t)[0]
+            for field, path in fields:
+                for value in _values(get_path(doc, path, _MISSING)):
+                    key = postings_key(sid, field, value)
+                    p.zadd(key, {t: ms})
+                    p.sadd(keys_key(sid), key)
+                    n += 1
+            touched.add(sid)
+        if n:
+            await p.execute()
+    now = time.time()
+    for sid in touched:
+        if now - _trimmed.get(sid, 0) > INDEX_TRIM_INTERVAL and sid not in _trimming:
+            _trimmed[sid] = now
+            _trimming[sid] = task = asyncio.create_task(_trim_quietly(sid))
+            task.add_done_callback(lambda _, sid=sid: _trimming.pop(sid, None))
+    return n
+
+
+async def trim(sid: str) -> int:
+    '''Remove postings of entries that have been trimmed from the stream.'''
+    first = await ctx.shard(sid).xrange(sid, count=1)
+    # an empty (or deleted) stream has nothing left to point to
+    first_ms = utils.parse_entry_id(first[0][0])[0] if first else '+inf'
+    removed, cursor = 0, 0
+    while True:
+        n, cursor = await ctx.r.eval(TRIM_SCRIPT, 1, keys_key(sid), first_ms, cursor, INDEX_TRIM_BATCH)
+        removed += n
+        if int(cursor) == 0:
+            return removed
+
+
+async def _trim_quietly(sid: str):
+    try:
+        await trim(sid)
+    except Exception as e:
+        print(f"Trimming the index of {sid} failed:", type(e).__name__, e)
+
+
+async def drop(sid: str):
+    '''Delete a stream's index.'''
+    keys = await ctx.r.smembers(keys_key(sid))
+    await ctx.r.delete(keys_key(sid), *keys)
+    _trimmed.pop(sid, None)
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Searching                                  #
+# ---------------------------------------------------------------------------- #
+
+def _rank(t: str) -> tuple[int, str]:
+    '''How redis orders postings: by score (milliseconds), then by member.'''
+    return utils.parse_entry_id(t)[0], t
+
+def _bound(x: str|None, default: str) -> str:
+    return default if x is None or x in ('-', '+') else str(utils.parse_entry_id(x)[0])
+
+
+async def search(sid: str, where: list[str], start: str|None=None, end: str|None=None, count: int=100, latest: bool=False,
+                 fields: list[str]|None=None, consistency: str|None=None) -> list:
+    '''Find the entries of a stream that match all of the filters (see ``jsonfilter``).
+
+    ``==`` and ``in`` filters on indexed fields are looked up in the index (at least one
+    is needed), so they also match lists that contain the value. The rest are checked on
+    the matching entries.
+
+    Returns up to ``count`` entries (the first ones, or the last ones with ``latest``) in
+    the usual ``[(stream_id, [(entry_id, entry), ...])]`` format, oldest first.
+    '''
+    indexed = dict((await _indexes.get([sid]))[sid] or ())
+    lookups, rest = [], []
+    for expr in where or ():
+        path, op, value = parse_predicate(expr)
+        if path in indexed and op in ('==', '=', 'in'):
+            lookups.append((path, value if op == 'in' else [value]))
+        else:
+            rest.append(expr)
+    if not lookups:
+        raise ValueError(f"Searching needs an == or in filter on an indexed field ({', '.join(indexed) or 'none'}).")
+
+    # each filter matches the union of its values' postings, and all filters must match.
+    # page through the filter with the fewest postings and check the others per page
+    r = ctx.reader(ctx.r, consistency)
+    lo, hi = _bound(start, '-inf'), _bound(end, '+inf')
+    lookups = [[postings_key(sid, field, v) for v in values] for field, values in lookups]
+    async with r.pipeline(transaction=False) as p:
+        for keys in lookups:
+            for key in keys:
+                p.zcount(key, lo, hi)
+        sizes = iter(await p.execute())
+    lookups.sort(key=lambda keys: sum(next(sizes) for _ in keys))
+    driver, others = lookups[0], lookups[1:]
+    start_id = utils.parse_entry_id(start) if start not in (None, '-') else None
+    end_id = utils.parse_entry_id(end) if end not in (None, '+') else None
+
+    jsonfilter = JsonFilter(fields, rest)
+    shard = ctx.reader(ctx.shard(sid), consistency)
+    limit = min(count or INDEX_MAX_RESULTS, INDEX_MAX_RESULTS)
+    order = utils.parse_entry_id
+    out = []
+    offsets = dict.fromkeys(driver, 0)
+    while offsets and len(out) < limit:
+        # the next page of the driving filter: merge its values' postings in order
+        async with r.pipeline(transaction=False) as p:
+            for key, offset in offsets.items():
+                p.zrange(key, hi if latest else lo, lo if latest else hi, desc=latest, byscore=True,
+                         offset=offset, num=INDEX_PAGE_SIZE)
+            pages = dict(zip(offsets, ([utils.maybe_decode(t) for t in xs] for xs in await p.execute())))
+        # only the IDs up to the end of the shortest full page are complete across keys
+        full = [_rank(xs[-1]) for xs in pages.values() if len(xs) == INDEX_PAGE_SIZE]
+        edge = (max if latest else min)(full) if full else None
+        ids = set()
+        for key, xs in pages.items():
+            if edge is not None:
+                xs = [t for t in xs if (_rank(t) >= edge if latest else _rank(t) <= edge)]
+            offsets[key] += len(xs)
+            ids.update(xs)
+            if len(pages[key]) < INDEX_PAGE_SIZE and len(xs) == len(pages[key]):
+                offsets.pop(key)  # exhausted
+        ids = sorted(ids, key=order, reverse=latest)
+        # scores are milliseconds, so check the exact window too
+        ids = [t for t in ids if (start_id is None or order(t) >= start_id) and (end_id is None or order(t) <= end_id)]
+        if others and ids:
+            async with r.pipeline(transaction=False) as p:
+                for keys in others:
+                    for key in keys:
+                        p.zmscore(key, ids)
+                scores = iter(await p.execute())
+            keep = [True] * len(ids)
+            for keys in others:
+                hits = [next(scores) for _ in keys]
+                keep = [k and any(h[i] is not None for h in hits) for i, k in enumerate(keep)]
+            ids = [t for t, k in zip(ids, keep) if k]
+        if not ids:
+            continue
+
+        # then read just those entries, applying any other filters
+        async with shard.pipeline(transaction=False) as p:
+            for t in ids:
+                p.xrange(sid, t, t, count=1)
+            entries = await p.execute()
+        found = [(t, xs[0][1]) for t, xs in zip(ids, entries) if xs]  # skip ones trimmed since
+        out.extend(jsonfilter.apply([(sid, found)])[0][1])
+    out = out[:limit]
+    return [(sid, out[::-1] if latest else out)] if out else []
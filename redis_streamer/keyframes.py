@@ -0,0 +1,82 @@
+'''Keyframe index for streams that can't skip frames.
+
+Delta-coded streams (e.g. H.264) can only be decoded starting from a keyframe, so
+``latest`` doesn't work for them, and a new viewer has to either wait for new data
+(``$``) or replay everything still in the stream (``0``).
+
+Producers mark keyframes when they push, with a meta object as the fourth item of an
+offsets header entry (``[stream_id, timestamp, end_index, {"keyframe": true}]``). The
+entry IDs of the last ``KEYFRAME_INDEX_SIZE`` keyframes of each stream are kept in a
+sorted set (scored by milliseconds, with zero-padded members so keyframes in the same
+millisecond are ordered by sequence number), and readers can start with
+``last_entry_id=last_keyframe`` to get the most recent keyframe that is still in the
+stream, then everything after it.
+'''
+from __future__ import annotations
+import os
+
+from redis_streamer import utils
+from redis_streamer.core import ctx, pipeline_by_shard
+from redis_streamer.config import KEYFRAME_PREFIX
+
+KEYFRAME_INDEX_SIZE = int(os.getenv('KEYFRAME_INDEX_SIZE') or 64)
+LAST_KEYFRAME = 'last_keyframe'
+MAX_SEQ = 2**64 - 1
+
+
+def index_key(sid: str) -> str:
+    return f'{KEYFRAME_PREFIX}:{sid}'
+
+
+def is_keyframe(meta) -> bool:
+    return isinstance(meta, dict) and bool(meta.get('keyframe'))
+
+
+def index_member(tid: str) -> str:
+    '''A fixed-width form of an entry ID, so members with the same score sort like IDs.'''
+    return '{:020d}-{:020d}'.format(*utils.parse_entry_id(tid))
+
+
+def entry_id_before(tid: str) -> str:
+    '''The largest entry ID before ``tid``, so an (exclusive) cursor starts at ``tid``.'''
+    ms, seq = utils.parse_entry_id(tid)
+    return f'{ms}-{seq - 1}' if seq else f'{ms - 1}-{MAX_SEQ}'
+
+
+async def add(sids: list[str], ids: list, metas: list) -> int:
+    '''Index the entries that were pushed with ``{"keyframe": true}``.'''
+    marked = [(sid, utils.maybe_decode(t)) for sid, t, meta in zip(sids, ids, metas) if is_keyframe(meta) and t]
+    if not marked:
+        return 0
+    async with ctx.r.pipeline() as p:
+        for sid, t in marked:
+            p.zadd(index_key(sid), {index_member(t): utils.parse_entry_id(t)[0]})
+            p.zremrangebyrank(index_key(sid), 0, -KEYFRAME_INDEX_SIZE - 1)
+        await p.execute()
+    return len(marked)
+
+
+async def last(sids: list[str], consistency: str|None=None) -> dict[str, str]:
+    '''Get the newest keyframe of each stream, skipping streams that have none left.'''
+    sids = list(sids)
+    async with ctx.r.pipeline() as p:
+        for sid in sids:
+            p.zrevrange(index_key(sid), 0, 0)
+        found = {sid: '{}-{}'.format(*utils.parse_entry_id(xs[0])) for sid, xs in zip(sids, await p.execute()) if xs}
+    if not found:
+        return {}
+    # the stream may have been trimmed (or deleted) past it
+    present = await pipeline_by_shard(
+        list(found), lambda p, sid: p.xrange(sid, found[sid], found[sid], count=1), consistency=consistency)
+    return {sid: t for (sid, t), xs in zip(found.items(), present) if xs}
+
+
+async def resolve_cursor(cursor: dict[str, str], consistency: str|None=None) -> dict[str, str]:
+    '''Replace ``last_keyframe`` in a cursor with the position just before each stream's
+    newest keyframe. Streams without one start from new entries (``$``).'''
+    sids = [sid for sid, t in cursor.items() if t == LAST_KEYFRAME]
+    if sids:
+        found = await last(sids, consistency)
+        for sid in sids:
+            cursor[sid] = entry_id_before(found[sid]) if sid in found else '$'
+    return cursor
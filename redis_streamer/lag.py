@@ -0,0 +1,149 @@
+'''End-to-end delivery latency and consumer lag.
+
+Redis entry IDs start with the ingest time in milliseconds, so comparing them to
+the time we send an entry gives the ingest-to-send latency for free. How far behind
+the head of the stream a consumer's cursor is gets sampled every
+``LAG_SAMPLE_INTERVAL`` seconds from ``XINFO STREAM`` (the length and the first and
+last entries), so it costs the same however far behind the consumer is. Redis can't
+count the entries after an arbitrary ID without reading them, so between the first and
+last entry the count is estimated from the entry times (it's exact when the consumer
+is caught up, or has fallen off the end of the stream).
+
+Consumer state is published per worker to redis so it can be queried from any worker.
+The metrics are labelled by route and stream (with the furthest behind consumer on
+this worker), not by consumer, so they don't grow a series per connection.
+'''
+from __future__ import annotations
+import os
+import time
+import uuid
+import orjson
+
+from redis_streamer import utils, metrics
+from redis_streamer.core import ctx, pipeline_by_shard, STREAM_CREATED_EVENT
+from redis_streamer.config import CONSUMERS_PREFIX
+
+LAG_SAMPLE_INTERVAL = float(os.getenv('LAG_SAMPLE_INTERVAL') or 5)
+
+
+def estimate_behind(cursor: str, info: dict) -> tuple[int, str|None]:
+    '''Estimate the entries after ``cursor`` from ``XINFO STREAM``. Returns the count and the head ID.'''
+    first, last = info.get('first-entry'), info.get('last-entry')
+    if not info.get('length') or not first or not last:
+        return 0, None
+    head = utils.maybe_decode(last[0])
+    c, a, b = (utils.parse_entry_id(x) for x in (cursor, first[0], head))
+    if c >= b:
+        return 0, head
+    if c < a:
+        return info['length'], head
+    # assume the entries are spread evenly in time between the first and last one
+    return max(1, min(info['length'] - 1, round(info['length'] * (b[0] - c[0]) / max(b[0] - a[0], 1)))), head
+
+
+delivery_latency = metrics.Histogram('delivery_latency_seconds', 'Time from ingest (entry ID) to being sent to a consumer.', ('route',))
+entries_behind = metrics.Gauge('consumer_entries_behind', 'Entries between the furthest behind consumer cursor and the head of the stream (estimated, see lag.py).', ('route', 'stream'))
+time_behind = metrics.Gauge('consumer_seconds_behind', 'Time between the furthest behind consumer cursor and the head of the stream.', ('route', 'stream'))
+
+consumers: dict[str, Consumer] = {}
+
+
+def update_lag_metrics(kind: str, sid: str):
+    '''Set the lag gauges of a route and stream to its furthest behind consumer.'''
+    xs = [c.streams[sid] for c in consumers.values() if c.kind == kind and sid in c.streams]
+    xs = [x for x in xs if x['entries_behind'] is not None]
+    if not xs:
+        entries_behind.remove(kind, sid)
+        time_behind.remove(kind, sid)
+        return
+    entries_behind.set(kind, sid, value=max(x['entries_behind'] for x in xs))
+    time_behind.set(kind, sid, value=max(x['time_behind'] for x in xs))
+
+
+def observe_latency(results: list, route: str) -> float:
+    now = time.time()
+    for sid, xs in results:
+        for t, _ in xs:
+            delivery_latency.observe(now - utils.parse_epoch_time(t), route)
+    return now
+
+
+class Consumer:
+    '''Tracks latency and lag for one pull socket or subscription reader.'''
+    def __init__(self, kind: str, **attrs):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.attrs = attrs
+        self.streams: dict[str, dict] = {}
+        self.last_check = 0.
+        consumers[self.id] = self
+
+    def _stream(self, sid: str) -> dict:
+        st = self.streams.get(sid)
+        if st is None:
+            st = self.streams[sid] = {
+                'stream_id': sid, 'cursor': '', 'delivered': 0,
+                'latency': None, 'entries_behind': None, 'time_behind': None,
+            }
+        return st
+
+    def delivered(self, results: list):
+        '''Record the ingest-to-send latency of entries that were just sent.'''
+        now = observe_latency(results, self.kind)
+        for sid, xs in results:
+            if not xs:
+                continue
+            st = self._stream(sid)
+            st['latency'] = now - utils.parse_epoch_time(xs[-1][0])
+            st['delivered'] += len(xs)
+
+    async def check_lag(self, cursor: dict[str, str], force: bool=False):
+        '''Sample how far behind the head each stream in the cursor is.'''
+        now = time.time()
+        if not force and now - self.last_check < LAG_SAMPLE_INTERVAL:
+            return
+        self.last_check = now
+        sids = [s for s in cursor if s != STREAM_CREATED_EVENT]
+        if not sids:
+            return
+        infos = await pipeline_by_shard(sids, lambda p, sid: p.xinfo_stream(sid), raise_on_error=False)
+        for sid, info in zip(sids, infos):
+            n, head = estimate_behind(cursor[sid], info if isinstance(info, dict) else {})
+            st = self._stream(sid)
+            st['cursor'] = cursor[sid]
+            st['entries_behind'] = n
+            st['time_behind'] = max(0, utils.parse_epoch_time(head) - utils.parse_epoch_time(cursor[sid])) if head else 0
+            update_lag_metrics(self.kind, sid)
+        await ctx.r.hset(self.key, self.id, orjson.dumps(self.as_dict()))
+        await ctx.r.expire(self.key, int(LAG_SAMPLE_INTERVAL * 3) + 1)
+
+    @property
+    def key(self):
+        return f'{CONSUMERS_PREFIX}:{metrics.WORKER_ID}'
+
+    def as_dict(self) -> dict:
+        return {
+            'id': self.id, 'kind': self.kind, 'worker': metrics.WORKER_ID,
+            'attrs': self.attrs, 'streams': list(self.streams.values()),
+        }
+
+    async def close(self):
+        consumers.pop(self.id, None)
+        for sid in self.streams:
+            update_lag_metrics(self.kind, sid)
+        try:
+            await ctx.r.hdel(self.key, self.id)
+        except Exception as e:  # e.g. redis is down. The hash expires if nothing refreshes it
+            print(f"Couldn't remove consumer {self.id}:", type(e).__name__, e)
+
+
+async def get_consumers(stream_id: str|None=None) -> list[dict]:
+    '''Get the consumers on all workers, optionally only those reading a specific stream.'''
+    keys = [k async for k in ctx.r.scan_iter(match=f'{CONSUMERS_PREFIX}:*', _type='hash')]
+    out = []
+    for k in keys:
+        for x in (await ctx.r.hgetall(k)).values():
+            c = orjson.loads(x)
+            if stream_id is None or any(s['stream_id'] == stream_id for s in c['streams']):
+                out.append(c)
+    return out
@@ -4,9 +4,9 @@ from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from strawberry.fastapi import GraphQLRouter
 
-from redis_streamer import ctx
+from redis_streamer import ctx, presence, metrics, replicas, relay, shm, derived, wal
 from redis_streamer import graphql_schema
-from redis_streamer.routes import data_requests, data_ws #, streaming, prompt_ws
+from redis_streamer.routes import data_requests, data_ws, direct_ws, prompt_ws, mux_ws, monitoring #, streaming
 
 
 
@@ -15,6 +15,17 @@ app = FastAPI()
 @app.on_event("startup")
 async def startup_event():
     await ctx.init()
+    presence.start()
+    replicas.start()
+    shm.start()
+    derived.start()
+    wal.start()
+    metrics.start(ctx.r)
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await relay.flush_all()
+    await wal.stop()
 
 @app.get('/')
 def index():
@@ -24,7 +35,10 @@ graphql_app = GraphQLRouter(graphql_schema.schema)
 app.include_router(graphql_app, prefix="/graphql")
 app.include_router(data_requests.app, prefix="/data")
 app.include_router(data_ws.app, prefix="/data")
-# app.include_router(prompt_ws.app, prefix="/data")
+app.include_router(direct_ws.app, prefix="/direct")
+app.include_router(monitoring.app)
+app.include_router(prompt_ws.app, prefix="/data")
+app.include_router(mux_ws.app, prefix="/data")
 # app.include_router(streaming.app, prefix="/streaming")
 
 app.add_middleware(
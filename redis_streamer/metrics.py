@@ -0,0 +1,210 @@
+'''Prometheus-style metrics for the data plane.
+
+Metrics are plain in-process dicts. They're only touched from the event loop between
+awaits, so they don't need locks. Each worker periodically flushes its counter and
+histogram deltas into a shared redis hash (and its gauges into a per-worker hash with
+a TTL), so ``/metrics`` reports totals across all gunicorn workers.
+'''
+from __future__ import annotations
+import os
+import socket
+import asyncio
+from redis_streamer.config import METRICS_KEY, METRICS_GAUGE_PREFIX
+
+PREFIX = 'redis_streamer'
+FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL') or 5)
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+TIME_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+registry: dict[str, Metric] = {}
+
+
+def escape(value) -> str:
+    '''Escape a label value for the text exposition format (stream IDs can contain anything).'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    type = 'untyped'
+    def __init__(self, name: str, description: str='', labels: tuple[str, ...]=()):
+        self.name = f'{PREFIX}_{name}'
+        self.description = description
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+        registry[self.name] = self
+
+    def series(self, key: tuple, suffix: str='', **extra) -> str:
+        labels = [f'{k}="{escape(v)}"' for k, v in (*zip(self.labels, key), *extra.items())]
+        return f'{self.name}{suffix}{{{",".join(labels)}}}' if labels else f'{self.name}{suffix}'
+
+    def collect(self) -> dict[str, float]:
+        '''Get and reset the accumulated values.'''
+        values, self.values = self.values, {}
+        return {self.series(k): v for k, v in values.items()}
+
+
+class Counter(Metric):
+    type = 'counter'
+    def inc(self, *labels, value: float=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+
+class Gauge(Metric):
+    '''A per-worker value. Gauges are summed across workers and are not reset on collection.'''
+    type = 'gauge'
+    def inc(self, *labels, value: float=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def dec(self, *labels, value: float=1):
+        self.values[labels] = self.values.get(labels, 0) - value
+
+    def set(self, *labels, value: float):
+        self.values[labels] = value
+
+    def remove(self, *labels):
+        self.values.pop(labels, None)
+
+    def collect(self) -> dict[str, float]:
+        return {self.series(k): v for k, v in self.values.items()}
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    def __init__(self, name: str, description: str='', labels: tuple[str, ...]=(), buckets: tuple[float, ...]=TIME_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        h = self.values.get(labels)
+        if h is None:
+            h = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.]
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                break
+        else:
+            i = len(self.buckets)
+        h[i] += 1
+        h[-1] += value
+
+    def collect(self) -> dict[str, float]:
+        values, self.values = self.values, {}
+        out = {}
+        for k, h in values.items():
+            total = 0
+            for b, n in zip(self.buckets + ('+Inf',), h):
+                total += n
+                out[self.series(k, '_bucket', le=b)] = total
+            out[self.series(k, '_count')] = total
+            out[self.series(k, '_sum')] = h[-1]
+        return out
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Metrics                                   #
+# ---------------------------------------------------------------------------- #
+
+read_seconds = Histogram('read_seconds', 'Time spent reading entries from redis.', ('latest',))
+entries_read = Counter('entries_read_total', 'Entries read from redis.', ('stream',))
+add_seconds = Histogram('add_entries_seconds', 'Time spent writing a batch of entries to redis.')
+pipeline_size = Histogram('add_entries_pipeline_size', 'Number of entries written per pipeline.', buckets=SIZE_BUCKETS)
+entries_in = Counter('entries_in_total', 'Entries written to redis.', ('stream',))
+bytes_in = Counter('bytes_in_total', 'Payload bytes written to redis.', ('stream',))
+bytes_out = Counter('bytes_out_total', 'Payload bytes sent to clients.', ('stream', 'route'))
+websockets = Gauge('websockets', 'Open websocket connections.', ('route',))
+ws_send_seconds = Histogram('websocket_send_seconds', 'Time spent sending a message to a websocket.', ('route',))
+ws_receive_seconds = Histogram('websocket_receive_seconds', 'Time spent receiving a message from a websocket.', ('route',))
+http_requests = Counter('http_requests_total', 'HTTP data requests.', ('route',))
+http_seconds = Histogram('http_request_seconds', 'Time spent handling HTTP data requests.', ('route',))
+
+
+def count_bytes_out(offsets: list, route: str):
+    '''Count bytes sent per stream from a pack_entries offset list.'''
+    start = 0
+    for sid, _, end in offsets:
+        bytes_out.inc(sid, route, value=end - start)
+        start = end
+
+
+# ---------------------------------------------------------------------------- #
+#                                 Aggregation                                  #
+# ---------------------------------------------------------------------------- #
+
+async def flush(r):
+    '''Push this worker's metrics to redis.'''
+    counts: dict[str, float] = {}
+    gauges: dict[str, float] = {}
+    for m in registry.values():
+        (gauges if m.type == 'gauge' else counts).update(m.collect())
+    gauge_key = f'{METRICS_GAUGE_PREFIX}:{WORKER_ID}'
+    async with r.pipeline() as p:
+        for k, v in counts.items():
+            p.hincrbyfloat(METRICS_KEY, k, v)
+        p.delete(gauge_key)
+        if gauges:
+            p.hset(gauge_key, mapping=gauges)
+            p.expire(gauge_key, int(FLUSH_INTERVAL * 3) + 1)
+        await p.execute()
+
+
+async def flush_forever(r):
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            await flush(r)
+        except Exception as e:
+            print("Metrics flush failed:", e)
+
+
+_flusher: asyncio.Task|None = None
+
+def start(r):
+    global _flusher
+    if _flusher is None or _flusher.done():
+        _flusher = asyncio.create_task(flush_forever(r))
+    return _flusher
+
+
+async def collect(r) -> dict[str, float]:
+    '''Get the metrics summed across all workers.'''
+    await flush(r)
+    values = {k.decode('utf-8'): float(v) for k, v in (await r.hgetall(METRICS_KEY)).items()}
+    keys = [k async for k in r.scan_iter(match=f'{METRICS_GAUGE_PREFIX}:*', _type='hash')]
+    if keys:
+        async with r.pipeline() as p:
+            for k in keys:
+                p.hgetall(k)
+            for gauges in await p.execute():
+                for k, v in gauges.items():
+                    k = k.decode('utf-8')
+                    values[k] = values.get(k, 0) + float(v)
+    return values
+
+
+def render(values: dict[str, float]) -> str:
+    '''Format metrics in the prometheus text exposition format.'''
+    by_metric: dict[str, list[str]] = {}
+    for series in sorted(values, key=_sort_key):
+        name = series.split('{', 1)[0]
+        if name not in registry:
+            name = name.rsplit('_', 1)[0]
+        by_metric.setdefault(name, []).append(series)
+    lines = []
+    for name, series in by_metric.items():
+        m = registry.get(name)
+        if m is not None:
+            lines.append(f'# HELP {name} {m.description}')
+            lines.append(f'# TYPE {name} {m.type}')
+        for s in series:
+            v = values[s]
+            lines.append(f'{s} {int(v) if v.is_integer() else v}')
+    return '\n'.join(lines) + '\n'
+
+
+def _sort_key(series: str):
+    # sort histogram buckets numerically rather than alphabetically
+    name, _, labels = series.partition('{')
+    labels, _, le = labels.partition('le="')
+    le = le.rstrip('"}')
+    return name.rsplit('_', 1)[0], labels, name, float(le) if le else 0
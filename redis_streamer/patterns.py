@@ -0,0 +1,77 @@
+'''Pattern subscriptions.
+
+XREAD needs explicit stream keys, so glob patterns like ``*:camera`` are resolved
+against the stream registry. The read cursor also listens on the ``stream.created``
+event stream, so streams that appear later are added without the client reconnecting.
+Internal streams (``:``-prefixed, like the event streams) only match patterns that
+start with ``:`` themselves, so ``*`` means every data stream.
+'''
+from __future__ import annotations
+import fnmatch
+import orjson
+
+from redis_streamer import utils
+from redis_streamer.core import ctx, STREAM_CREATED_EVENT
+from redis_streamer.config import STREAM_REGISTRY_KEY
+
+
+def is_pattern(sid: str) -> bool:
+    return any(c in sid for c in '*?[')
+
+
+def matches(sid: str, patterns: list[str]) -> bool:
+    '''Does the stream match any of the patterns? Internal streams need a ``:`` pattern.'''
+    internal = sid.startswith(':')
+    return any(fnmatch.fnmatchcase(sid, p) for p in patterns if p.startswith(':') == internal)
+
+
+async def match_streams(patterns: list[str], scan: bool=False) -> set[str]:
+    '''Get the registered streams matching any of the patterns.
+    Use ``scan`` to also find streams written before the registry existed.'''
+    sids = {utils.maybe_decode(x) for x in await ctx.r.smembers(STREAM_REGISTRY_KEY)}
+    if scan:
+        for r in ctx.shards:
+            for pattern in patterns:
+                sids.update([utils.maybe_decode(x) async for x in r.scan_iter(match=pattern, _type='stream')])
+    return {s for s in sids if matches(s, patterns)}
+
+
+class PatternCursor:
+    '''Keeps a read cursor in sync with the streams matching a set of patterns.'''
+    def __init__(self, patterns: list[str], last_entry_id: str='$', latest: bool=False):
+        self.patterns = patterns
+        self.last_entry_id = last_entry_id
+        self.latest = latest
+        self.seen = '0-0'  # the last stream.created event we've handled
+
+    async def init(self, cursor: dict[str, str]) -> dict[str, str]:
+        '''Add all currently matching streams and start listening for new ones.'''
+        last = await ctx.r.xrevrange(STREAM_CREATED_EVENT, count=1)
+        self.seen = utils.maybe_decode(last[0][0]) if last else '0-0'
+        for sid in await match_streams(self.patterns, scan=True):
+            cursor.setdefault(sid, self.last_entry_id)
+        cursor[STREAM_CREATED_EVENT] = self.seen
+        return cursor
+
+    async def update(self, cursor: dict[str, str], results: list) -> list:
+        '''Remove stream creation events from the results, adding any new matching streams to the cursor.
+
+        New streams are read from the start, so nothing written before we noticed them is lost.
+        '''
+        events = [x for sid, xs in results if sid == STREAM_CREATED_EVENT for x in xs]
+        if not events:
+            return results
+        if self.latest:
+            # latest=True only gives us the newest event - fetch the ones it skipped over
+            events = [
+                (utils.maybe_decode(t), x)
+                for t, x in await ctx.r.xrange(STREAM_CREATED_EVENT, self.seen, events[-1][0])]
+        seen = utils.parse_entry_id(self.seen)
+        for t, x in events:
+            if utils.parse_entry_id(t) <= seen:
+                continue
+            sid = orjson.loads(x[b'd'])['stream_id']
+            if matches(sid, self.patterns):
+                cursor.setdefault(sid, '0-0')
+        self.seen = events[-1][0]
+        return [(sid, xs) for sid, xs in results if sid != STREAM_CREATED_EVENT]
@@ -0,0 +1,111 @@
+'''Device presence.
+
+Devices are considered connected as long as they keep sending heartbeats. A heartbeat
+is just the device's last-seen time in a sorted set, so it's written implicitly by any
+push traffic (throttled per worker). A background reaper removes devices that haven't
+been seen within the TTL and fires a ``device.connected`` event for them.
+'''
+from __future__ import annotations
+import os
+import time
+import asyncio
+import orjson
+
+from redis_streamer.core import ctx
+from redis_streamer.config import DEVICES_PRESENCE_KEY, DEVICES_SEEN_KEY, EVENT_PREFIX
+
+PRESENCE_TTL = float(os.getenv('DEVICE_PRESENCE_TTL') or 30)
+HEARTBEAT_INTERVAL = float(os.getenv('DEVICE_HEARTBEAT_INTERVAL') or 2)
+REAP_INTERVAL = float(os.getenv('DEVICE_REAP_INTERVAL') or 5)
+
+CONNECTED_EVENT = f'{EVENT_PREFIX}:device.connected'
+
+# pop all members older than the cutoff atomically, so only one worker reports each expiry
+REAP_SCRIPT = '''
+local xs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #xs > 0 then redis.call('ZREM', KEYS[1], unpack(xs)) end
+return xs
+'''
+
+_last_heartbeat: dict[str, float] = {}
+_reaper: asyncio.Task|None = None
+_background: set[asyncio.Task] = set()
+
+
+async def heartbeat(device_id: str, force: bool=False, background: bool=False) -> bool:
+    '''Mark a device as seen. Returns True if the device just (re)connected.
+
+    Writes are throttled to once every ``HEARTBEAT_INTERVAL`` seconds per device
+    so this can be called on every pushed message. With ``background``, the write
+    happens in a task and this returns False right away (for the write path when it
+    shouldn't wait for redis).
+    '''
+    now = time.time()
+    if not force and now - _last_heartbeat.get(device_id, 0) < HEARTBEAT_INTERVAL:
+        return False
+    _last_heartbeat[device_id] = now
+    if background:
+        task = asyncio.create_task(_write_quietly(device_id, now))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+        return False
+    return await _write(device_id, now)
+
+
+async def _write_quietly(device_id: str, now: float):
+    try:
+        await _write(device_id, now)
+    except Exception as e:
+        print(f"Heartbeat for {device_id} failed:", type(e).__name__, e)
+
+
+async def _write(device_id: str, now: float) -> bool:
+    async with ctx.r.pipeline() as p:
+        p.zadd(DEVICES_PRESENCE_KEY, {device_id: now})
+        p.sadd(DEVICES_SEEN_KEY, device_id)
+        is_new, _ = await p.execute()
+    if is_new:
+        await ctx.r.xadd(CONNECTED_EVENT, {b'd': orjson.dumps({ "device_id": device_id, "connected": True })})
+    return bool(is_new)
+
+
+def forget(device_id: str):
+    '''Clear the heartbeat throttle for a device (e.g. after it was disconnected).'''
+    _last_heartbeat.pop(device_id, None)
+
+
+async def get_connected_device_ids() -> list[str]:
+    return [
+        x.decode('utf-8') for x in
+        await ctx.r.zrangebyscore(DEVICES_PRESENCE_KEY, time.time() - PRESENCE_TTL, '+inf')
+    ]
+
+
+async def reap() -> list[str]:
+    '''Remove expired devices and fire disconnect events for them.'''
+    expired = await ctx.r.eval(REAP_SCRIPT, 1, DEVICES_PRESENCE_KEY, time.time() - PRESENCE_TTL)
+    if not expired:
+        return []
+    expired = [x.decode('utf-8') for x in expired]
+    async with ctx.r.pipeline() as p:
+        for device_id in expired:
+            forget(device_id)
+            p.xadd(CONNECTED_EVENT, {b'd': orjson.dumps({ "device_id": device_id, "connected": False, "reason": "expired" })})
+        await p.execute()
+    return expired
+
+
+async def reap_forever():
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+        try:
+            await reap()
+        except Exception as e:
+            print("Device reaper failed:", e)
+
+
+def start():
+    global _reaper
+    if _reaper is None or _reaper.done():
+        _reaper = asyncio.create_task(reap_forever())
+    return _reaper
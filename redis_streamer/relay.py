@@ -0,0 +1,198 @@
+'''In-process relay for low-latency streams.
+
+Frames pushed to ``/direct/{stream_id}/push`` are handed straight to the subscriber
+queues of ``/direct/{stream_id}/pull`` sockets on the same worker, so redis isn't on the
+latency-critical path. Entry IDs are generated locally (monotonic per stream, in the
+same ``ms-seq`` format redis uses), and a background task writes the frames to the
+redis stream in batches every ``DIRECT_PERSIST_INTERVAL`` seconds, so late joiners,
+history queries and consumers on other workers still see them.
+
+If something else writes to the stream with a newer ID in the meantime, the frames that
+no longer fit are persisted with IDs picked by redis, so in that case the IDs in history
+differ from the ones live subscribers got.
+
+While redis is down, the frames waiting to be persisted are kept in memory, up to
+``DIRECT_MAX_PENDING_BYTES`` per stream. Past that, producers wait (as they would
+without the relay) until redis catches up.
+
+Each subscriber has a queue of ``DIRECT_QUEUE_SIZE`` batches. When a ``latest``
+subscriber falls that far behind, its oldest batch is dropped. Other subscribers get
+``BEHIND`` instead and are disconnected, since skipping frames would break delta-coded
+streams.
+'''
+from __future__ import annotations
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+
+from redis_streamer import utils
+from redis_streamer.core import ctx, Agent
+from redis_streamer.indexing import after_write
+
+DIRECT_PERSIST_INTERVAL = float(os.getenv('DIRECT_PERSIST_INTERVAL') or 0.05)
+DIRECT_PERSIST_BATCH = int(os.getenv('DIRECT_PERSIST_BATCH') or 256)
+DIRECT_QUEUE_SIZE = int(os.getenv('DIRECT_QUEUE_SIZE') or 64)
+DIRECT_MAX_PENDING_BYTES = int(os.getenv('DIRECT_MAX_PENDING_BYTES') or 256 * 1024 * 1024)
+BEHIND = None  # put in the queue of a subscriber that fell too far behind
+
+
+class Relay:
+    '''Forwards one stream's entries to local subscribers and persists them in the background.'''
+    def __init__(self, sid: str):
+        self.sid = sid
+        self.queues: dict[asyncio.Queue, bool] = {}  # {queue: latest}
+        self.pending: list[tuple[str, dict]] = []
+        self.pending_bytes = 0
+        self.producers = 0
+        self.last_id = (0, 0)
+        self.task: asyncio.Task|None = None
+        self._flush = asyncio.Event()
+        self._persisted = asyncio.Event()
+        self._synced = False
+
+    # --------------------------------- Producing -------------------------------- #
+
+    async def sync_id(self):
+        '''Make sure our IDs come after whatever is already in the stream.'''
+        last = await ctx.shard(self.sid).xrevrange(self.sid, count=1)
+        if last:
+            self.last_id = max(self.last_id, utils.parse_entry_id(last[0][0]))
+        self._synced = True
+
+    def next_id(self) -> str:
+        ms = int(time.time() * 1000)
+        last_ms, seq = self.last_id
+        self.last_id = (ms, 0) if ms > last_ms else (last_ms, seq + 1)
+        return '{}-{}'.format(*self.last_id)
+
+    def publish(self, entries: list[bytes]) -> list[str]:
+        '''Send entries to subscribers and queue them to be persisted. Returns their IDs.'''
+        xs = [(self.next_id(), {b'd': d}) for d in entries]
+        self.pending.extend(xs)
+        self.pending_bytes += sum(len(d) for d in entries)
+        broadcast(self.queues, [(self.sid, xs)])
+        if len(self.pending) >= DIRECT_PERSIST_BATCH:
+            self._flush.set()
+        return [t for t, _ in xs]
+
+    async def wait_for_room(self):
+        '''Wait while more than ``DIRECT_MAX_PENDING_BYTES`` are waiting to be persisted.'''
+        while self.pending_bytes > DIRECT_MAX_PENDING_BYTES:
+            self._flush.set()
+            self._persisted.clear()
+            await self._persisted.wait()
+
+    @asynccontextmanager
+    async def produce(self):
+        if not self._synced:
+            await self.sync_id()
+        self.producers += 1
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._persist_forever())
+        try:
+            yield self
+        finally:
+            self.producers -= 1
+            self._flush.set()
+
+    # ------------------------------- Persistence ------------------------------- #
+
+    def _put_back(self, xs: list):
+        self.pending[:0] = xs  # in order, for the next attempt
+        self.pending_bytes += sum(len(x[b'd']) for _, x in xs)
+
+    async def persist(self):
+        xs, self.pending = self.pending, []
+        self.pending_bytes = 0
+        if not xs:
+            return
+        try:
+            await self._persist(xs)
+        finally:
+            self._persisted.set()
+
+    async def _persist(self, xs: list):
+        agent = Agent()
+        try:
+            result = await agent.add_entries([(self.sid, t, x[b'd']) for t, x in xs], raise_on_error=False)
+        except Exception:
+            self._put_back(xs)
+            raise
+        await after_write([self.sid] * len(xs), result, [x[b'd'] for _, x in xs])
+        failed = [x for x, r in zip(xs, result) if isinstance(r, Exception)]
+        if failed:
+            # someone else wrote to the stream with a newer ID - let redis pick the IDs.
+            # NOTE: these are stored under different IDs than the ones subscribers saw.
+            print(f"Relay {self.sid}: {len(failed)} entries were out of order, persisting with new IDs.")
+            try:
+                ids = await agent.add_entries([(self.sid, '*', x[b'd']) for _, x in failed])
+            except Exception:
+                self._put_back(failed)
+                raise
+            await after_write([self.sid] * len(failed), ids, [x[b'd'] for _, x in failed])
+            await self.sync_id()
+
+    async def _persist_forever(self):
+        try:
+            while self.producers or self.pending:
+                try:
+                    await asyncio.wait_for(self._flush.wait(), DIRECT_PERSIST_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush.clear()
+                try:
+                    await self.persist()
+                except Exception as e:
+                    print(f"Relay {self.sid}: persisting failed:", e)
+                    await asyncio.sleep(DIRECT_PERSIST_INTERVAL)
+        finally:
+            release(self)
+
+    # -------------------------------- Consuming -------------------------------- #
+
+    @asynccontextmanager
+    async def subscribe(self, q: asyncio.Queue|None=None, latest: bool=False):
+        '''Get a queue of batches (pass one to share it between streams). It starts with the
+        entries that haven't been persisted yet, so together with a read from redis nothing is missed.
+        With ``latest``, batches may be dropped if the subscriber falls behind, otherwise it gets ``BEHIND``.'''
+        q = q or asyncio.Queue(DIRECT_QUEUE_SIZE)
+        if self.pending:
+            broadcast({q: latest}, [(self.sid, list(self.pending))])
+        self.queues[q] = latest
+        try:
+            yield q
+        finally:
+            self.queues.pop(q, None)
+            release(self)
+
+
+def broadcast(queues: dict[asyncio.Queue, bool], item):
+    for q, latest in queues.items():
+        if q.full():
+            if not latest:  # slow subscriber that needs every entry - tell them to go
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait(BEHIND)
+                continue
+            q.get_nowait()  # they only want the newest, so drop their oldest batch
+        q.put_nowait(item)
+
+
+relays: dict[str, Relay] = {}
+
+def get_relay(sid: str) -> Relay:
+    r = relays.get(sid)
+    if r is None:
+        r = relays[sid] = Relay(sid)
+    return r
+
+def release(relay: Relay):
+    '''Forget a relay once nobody is using it.'''
+    if not relay.queues and not relay.producers and not relay.pending and relays.get(relay.sid) is relay:
+        del relays[relay.sid]
+
+
+async def flush_all():
+    '''Persist everything that's pending (e.g. on shutdown).'''
+    await asyncio.gather(*(r.persist() for r in list(relays.values())))
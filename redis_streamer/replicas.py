@@ -0,0 +1,73 @@
+'''Read replica health.
+
+Set ``REDIS_REPLICA_URLS`` to send pull, GET, subscription and query reads to replicas
+(shards separated by ``;``, replicas of a shard by ``,``). Each replica is checked every
+``REPLICA_CHECK_INTERVAL`` seconds using ``INFO replication``, and is only read from while
+its link to the primary is up and it's less than ``REPLICA_MAX_LAG_BYTES`` behind.
+Otherwise (or if a read fails) reads go to the primary.
+
+Replicas can be a little behind, so pass ``consistency=primary`` to read your own writes.
+'''
+from __future__ import annotations
+import os
+import asyncio
+from redis import asyncio as aioredis
+
+from redis_streamer import metrics
+from redis_streamer.core import ctx
+
+REPLICA_CHECK_INTERVAL = float(os.getenv('REPLICA_CHECK_INTERVAL') or 1)
+REPLICA_MAX_LAG_BYTES = int(os.getenv('REPLICA_MAX_LAG_BYTES') or 1_000_000)
+REPLICA_MAX_IO_SECONDS = int(os.getenv('REPLICA_MAX_IO_SECONDS') or 10)
+
+replica_healthy = metrics.Gauge('replica_healthy', 'Whether a read replica is being used (1) or skipped (0).', ('replica',))
+replica_lag = metrics.Gauge('replica_lag_bytes', 'How far a read replica is behind its primary.', ('replica',))
+
+
+def replica_name(r: aioredis.Redis) -> str:
+    kw = r.connection_pool.connection_kwargs
+    return f'{kw.get("host", "")}:{kw.get("port", "")}'
+
+
+async def check(primary: aioredis.Redis, replica: aioredis.Redis) -> bool:
+    '''Is the replica connected to its primary and caught up?'''
+    name = replica_name(replica)
+    try:
+        p, r = await asyncio.gather(primary.info('replication'), replica.info('replication'))
+    except aioredis.RedisError:
+        ok = False
+    else:
+        lag = p.get('master_repl_offset', 0) - r.get('slave_repl_offset', 0)
+        replica_lag.set(name, value=lag)
+        ok = (
+            r.get('role') == 'slave' and
+            r.get('master_link_status') == 'up' and
+            r.get('master_last_io_seconds_ago', 0) <= REPLICA_MAX_IO_SECONDS and
+            lag <= REPLICA_MAX_LAG_BYTES)
+    replica_healthy.set(name, value=int(ok))
+    return ok
+
+
+async def check_all():
+    pairs = [(p, r) for p, rs in ctx.replicas.items() for r in rs]
+    results = await asyncio.gather(*(check(p, r) for p, r in pairs))
+    for (_, r), ok in zip(pairs, results):
+        (ctx.healthy_replicas.add if ok else ctx.healthy_replicas.discard)(r)
+
+
+async def monitor_forever():
+    while True:
+        try:
+            await check_all()
+        except Exception as e:
+            print("Replica check failed:", e)
+        await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+
+_monitor: asyncio.Task|None = None
+
+def start():
+    global _monitor
+    if ctx.replicas and (_monitor is None or _monitor.done()):
+        _monitor = asyncio.create_task(monitor_forever())
+    return _monitor
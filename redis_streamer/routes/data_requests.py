@@ -1,9 +1,14 @@
+import time
 import asyncio
 import io
 import orjson
-from fastapi import APIRouter, Query, Path, File, UploadFile
+from fastapi import APIRouter, HTTPException, Query, Path, File, UploadFile
 from fastapi.responses import StreamingResponse
-from redis_streamer import Agent, utils
+from redis_streamer import Agent, utils, presence, metrics
+from redis_streamer.join import Joiner
+from redis_streamer.jsonfilter import JsonFilter
+from redis_streamer import decimate, aggregate, keyframes, export, tensors, jsonindex, wal
+from redis_streamer.core import Consistency
 from redis_streamer.config import DEFAULT_DEVICE, ENABLE_MULTI_DEVICE_PREFIXING
 
 app = APIRouter()
@@ -14,6 +19,7 @@ async def send_data_entries(
         entries: list[UploadFile] = File(..., description='A list of data entries (as multiform files) to be added into the stream(s).'),
         device_id: str=Query(DEFAULT_DEVICE, description='You should give devices names if you want to manage multiple devices.'),
         prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
+        keyframe: bool=Query(False, description='Mark the entries as keyframes, so readers can start from them with last_entry_id=last_keyframe.'),
 ):
     """Send data into one or multiple streams using multipart/form-data,
     each part represent a separate entry of a stream. Set
@@ -22,23 +28,166 @@ async def send_data_entries(
     stream ids.
 
     """
+    t0 = time.perf_counter()
     sids = [x.filename.split('/') for x in entries] if sid == '*' else [sid] * len(entries)
     if ENABLE_MULTI_DEVICE_PREFIXING:
         prefix = f'{device_id or DEFAULT_DEVICE}:{prefix}'
     sids = [f'{prefix}{s}' for s in sids]
     data = await asyncio.gather(*(x.read() for x in entries))
-    return await Agent().add_entries(zip(sids, [None]*len(sids), data))
+    try:
+        await tensors.validate(zip(sids, data), stale=wal.enabled())
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    result = await wal.add_entries(
+        Agent(), sids, [None]*len(sids), data, [{'keyframe': True}] * len(sids) if keyframe else None)
+    if ENABLE_MULTI_DEVICE_PREFIXING:
+        await presence.heartbeat(device_id or DEFAULT_DEVICE, background=wal.enabled())
+    metrics.http_requests.inc('post')
+    metrics.http_seconds.observe(time.perf_counter() - t0, 'post')
+    return result
+
+
+@app.get('/{stream_id}/aggregate', summary='Aggregate numeric fields of a JSON stream by time bucket')
+async def aggregate_entries(
+        stream_id: str = Path(..., description='The unique ID of the stream'),
+        fields: list[str] = Query(..., description='Dotted paths to numeric fields, e.g. pose.position.0. Can be given multiple times.'),
+        bucket: float = Query(..., description='The bucket width in milliseconds.'),
+        start: str|None = Query(None, description='The start of the window, as an entry ID or millisecond time. Defaults to the first entry.'),
+        end: str|None = Query(None, description='The end of the window, as an entry ID or millisecond time. Defaults to the last entry.'),
+        device_id: str=Query(DEFAULT_DEVICE, description='You should give devices names if you want to manage multiple devices.'),
+        prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
+        consistency: Consistency|None=Query(None, description='Read from a replica ("replica") or from the primary ("primary") if you need to read your own writes. Defaults to REDIS_READ_CONSISTENCY.'),
+):
+    """Compute count, min, max, mean and last of each field for every
+    **bucket** millisecond window that has entries. Returns
+    `{"buckets": [bucket start, ...], "fields": {field: {stat: [value, ...]}}}`.
+    Missing and non-numeric values are skipped (a bucket with none has a
+    count of 0 and null stats).
+
+    """
+    t0 = time.perf_counter()
+    if ENABLE_MULTI_DEVICE_PREFIXING:
+        prefix = f'{device_id or DEFAULT_DEVICE}:{prefix}'
+    try:
+        result = await aggregate.aggregate(f'{prefix}{stream_id}', fields, bucket, start, end, consistency=consistency)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    metrics.http_requests.inc('aggregate')
+    metrics.http_seconds.observe(time.perf_counter() - t0, 'aggregate')
+    return result
+
+
+@app.get('/{stream_id}/export', summary='Export a range of a stream as a columnar file (Arrow IPC or NPZ)', response_class=StreamingResponse)
+async def export_entries(
+        stream_id: str = Path(..., description='The unique ID of the stream'),
+        format: str = Query('arrow', description='"arrow" (an Arrow IPC stream, needs pyarrow on the server) or "npz" (numpy).'),
+        start: str|None = Query(None, description='The start of the range, as an entry ID or millisecond time. Defaults to the first entry.'),
+        end: str|None = Query(None, description='The end of the range (inclusive), as an entry ID or millisecond time. Defaults to the last entry.'),
+        fields: list[str]|None = Query(None, description='JSON fields to add as columns (dotted paths). Float64 by default, add ":str" for strings, e.g. label:str. Can be given multiple times.'),
+        meta: list[str]|None = Query(None, description='Entry fields (besides the payload) to add as string columns. Can be given multiple times.'),
+        payload: bool = Query(True, description='Include the payload as a binary "data" column.'),
+        count: int|None = Query(None, description='The maximum number of entries to export.'),
+        hz: float|None=Query(None, description='Decimate to this rate: only the first entry in each 1/hz second bucket is exported.'),
+        bucket: float|None=Query(None, description='Decimate by bucket width (in milliseconds) instead of rate.'),
+        device_id: str=Query(DEFAULT_DEVICE, description='You should give devices names if you want to manage multiple devices.'),
+        prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
+        consistency: Consistency|None=Query(None, description='Read from a replica ("replica") or from the primary ("primary") if you need to read your own writes. Defaults to REDIS_READ_CONSISTENCY.'),
+):
+    """Export the entries from **start** to **end** with one column
+    per attribute: `ms` and `seq` (the entry ID), `data` (the
+    payload), and any JSON **fields** and entry **meta** fields.
+
+    Arrow is sent one record batch per page as the range is read, so
+    it can be loaded with `pyarrow.ipc.open_stream`. In NPZ, payloads
+    are concatenated into a uint8 `data` array, with the end offset of
+    each one in `data_offsets`.
+
+    """
+    t0 = time.perf_counter()
+    if ENABLE_MULTI_DEVICE_PREFIXING:
+        prefix = f'{device_id or DEFAULT_DEVICE}:{prefix}'
+    try:
+        width = decimate.bucket_width(hz, bucket)
+        body = export.export(
+            f'{prefix}{stream_id}', format, fields=fields, meta=meta, payload=payload,
+            start=start, end=end, width=width, count=count, consistency=consistency)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    metrics.http_requests.inc('export')
+
+    async def stream():
+        n = 0
+        async for chunk in body:
+            n += len(chunk)
+            yield chunk
+        metrics.bytes_out.inc(stream_id, 'export', value=n)
+        metrics.http_seconds.observe(time.perf_counter() - t0, 'export')
+
+    media_type, ext = export.FORMATS[format]
+    return StreamingResponse(
+        stream(), media_type=media_type,
+        headers={'content-disposition': f'attachment; filename="{stream_id}.{ext}"'})
+
+
+@app.get('/{stream_id}/search', summary='Find the entries of a JSON stream by indexed field values', response_class=StreamingResponse)
+async def search_entries(
+        stream_id: str = Path(..., description='The unique ID of the stream'),
+        where: list[str] = Query(..., description='Filters that entries must all match, e.g. "label == car" or \'track_id in [3, 7]\'. At least one must be an == or in filter on an indexed field.'),
+        start: str|None = Query(None, description='The start of the window, as an entry ID or millisecond time. Defaults to the first entry.'),
+        end: str|None = Query(None, description='The end of the window (inclusive), as an entry ID or millisecond time. Defaults to the last entry.'),
+        count: int = Query(100, description='The maximum number of entries to return.'),
+        latest: bool = Query(False, description='Return the last matching entries instead of the first ones.'),
+        fields: list[str]|None = Query(None, description='Only return these fields of the entries (dotted paths, e.g. box.0). Can be given multiple times.'),
+        device_id: str=Query(DEFAULT_DEVICE, description='You should give devices names if you want to manage multiple devices.'),
+        prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
+        consistency: Consistency|None=Query(None, description='Read from a replica ("replica") or from the primary ("primary") if you need to read your own writes. Defaults to REDIS_READ_CONSISTENCY.'),
+):
+    """Find entries using the stream's JSON field index (the `index`
+    list in its meta). Only the matching entries are read, so this is
+    fast however long the window is. Entries written before a field
+    was indexed aren't found.
+
+    The response is formatted like a GET, oldest entry first.
+
+    """
+    t0 = time.perf_counter()
+    if ENABLE_MULTI_DEVICE_PREFIXING:
+        prefix = f'{device_id or DEFAULT_DEVICE}:{prefix}'
+    try:
+        entries = await jsonindex.search(
+            f'{prefix}{stream_id}', where, start=start, end=end, count=count, latest=latest,
+            fields=fields, consistency=consistency)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    entries = [(stream_id, xs) for _, xs in entries]
+
+    offsets, content = utils.pack_entries(entries)
+    metrics.count_bytes_out(offsets, 'search')
+    metrics.http_requests.inc('search')
+    metrics.http_seconds.observe(time.perf_counter() - t0, 'search')
+    return StreamingResponse(
+        io.BytesIO(content),
+        headers={'x-offsets': orjson.dumps(offsets).decode('utf-8')},
+        media_type='application/octet-stream')
 
 
 @app.get('/{stream_id}', summary='Retrieve data from one or multiple streams', response_class=StreamingResponse)
 async def get_data_entries(
         stream_id: str = Path(..., description='The unique ID of the stream'),
-        last_entry_id: str=Query('-', description="Start retrieving entries later than the provided ID"),
+        last_entry_id: str=Query('-', description="Start retrieving entries later than the provided ID. Use last_keyframe to start from the most recent keyframe."),
         latest: bool=Query(False, description="Should we return the latest available frame?"),
         count: int=Query(1, description="the maximum number of entries for each receive"),
         block: int=Query(500, description="Should it block if no data is available?"),
         device_id: str=Query(DEFAULT_DEVICE, description='You should give devices names if you want to manage multiple devices.'),
         prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
+        consistency: Consistency|None=Query(None, description='Read from a replica ("replica") or from the primary ("primary") if you need to read your own writes. Defaults to REDIS_READ_CONSISTENCY.'),
+        join: str|None=Query(None, description='Align the streams by timestamp, using the first stream as the reference: "nearest" or "asof" (the latest entry at or before it).'),
+        tolerance: float=Query(50, description='How far apart (in milliseconds) joined entries can be.'),
+        hz: float|None=Query(None, description='Decimate to this rate: only the first entry in each 1/hz second bucket is read.'),
+        bucket: float|None=Query(None, description='Decimate by bucket width (in milliseconds) instead of rate.'),
+        fields: list[str]|None=Query(None, description='Only return these fields of JSON entries (dotted paths, e.g. box.0). Can be given multiple times.'),
+        where: list[str]|None=Query(None, description='Only return JSON entries that match all of these filters, e.g. "confidence > 0.5" or \'label in ["car"]\'.'),
+        stack: bool=Query(False, description='For tensor streams (with dtype and shape in their meta): return the entries as one array, described by the x-dtype and x-shape headers.'),
     ):
     """This retrieves **count** elements that have later timestamps
     than **last_entry_id** from the specified data stream. The entry
@@ -50,7 +199,8 @@ async def get_data_entries(
     documentation](https://redis.io/docs/manual/data-types/streams/#entry-ids). Special
     IDs such as `0` and `$` are also accepted. In addition, if
     **last_entry_id** is a `*`, the latest **count** entries will be
-    returned.
+    returned. Use `last_keyframe` to start from the most recent
+    keyframe (see **keyframe** when sending data).
 
     If successful, the response header will include an `entry-offset`
     field describing the offsets of the batch
@@ -65,23 +215,76 @@ async def get_data_entries(
     the similar `+` separator (e.g. **last_entry_id**=`$+$`), or for
     the all streams (e.g. just `$`).
 
+    With **hz** or **bucket**, only the first entry in each time bucket
+    is returned, e.g. `hz=1` with `count=60` for a minute of a 30 Hz
+    stream at 1 Hz. The returned **x-last-entry-id** is the end of the
+    last bucket.
+
+    With **fields** and **where**, JSON entries are filtered and
+    projected (to flat objects keyed by path) before joining. Filtered
+    out entries still move **x-last-entry-id**.
+
+    With **stack**, the streams must declare the same dtype and shape
+    in their meta, and the content is the buffer of the stacked array.
+    Its dtype and shape (`[n, *shape]`) are in the **x-dtype** and
+    **x-shape** headers.
+
+    With **join**, the response contains aligned tuples: one entry from
+    each stream, in the order of **stream_id**, within **tolerance**
+    milliseconds of the first stream's entry. Only entries in this
+    response are matched, so use a **count** that covers the slowest
+    stream.
+
     """
+    t0 = time.perf_counter()
     agent = Agent()
     
     if ENABLE_MULTI_DEVICE_PREFIXING:
         prefix = f'{device_id or DEFAULT_DEVICE}:{prefix}'
     
-    cursor = agent.init_cursor({f'{prefix}{stream_id}': last_entry_id})
-    entries, cursor = await agent.read(cursor, latest=latest, count=count, block=block)
+    stream_ids = stream_id.split('+')
+    last_entry_ids = last_entry_id.split('+')
+    if len(last_entry_ids) == 1:
+        last_entry_ids = last_entry_ids * len(stream_ids)
+    if len(last_entry_ids) != len(stream_ids):
+        raise HTTPException(422, "Give one last_entry_id, or one for each stream.")
+    sids = [f'{prefix}{s}' for s in stream_ids]
+    try:
+        joiner = Joiner(sids, join, tolerance) if join else None
+        width = decimate.bucket_width(hz, bucket)
+        jsonfilter = JsonFilter(fields, where)
+        spec = await tensors.stack_spec(sids) if stack else None
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+
+    cursor = agent.init_cursor(await keyframes.resolve_cursor(dict(zip(sids, last_entry_ids)), consistency))
+    if width:
+        entries, cursor = await decimate.read(agent, cursor, width, count=count, block=block, consistency=consistency)
+    else:
+        entries, cursor = await agent.read(cursor, latest=latest, count=count, block=block, consistency=consistency)
+    if jsonfilter:
+        entries = jsonfilter.apply(entries)
+    if joiner is not None:
+        entries = joiner.add(entries, flush=True)
+    if spec is not None:
+        entries = tensors.fitting(entries, spec)
     
     if ENABLE_MULTI_DEVICE_PREFIXING:
         entries = [(s[len(prefix):] if s.startswith(prefix) else s, xs) for s, xs in entries]
     
     offsets, content = utils.pack_entries(entries)
+    metrics.count_bytes_out(offsets, 'get')
+    metrics.http_requests.inc('get')
+    metrics.http_seconds.observe(time.perf_counter() - t0, 'get')
+    headers = {
+        'x-offsets': orjson.dumps(offsets).decode('utf-8'), 
+        'x-last-entry-id': '+'.join(cursor[s] for s in sids),
+    }
+    if spec is not None:
+        header = tensors.stack_header(spec, offsets)
+        headers['x-dtype'] = header['dtype']
+        headers['x-shape'] = orjson.dumps(header['shape']).decode('utf-8')
     return StreamingResponse(
         io.BytesIO(content),
-        headers={
-            'x-offsets': orjson.dumps(offsets).decode('utf-8'), 
-            'x-last-entry-id': cursor[f'{prefix}{stream_id}'],
-        },
+        headers=headers,
         media_type='application/octet-stream')
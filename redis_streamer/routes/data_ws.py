@@ -27,8 +27,14 @@ import orjson
 from fastapi import APIRouter, Path, Query, WebSocket, WebSocketDisconnect
 from websockets.exceptions import ConnectionClosed
 
-from .. import utils
-from ..core import ctx, Agent
+from .. import utils, presence, metrics, tracing
+from ..lag import Consumer
+from ..patterns import PatternCursor, is_pattern
+from ..core import ctx, Agent, Consistency
+from ..groups import GroupBuffer, check_group
+from ..join import Joiner
+from .. import decimate, keyframes, tensors, wal
+from ..jsonfilter import JsonFilter
 from redis_streamer.config import DEFAULT_DEVICE, ENABLE_MULTI_DEVICE_PREFIXING
 
 app = APIRouter()
@@ -42,7 +48,7 @@ app = APIRouter()
 async def pull_stream_data_ws(
         ws: WebSocket,
         stream_id: str = Path(..., description='The unique ID of the stream'),
-        last_entry_id: str=Query('$', description="Start retrieving entries later than the provided ID"),
+        last_entry_id: str=Query('$', description="Start retrieving entries later than the provided ID. Use last_keyframe to start from the most recent keyframe."),
         block: int|None=Query(5000, description="How long to block, in milliseconds"),
         latest: bool=Query(False, description='Should we allow frame skipping? Ok for some data (e.g. jpeg), not for others (e.g. mp4). Can use with max_fps or ack to reduce frame rate.'),
         max_fps: float=Query(0, description='Should we limit the frame rate that data is sent? Useful in cases with latest=True.'),
@@ -52,6 +58,15 @@ async def pull_stream_data_ws(
         prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
         count: int=Query(1, description='Accept multiple messages.'),
         header: bool=Query(True, description='Should the server send a JSON header before each payload? It contains a list of stream_id, timestamp, byte offset tuples.'),
+        consistency: Consistency|None=Query(None, description='Read from a replica ("replica") or from the primary ("primary") if you need to read your own writes. Defaults to REDIS_READ_CONSISTENCY.'),
+        complete: bool=Query(False, description='Only send frame groups (see push with group=true) once all of their entries have arrived.'),
+        join: str|None=Query(None, description='Align the streams by timestamp, using the first stream as the reference: "nearest" or "asof" (the latest entry at or before it).'),
+        tolerance: float=Query(50, description='How far apart (in milliseconds) joined entries can be.'),
+        hz: float|None=Query(None, description='Decimate to this rate: only the first entry in each 1/hz second bucket is read.'),
+        bucket: float|None=Query(None, description='Decimate by bucket width (in milliseconds) instead of rate.'),
+        fields: list[str]|None=Query(None, description='Only send these fields of JSON entries (dotted paths, e.g. box.0). Can be given multiple times.'),
+        where: list[str]|None=Query(None, description='Only send JSON entries that match all of these filters, e.g. "confidence > 0.5" or \'label in ["car"]\'.'),
+        stack: bool=Query(False, description='For tensor streams (with dtype and shape in their meta): send each batch as one array, with a {dtype, shape, offsets} header.'),
 ):
     '''Pull data.
     
@@ -63,6 +78,28 @@ async def pull_stream_data_ws(
             i.e. (data[previous_end_index:end_index])
     else:
         - client receives data bytes. This will contain a single message.
+
+    For streams that can't skip frames (e.g. mp4), ``last_entry_id=last_keyframe``
+    starts from the most recent keyframe (see push), so the first frame sent can be
+    decoded. Streams without a keyframe start from new entries.
+
+    Stream and device IDs can be glob patterns (e.g. ``device_id=*`` and ``stream_id=camera``).
+    Matching streams that are created after you connect are added automatically.
+
+    With ``hz`` or ``bucket``, only the first entry in each time bucket is sent (e.g. ``hz=1``
+    for a 1 Hz view of a 30 Hz stream). Unlike ``max_fps``, the skipped entries aren't
+    read from redis at all.
+
+    With ``fields`` and ``where``, JSON entries are filtered and projected before they
+    are sent (and before grouping and joining). Projected entries are flat objects
+    keyed by path.
+
+    With ``stack``, the streams must declare the same dtype and shape in their meta. The
+    header is ``{"dtype", "shape": [n, *shape], "offsets"}`` and the payload is the buffer
+    of the stacked array, so ``np.frombuffer(data, dtype).reshape(shape)`` gives the batch.
+
+    With ``join``, each message contains aligned tuples: one entry from each stream, in the
+    order of ``stream_id``, within ``tolerance`` milliseconds of the first stream's entry.
     '''
     await ws.accept()
     agent = Agent(ws)
@@ -77,21 +114,68 @@ async def pull_stream_data_ws(
     stream_ids = stream_id.split('+')
     assert header or not (count > 1 and len(stream_ids) > 1), "You must enable the header to stream multiple stream IDs or messages."
 
+    metrics.websockets.inc('pull')
+    consumer = Consumer('pull', stream=stream_id, device=device_id)
     try:
         t0 = time.time()
-        cursor = agent.init_cursor({f'{prefix}{s}': last_entry_id for s in stream_ids})
+        cursor = {f'{prefix}{s}': last_entry_id for s in stream_ids}
+        # resolve wildcard streams
+        patterns = [s for s in cursor if is_pattern(s)]
+        watcher = PatternCursor(patterns, last_entry_id, latest=latest) if patterns else None
+        if watcher:
+            cursor = await watcher.init({s: t for s, t in cursor.items() if s not in patterns})
+        cursor = agent.init_cursor(await keyframes.resolve_cursor(cursor, consistency))
+        groups = GroupBuffer(cursor) if complete else None
+        # check the query (as a 422 would on HTTP)
+        try:
+            if join and watcher:
+                raise ValueError("Stream patterns can't be joined.")
+            joiner = Joiner(list(cursor), join, tolerance) if join else None
+            width = decimate.bucket_width(hz, bucket)
+            jsonfilter = JsonFilter(fields, where)
+            if stack and watcher:
+                raise ValueError("Stream patterns can't be stacked.")
+            spec = await tensors.stack_spec(cursor) if stack else None
+        except ValueError as e:
+            await ws.close(1008, str(e)[:120])
+            return
         while True:
-            # read data from redis
-            results, cursor = await agent.read(cursor, latest=latest, count=count or 1, block=block)
-            # strip device ID from stream IDs
-            if not keep_device_id_in_stream_id:
-                results = [(s[len(prefix):] if s.startswith(prefix) else s, xs) for s, xs in results]
-
-            # prepare and send back data
-            offsets, entries = utils.pack_entries(results)
-            if header:
-                await ws.send_json(offsets)
-            await ws.send_bytes(entries)
+            with tracing.trace('pull', stream=stream_id, device=device_id):
+                # read data from redis
+                with tracing.span('read'):
+                    if width:
+                        results, cursor = await decimate.read(agent, cursor, width, count=count or 1, block=block, consistency=consistency)
+                    else:
+                        results, cursor = await agent.read(cursor, latest=latest, count=count or 1, block=block, consistency=consistency)
+                if watcher:
+                    results = await watcher.update(cursor, results)
+                if jsonfilter:
+                    results = jsonfilter.apply(results)
+                if groups is not None:
+                    groups.sids = set(cursor)
+                    results = groups.add(results)
+                if joiner is not None:
+                    results = joiner.add(results)
+                if spec is not None:
+                    results = tensors.fitting(results, spec)
+                raw_results = results
+                # strip device ID from stream IDs
+                if not keep_device_id_in_stream_id:
+                    results = [(s[len(prefix):] if s.startswith(prefix) else s, xs) for s, xs in results]
+
+                # prepare and send back data
+                with tracing.span('pack_entries'):
+                    offsets, entries = utils.pack_entries(results)
+                t_send = time.perf_counter()
+                if header:
+                    with tracing.span('send_json'):
+                        await ws.send_json(tensors.stack_header(spec, offsets) if spec is not None else offsets)
+                with tracing.span('send_bytes'):
+                    await ws.send_bytes(entries)
+                metrics.ws_send_seconds.observe(time.perf_counter() - t_send, 'pull')
+                metrics.count_bytes_out(offsets, 'pull')
+                consumer.delivered(raw_results)
+                await consumer.check_lag(cursor)
 
             # rate limiting
             if max_fps:
@@ -103,6 +187,9 @@ async def pull_stream_data_ws(
                 await ws.receive_text()
     except (WebSocketDisconnect, ConnectionClosed):
         pass
+    finally:
+        metrics.websockets.dec('pull')
+        await consumer.close()
 
 
 @app.websocket('/{stream_id}/push')
@@ -114,6 +201,7 @@ async def push_stream_data_ws(
         device_id: str=Query(DEFAULT_DEVICE, description='You should give devices names if you want to manage multiple devices.'),
         prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
         header: bool=Query(True, description='Should the server expect a JSON header before each payload? It should contain a list of stream_id, timestamp, byte offset tuples.'),
+        group: bool=Query(False, description='Write each message as a frame group: atomically, with one shared entry ID for all of its streams. Timestamps are ignored.'),
 ):
     '''Push data.
     
@@ -125,8 +213,18 @@ async def push_stream_data_ws(
             i.e. (data[previous_end_index:end_index])
     else:
         - client sends data bytes. This expects a single message.
-        
-    
+
+    Entries of tensor streams (with dtype and shape in their meta) must be one array of
+    that dtype and shape. Messages with other entries are rejected: with ``ack`` you get
+    ``{"error": ...}`` back, otherwise the socket is closed (code 1007).
+
+    Header entries can have a fourth item, a meta object. ``{"keyframe": true}`` adds
+    the entry to the stream's keyframe index (see pull with ``last_entry_id=last_keyframe``).
+
+    With ``group``, each message is written atomically and all of its entries get the
+    same entry ID (one entry per stream), so consumers can tell they belong together.
+    Groups with a repeated stream, or streams on different shards, are rejected like
+    invalid tensors.
     '''
     await ws.accept()
     agent = Agent(ws)
@@ -137,41 +235,76 @@ async def push_stream_data_ws(
     stream_ids = stream_id.split('+')
     assert header or len(stream_ids) == 1, "To send multiple stream IDs, you must enable the header."
 
+    metrics.websockets.inc('push')
     try:
         while True:
             # read header
             if header:
-                sids, ts, offsets = parse_offsets(await ws.receive_json(), stream_ids)
+                offsets = await ws.receive_json()
+                metas = get_meta(offsets)
+                sids, ts, offsets = parse_offsets(offsets, stream_ids)
             else:
-                sids, ts, offsets = stream_ids, [None], None
+                sids, ts, offsets, metas = stream_ids, [None], None, None
 
-            # read data
-            data = await ws.receive_bytes()
-            
-            # prepare and send data
-            sids = [f'{prefix}{s}' for s in sids]
-            entries = get_data_from_offsets(data, offsets) if header else [data]
-            result = await agent.add_entries(zip(sids, ts, entries))
+            with tracing.trace('push', stream=stream_id, device=device_id):
+                # read data
+                t_recv = time.perf_counter()
+                with tracing.span('receive_bytes'):
+                    data = await ws.receive_bytes()
+                metrics.ws_receive_seconds.observe(time.perf_counter() - t_recv, 'push')
+                
+                # prepare and send data
+                with tracing.span('get_data_from_offsets'):
+                    sids = [f'{prefix}{s}' for s in sids]
+                    entries = get_data_from_offsets(data, offsets) if header else [data]
+                try:
+                    await tensors.validate(zip(sids, entries), stale=wal.enabled())
+                    if group:
+                        check_group(sids)
+                except ValueError as e:
+                    if not ack:
+                        await ws.close(1007, str(e)[:120])
+                        return
+                    await ws.send_json({'error': str(e)})
+                    continue
+                if group:
+                    with tracing.span('add_group'):
+                        result = await wal.add_group(list(sids), entries, metas)
+                else:
+                    with tracing.span('add_entries'):
+                        result = await wal.add_entries(agent, sids, ts, entries, metas)
+                if ENABLE_MULTI_DEVICE_PREFIXING:
+                    await presence.heartbeat(device_id or DEFAULT_DEVICE, background=wal.enabled())
 
-            # acknowledge receipt
-            if ack:
-                await ws.send_json(result)
+                # acknowledge receipt
+                if ack:
+                    with tracing.span('send_ack'):
+                        await ws.send_json([utils.maybe_decode(x) for x in result])
     except (WebSocketDisconnect, ConnectionClosed):
         pass
+    finally:
+        metrics.websockets.dec('push')
 
 
 def parse_offsets(offsets: list, sids: list[str]):
     ts = (None,)*max(len(offsets), 1)
     if offsets and isinstance(offsets[0], list):
-        if len(offsets[0]) == 3:
-            sids, ts, offsets = zip(*offsets)
+        if len(offsets[0]) >= 3:  # entries can have a meta object too, see get_meta
+            sids, ts, offsets = tuple(zip(*offsets))[:3]
         else:
             sids, offsets = zip(*offsets)
     if len(sids) != len(offsets):
-        raise ValueError("")
-    
+        raise ValueError(f"Got {len(offsets)} offsets for {len(sids)} stream IDs.")
     return sids, ts, offsets
 
+def get_meta(offsets: list) -> list|None:
+    '''Get the meta objects of a header with ``[stream_id, timestamp, end_index, meta]``
+    entries (``None`` for entries without one), or ``None`` if there aren't any.'''
+    if not offsets or not isinstance(offsets[0], list):
+        return None
+    metas = [x[3] if len(x) > 3 else None for x in offsets]
+    return metas if any(metas) else None
+
 def get_data_from_offsets(data, offsets):
     if not offsets:  # no offsets provided
         offsets = [0, None]
@@ -1,72 +1,166 @@
+'''Direct (in-process) relay.
+
+Same protocol as ``/data/{stream_id}/push`` and ``/data/{stream_id}/pull``, but frames
+go straight from the producer's socket to the subscribers on the same worker and are
+written to redis in the background. Subscribers on other workers (or that want
+history) can still read the stream from ``/data``, a few milliseconds later.
+'''
+from __future__ import annotations
+import time
 import asyncio
-from typing import List
-from collections import defaultdict
-from contextlib import asynccontextmanager
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse
+from contextlib import AsyncExitStack
+from fastapi import APIRouter, Path, Query, WebSocket, WebSocketDisconnect
+from websockets.exceptions import ConnectionClosed
 
-app = FastAPI()
+from .. import utils, presence, metrics, tensors
+from ..core import Agent
+from ..relay import get_relay, DIRECT_QUEUE_SIZE, BEHIND
+from .data_ws import parse_offsets, get_data_from_offsets
+from redis_streamer.config import DEFAULT_DEVICE, ENABLE_MULTI_DEVICE_PREFIXING
 
+app = APIRouter()
 
 
-class OneToManyConnectionManager:
-    def __init__(self):
-        self.active_server: WebSocket|None = None
-        self.active_clients: List[WebSocket] = []
-        self._server_connect_lock = asyncio.Event()
+@app.websocket('/{stream_id}/push')
+async def push_direct_ws(
+        ws: WebSocket,
+        stream_id: str = Path(..., description='The unique ID of the streams'),
+        ack: bool=Query(False, description='Whether the server should send back the entry IDs after relaying. '
+                                           'If you enable this, you must read the response otherwise everything will hang.'),
+        device_id: str=Query(DEFAULT_DEVICE, description='You should give devices names if you want to manage multiple devices.'),
+        prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
+        header: bool=Query(True, description='Should the server expect a JSON header before each payload? It should contain a list of stream_id, byte offset tuples.'),
+):
+    '''Push data to local subscribers, persisting it to redis in the background.
 
-    @asynccontextmanager
-    async def connect_client(self, websocket: WebSocket):
-        try:
-            await websocket.accept()
-            self.active_clients.append(websocket)
-            yield self
-        except WebSocketDisconnect:
-            self.active_clients.remove(websocket)
+    Same protocol as ``/data/{stream_id}/push``. Timestamps in the header are ignored -
+    entry IDs are assigned by the relay.
+    '''
+    await ws.accept()
+    if ENABLE_MULTI_DEVICE_PREFIXING:
+        prefix = f'{device_id or DEFAULT_DEVICE}:{prefix}'
+    stream_ids = stream_id.split('+')
+    assert header or len(stream_ids) == 1, "To send multiple stream IDs, you must enable the header."
 
-    @asynccontextmanager
-    async def connect_server(self, websocket: WebSocket):
-        try:
-            if self.active_server is not None:
-                await self.active_server.close()
-            await websocket.accept()
-            self.active_server = websocket
-            self._server_connect_lock.set()
-            yield self
-        except WebSocketDisconnect:
-            pass
-        finally:
-            self._server_connect_lock.clear()
-            self.active_server = None
+    metrics.websockets.inc('direct_push')
+    try:
+        async with AsyncExitStack() as stack:
+            relays = {}
+            while True:
+                offsets = await ws.receive_json() if header else None
+                t_recv = time.perf_counter()
+                data = await ws.receive_bytes()
+                metrics.ws_receive_seconds.observe(time.perf_counter() - t_recv, 'direct_push')
+                try:
+                    if header:
+                        sids, _, offsets = parse_offsets(offsets, stream_ids)
+                    else:
+                        sids = stream_ids
+                    entries = get_data_from_offsets(data, offsets) if header else [data]
+                    sids = [f'{prefix}{s}' for s in sids]
+                    # the spec is read in the background, so redis stays off the relay's path
+                    await tensors.validate(zip(sids, entries), stale=True)
+                except ValueError as e:
+                    if not ack:
+                        await ws.close(1007, str(e)[:120])
+                        return
+                    await ws.send_json({'error': str(e)})
+                    continue
 
-    async def receive_client_bytes(self):
+                # group by stream, keeping the original order for the acknowledgement
+                by_stream: dict[str, list[int]] = {}
+                for i, sid in enumerate(sids):
+                    by_stream.setdefault(sid, []).append(i)
+                ids = [None] * len(entries)
+                for sid, idx in by_stream.items():
+                    relay = relays.get(sid)
+                    if relay is None:
+                        relay = relays[sid] = await stack.enter_async_context(get_relay(sid).produce())
+                    await relay.wait_for_room()
+                    for i, t in zip(idx, relay.publish([entries[i] for i in idx])):
+                        ids[i] = t
+                    metrics.entries_in.inc(sid, value=len(idx))
+                if ENABLE_MULTI_DEVICE_PREFIXING:
+                    await presence.heartbeat(device_id or DEFAULT_DEVICE, background=True)
+                if ack:
+                    await ws.send_json(ids)
+    except (WebSocketDisconnect, ConnectionClosed):
         pass
+    finally:
+        metrics.websockets.dec('direct_push')
 
-    async def send_clients_bytes(self, message: bytes):
-        for connection in self.active_clients:
-            await connection.send_bytes(message)
-
-    async def send_server_bytes(self, message: bytes):
-        await self._server_connect_lock.wait()
-        await self.active_server.send_bytes(message)
 
-managers = defaultdict(lambda: OneToManyConnectionManager())
+@app.websocket('/{stream_id}/pull')
+async def pull_direct_ws(
+        ws: WebSocket,
+        stream_id: str = Path(..., description='The unique ID of the stream'),
+        last_entry_id: str=Query('$', description="Start retrieving entries later than the provided ID. Older entries are read from redis first."),
+        latest: bool=Query(False, description='Only send the newest entry of each stream if we fall behind.'),
+        device_id: str=Query(DEFAULT_DEVICE, description='You should give devices names if you want to manage multiple devices.'),
+        prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
+        header: bool=Query(True, description='Should the server send a JSON header before each payload? It contains a list of stream_id, timestamp, byte offset tuples.'),
+):
+    '''Pull data relayed from producers on this worker.
 
+    Same protocol as ``/data/{stream_id}/pull``. Each message contains everything
+    that arrived since the last one (or just the newest entries with ``latest``).
+    '''
+    await ws.accept()
+    agent = Agent(ws)
+    if ENABLE_MULTI_DEVICE_PREFIXING:
+        prefix = f'{device_id or DEFAULT_DEVICE}:{prefix}'
+    stream_ids = stream_id.split('+')
+    sids = [f'{prefix}{s}' for s in stream_ids]
 
-@app.websocket("/direct/{client_id}/server")
-async def server(ws: WebSocket, client_id: int):
-    m = managers[client_id]
-    async with m.connect_server(ws) as m:
-        await ws.send_bytes(await m.receive_client_bytes())
-        while True:
-            await m.send_clients_bytes(await ws.receive_bytes())
+    async def send(results):
+        results = [(s[len(prefix):] if s.startswith(prefix) else s, xs) for s, xs in results if xs]
+        if not results:
+            return
+        offsets, entries = utils.pack_entries(results)
+        if header:
+            await ws.send_json(offsets)
+        await ws.send_bytes(entries)
+        metrics.count_bytes_out(offsets, 'direct_pull')
 
+    metrics.websockets.inc('direct_pull')
+    try:
+        q = asyncio.Queue(DIRECT_QUEUE_SIZE)
+        async with AsyncExitStack() as stack:
+            # subscribe first, so nothing is lost between reading history and relaying
+            for sid in sids:
+                await stack.enter_async_context(get_relay(sid).subscribe(q, latest=latest))
+            cursor = agent.init_cursor({sid: last_entry_id for sid in sids})
+            if last_entry_id != '$':
+                # catch up from redis
+                while True:
+                    results, cursor = await agent.read(cursor, count=DIRECT_QUEUE_SIZE, latest=latest)
+                    if not any(xs for _, xs in results):
+                        break
+                    await send(results)
+            last = {sid: utils.parse_entry_id(t) for sid, t in cursor.items()}
 
-@app.websocket("/direct/{client_id}/client")
-async def client(ws: WebSocket, client_id: int):
-    m = managers[client_id]
-    async with m.connect_client(ws) as m:
-        await m.send_server_bytes(await ws.receive_bytes())
-        while True:
-            await ws.send_bytes(await m.receive_client_bytes())
-
+            while True:
+                batches = [await q.get()]
+                while not q.empty():
+                    batches.append(q.get_nowait())
+                if BEHIND in batches:
+                    await ws.close(1013, 'Fell too far behind. Reconnect with last_entry_id to catch up from redis.')
+                    return
+                merged: dict[str, list] = {}
+                for batch in batches:
+                    for sid, xs in batch:
+                        merged.setdefault(sid, []).extend(xs)
+                results = []
+                for sid, xs in merged.items():
+                    # skip what we already sent from redis
+                    xs = [x for x in xs if utils.parse_entry_id(x[0]) > last[sid]]
+                    if latest:
+                        xs = xs[-1:]
+                    if xs:
+                        last[sid] = utils.parse_entry_id(xs[-1][0])
+                        results.append((sid, xs))
+                await send(results)
+    except (WebSocketDisconnect, ConnectionClosed):
+        pass
+    finally:
+        metrics.websockets.dec('direct_pull')
@@ -0,0 +1,36 @@
+from fastapi import APIRouter, Query
+from fastapi.responses import PlainTextResponse
+from redis_streamer import ctx, metrics, tracing
+
+app = APIRouter()
+
+
+@app.get('/metrics', summary='Prometheus metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    """Data plane metrics, summed across all workers, in the Prometheus text format."""
+    return metrics.render(await metrics.collect(ctx.r))
+
+
+@app.get('/admin/traces', summary='Sampled stage timings')
+async def get_traces(
+        name: str|None=Query(None, description='Only return traces with this name (e.g. pull, push).'),
+        limit: int=Query(100, description='The maximum number of (most recent) traces to return. 0 for all.'),
+        format: str=Query('json', description='json, summary, or chrome (chrome://tracing / perfetto compatible).'),
+):
+    """Get the most recent sampled traces from this worker.
+    Tracing is disabled unless ``TRACE_SAMPLE_RATE`` is set or changed via ``/admin/traces/config``."""
+    xs = tracing.get_traces(name, limit)
+    if format == 'chrome':
+        return tracing.as_chrome_trace(xs)
+    if format == 'summary':
+        return tracing.summarize(xs)
+    return [t.as_dict() for t in xs]
+
+
+@app.post('/admin/traces/config', summary='Configure tracing')
+async def configure_traces(
+        sample_rate: float=Query(..., description='The fraction of loop iterations to trace (0-1).'),
+):
+    """Change the trace sample rate for this worker."""
+    tracing.set_sample_rate(sample_rate)
+    return {'sample_rate': tracing.SAMPLE_RATE}
@@ -0,0 +1,232 @@
+'''Multiplexed pull and push.
+
+One socket can carry any number of subscriptions and publishers, each identified by a
+small channel ID that the client picks. Channels are added and removed at any time
+with JSON (text) control messages:
+
+    {"op": "subscribe", "channel": 1, "stream_id": "camera+imu", "last_entry_id": "$", "count": 1, "latest": false}
+    {"op": "publish", "channel": 2, "stream_id": "audio", "ack": false}
+    {"op": "unsubscribe", "channel": 1}
+
+Each is answered with ``{"channel": 1, "ok": true}`` (or ``"error"``). Data in either
+direction is sent as binary frames: a ``u16`` channel ID followed by a frame (see
+``utils.pack_frame``) whose header is the same offset list as ``/data/{stream_id}/push``
+and ``/pull`` use. Publish channels with ``ack`` get ``{"channel": 2, "ids": [...]}`` back.
+
+All subscriptions are served by one loop that takes turns between channels, reading
+at most ``count`` entries for each, so a busy channel can't starve the others.
+'''
+from __future__ import annotations
+import os
+import time
+import struct
+import asyncio
+import orjson
+from fastapi import APIRouter, Query, WebSocket, WebSocketDisconnect
+from websockets.exceptions import ConnectionClosed
+
+from .. import utils, presence, metrics, keyframes, tensors, wal
+from ..core import Agent, check_consistency
+from .data_ws import parse_offsets, get_meta, get_data_from_offsets
+from redis_streamer.config import DEFAULT_DEVICE, ENABLE_MULTI_DEVICE_PREFIXING
+
+MUX_BLOCK_MS = int(os.getenv('MUX_BLOCK_MS') or 100)
+MUX_MAX_CHANNELS = int(os.getenv('MUX_MAX_CHANNELS') or 1024)
+
+CHANNEL = struct.Struct('<H')
+
+app = APIRouter()
+
+
+def pack_channel_frame(channel: int, offsets, data: bytes=b'') -> bytes:
+    return CHANNEL.pack(channel) + utils.pack_frame(offsets, data)
+
+def unpack_channel_frame(frame: bytes):
+    '''Get the channel ID, offsets and (zero-copy) data of a frame.'''
+    channel, = CHANNEL.unpack_from(frame)
+    offsets, data = utils.unpack_frame(memoryview(frame)[CHANNEL.size:])
+    return channel, offsets, data
+
+
+def merge_cursors(cursors) -> dict[str, str]:
+    '''Combine cursors, keeping the oldest position of each stream.'''
+    merged = {}
+    for cursor in cursors:
+        for sid, t in cursor.items():
+            if sid not in merged or utils.parse_entry_id(t) < utils.parse_entry_id(merged[sid]):
+                merged[sid] = t
+    return merged
+
+
+def take_entries(sub: Subscription, results) -> list:
+    '''Hand a subscription the entries from a shared read that come after its cursor
+    (at most ``count`` per stream, the newest ones if it's ``latest``) and advance it.'''
+    out = []
+    for sid, xs in results:
+        t = sub.cursor.get(sid)
+        if t is None:
+            continue
+        after = utils.parse_entry_id(t)
+        xs = [x for x in xs if utils.parse_entry_id(x[0]) > after]
+        xs = xs[-sub.count:] if sub.latest else xs[:sub.count]
+        if xs:
+            out.append((sid, xs))
+            sub.cursor[sid] = utils.maybe_decode(xs[-1][0])
+    return out
+
+
+class Subscription:
+    def __init__(self, agent: Agent, stream_ids: list[str], prefix: str, last_entry_id: str='$', count: int=1, latest: bool=False, consistency: str|None=None):
+        self.stream_ids = stream_ids
+        self.prefix = prefix
+        self.cursor = agent.init_cursor({f'{prefix}{s}': last_entry_id for s in stream_ids})
+        self.count = max(int(count or 1), 1)
+        self.latest = latest
+        self.consistency = consistency
+
+class Publisher:
+    def __init__(self, stream_ids: list[str], prefix: str, ack: bool=False):
+        self.stream_ids = stream_ids
+        self.prefix = prefix
+        self.ack = ack
+
+
+@app.websocket('/mux')
+async def mux_ws(
+        ws: WebSocket,
+        device_id: str=Query(DEFAULT_DEVICE, description='The default device for channels that don\'t give one.'),
+):
+    '''Subscribe and publish to many streams over one socket. See the module docstring for the protocol.'''
+    await ws.accept()
+    agent = Agent(ws)
+    subs: dict[int, Subscription] = {}
+    pubs: dict[int, Publisher] = {}
+    changed = asyncio.Event()
+
+    def get_prefix(msg):
+        prefix = msg.get('prefix') or ''
+        if ENABLE_MULTI_DEVICE_PREFIXING:
+            prefix = f'{msg.get("device_id") or device_id or DEFAULT_DEVICE}:{prefix}'
+        return prefix
+
+    async def control(msg: dict):
+        op, channel = msg.get('op'), int(msg['channel'])
+        if not 0 <= channel <= 0xFFFF:
+            raise ValueError("Channel IDs must fit in 16 bits.")
+        if op == 'unsubscribe':
+            subs.pop(channel, None)
+            pubs.pop(channel, None)
+        elif len(subs) + len(pubs) >= MUX_MAX_CHANNELS and channel not in subs and channel not in pubs:
+            raise ValueError(f"Too many channels (max {MUX_MAX_CHANNELS}).")
+        elif op == 'subscribe':
+            check_consistency(msg.get('consistency'))
+            sub = Subscription(
+                agent, msg['stream_id'].split('+'), get_prefix(msg),
+                last_entry_id=msg.get('last_entry_id') or '$', count=msg.get('count', 1),
+                latest=bool(msg.get('latest')), consistency=msg.get('consistency'))
+            sub.cursor = agent.init_cursor(await keyframes.resolve_cursor(sub.cursor, sub.consistency))
+            pubs.pop(channel, None)
+            subs[channel] = sub
+        elif op == 'publish':
+            subs.pop(channel, None)
+            pubs[channel] = Publisher(msg['stream_id'].split('+'), get_prefix(msg), ack=bool(msg.get('ack')))
+        else:
+            raise ValueError(f"Unknown op: {op!r}")
+        changed.set()
+
+    async def publish(frame: bytes):
+        try:
+            channel, offsets, data = unpack_channel_frame(frame)
+        except (struct.error, ValueError) as e:
+            await ws.send_json({'channel': None, 'error': f'Malformed frame: {e}'})
+            return
+        pub = pubs.get(channel)
+        if pub is None:
+            await ws.send_json({'channel': channel, 'error': "Not a publish channel."})
+            return
+        try:
+            metas = get_meta(offsets)
+            sids, ts, offsets = parse_offsets(offsets, pub.stream_ids)
+            entries = get_data_from_offsets(data, offsets)
+            sids = [f'{pub.prefix}{s}' for s in sids]
+            await tensors.validate(zip(sids, entries), stale=wal.enabled())
+        except (ValueError, TypeError, IndexError) as e:
+            await ws.send_json({'channel': channel, 'error': str(e)})
+            return
+        result = await wal.add_entries(agent, sids, ts, entries, metas)
+        if ENABLE_MULTI_DEVICE_PREFIXING:
+            await presence.heartbeat(device_id or DEFAULT_DEVICE, background=wal.enabled())
+        if pub.ack:
+            await ws.send_json({'channel': channel, 'ids': [utils.maybe_decode(x) for x in result]})
+
+    async def receive():
+        while True:
+            msg = await ws.receive()
+            if msg['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(msg.get('code', 1000))
+            if msg.get('bytes') is not None:
+                await publish(msg['bytes'])
+                continue
+            try:
+                msg = orjson.loads(msg.get('text') or '{}')
+                await control(msg)
+            except (KeyError, ValueError, TypeError, AttributeError) as e:
+                await ws.send_json({'channel': msg.get('channel') if isinstance(msg, dict) else None, 'error': f'{type(e).__name__}: {e}'})
+            else:
+                await ws.send_json({'channel': msg['channel'], 'ok': True})
+
+    async def read(channel: int, sub: Subscription) -> bool:
+        results, sub.cursor = await agent.read(sub.cursor, latest=sub.latest, count=sub.count, consistency=sub.consistency)
+        return await send(channel, sub, results)
+
+    async def send(channel: int, sub: Subscription, results) -> bool:
+        results = [(s[len(sub.prefix):] if s.startswith(sub.prefix) else s, xs) for s, xs in results if xs]
+        if not results or subs.get(channel) is not sub:  # unsubscribed while reading
+            return False
+        offsets, entries = utils.pack_entries(results)
+        t_send = time.perf_counter()
+        await ws.send_bytes(pack_channel_frame(channel, offsets, entries))
+        metrics.ws_send_seconds.observe(time.perf_counter() - t_send, 'mux')
+        metrics.count_bytes_out(offsets, 'mux')
+        return True
+
+    async def serve():
+        turn = 0
+        while True:
+            if not subs:
+                await changed.wait()
+            changed.clear()
+            # take turns, starting from a different channel each round
+            channels = list(subs.items())
+            if not channels:
+                continue
+            turn = (turn + 1) % len(channels)
+            sent = False
+            for channel, sub in channels[turn:] + channels[:turn]:
+                sent = await read(channel, sub) or sent
+            if not sent and not changed.is_set() and subs:
+                # nothing new anywhere - wait for any subscribed stream to get something (or a
+                # control message, at most MUX_BLOCK_MS later), and hand what arrived to the
+                # subscriptions so they don't read it again
+                waiting = list(subs.items())
+                results, _ = await agent.read(
+                    merge_cursors(sub.cursor for _, sub in waiting), block=MUX_BLOCK_MS,
+                    count=max(sub.count for _, sub in waiting),
+                    consistency='primary' if any(sub.consistency == 'primary' for _, sub in waiting) else None)
+                for channel, sub in waiting:
+                    if results and subs.get(channel) is sub:
+                        await send(channel, sub, take_entries(sub, results))
+
+    metrics.websockets.inc('mux')
+    receiver = asyncio.create_task(receive())
+    server = asyncio.create_task(serve())
+    try:
+        done, _ = await asyncio.wait([receiver, server], return_when=asyncio.FIRST_COMPLETED)
+        for t in done:
+            t.result()
+    except (WebSocketDisconnect, ConnectionClosed):
+        pass
+    finally:
+        receiver.cancel()
+        server.cancel()
+        metrics.websockets.dec('mux')
@@ -21,28 +21,88 @@ XADD: {
 
 '''
 import time
+import struct
 import asyncio
 import orjson
 from fastapi import APIRouter, Path, Query, WebSocket, WebSocketDisconnect
 from websockets.exceptions import ConnectionClosed
 
-from .. import utils
+from .. import utils, metrics
 from ..core import ctx, Agent
+from redis_streamer.config import DEFAULT_DEVICE, ENABLE_MULTI_DEVICE_PREFIXING
 
 app = APIRouter()
 
 
-# @app.websocket('/prompt')
-# async def prompt_data_ws(ws: WebSocket):
-#     ''''''
-#     await ws.accept()
-#     agent = Agent(ws)
-#     try:
-#         async for query in recv_queries(ws):
-#             results = await agent.run_commands(query)
-#             pack_entries(results)
-#     except (WebSocketDisconnect, ConnectionClosed):
-#         pass
+@app.websocket('/commands')
+async def commands_ws(
+        ws: WebSocket,
+        device_id: str=Query(DEFAULT_DEVICE, description='You should give devices names if you want to manage multiple devices.'),
+        prefix: str=Query('', description='Add a prefix to the streams. If a device ID is provided, this will come after the device ID.'),
+):
+    '''Run batches of redis commands over one socket.
+
+    Protocol:
+     - send a batch as one binary frame (see ``utils.pack_frame``): a JSON list of
+       commands, followed by the XADD payloads back to back.
+     - receive one binary frame: a JSON list with a result for each command, followed
+       by the entry payloads.
+
+    Commands:
+        {"cmd": "xadd", "sid": ..., "size": payload bytes, "time": "*", "metadata": {}}
+        {"cmd": "xrange"|"xrevrange", "sid": ..., "start": ..., "end": "+", "count": 1, "inclusive": false}
+        {"cmd": "xread", "sids": {stream_id: last_entry_id}, "count": 1, "block": null}
+        {"cmd": "xlen", "sid": ...}
+
+    Results:
+        {"result": ...} for xadd (the entry ID) and xlen,
+        {"entries": [[stream_id, entry_id, end offset], ...]} for xrange, xrevrange and
+        xread (the same format as the ``/data`` pull header), or {"error": message}.
+
+    The commands in a batch run in one pipeline per shard. XREAD streams must all be
+    on the same shard. Stream IDs get the device prefix, like in the other routes, and
+    it's removed again from the stream IDs in the results.
+
+    A batch that can't be parsed (or a text frame) gets a single ``{"error": message}``.
+    '''
+    await ws.accept()
+    agent = Agent(ws)
+    if ENABLE_MULTI_DEVICE_PREFIXING:
+        prefix = f'{device_id or DEFAULT_DEVICE}:{prefix}'
+    metrics.websockets.inc('commands')
+    try:
+        while True:
+            msg = await ws.receive()
+            if msg['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(msg.get('code', 1000))
+            try:
+                if msg.get('bytes') is None:
+                    raise ValueError("Send batches as binary frames (see utils.pack_frame).")
+                queries, data = utils.unpack_frame(msg['bytes'])
+                if not isinstance(queries, list):
+                    raise ValueError("A batch must be a list of commands.")
+                queries = [prefix_command(q, prefix) for q in queries]
+                results = await agent.run_commands(queries, data=data)
+            except (ValueError, TypeError, struct.error) as e:
+                await ws.send_bytes(utils.pack_frame({'error': str(e)}))
+                continue
+            header, content = [], bytearray()
+            for q, x in zip(queries, results):
+                if isinstance(x, Exception):
+                    header.append({'error': str(x)})
+                elif q['cmd'].lower() in ('xrange', 'xrevrange'):
+                    offsets, _ = pack_into(content, [(q['sid'], x)], prefix)
+                    header.append({'entries': offsets})
+                elif q['cmd'].lower() == 'xread':
+                    offsets, _ = pack_into(content, x or [], prefix)
+                    header.append({'entries': offsets})
+                else:
+                    header.append({'result': utils.maybe_decode(x)})
+            await ws.send_bytes(utils.pack_frame(header, content))
+    except (WebSocketDisconnect, ConnectionClosed):
+        pass
+    finally:
+        metrics.websockets.dec('commands')
 
 
 @app.websocket('/pull')
@@ -70,14 +130,12 @@ async def prompt_pull_data_ws(ws: WebSocket):
     agent = Agent(ws)
     try:
         async for query in recv_queries(ws):
-            xs = await agent.run_commands([query], 'XREAD')
-            for sid, t, data, metadata in xs:
-                await ws.send_json({
-                    'stream_id': sid,
-                    'time': t,
-                    'metadata': metadata,
-                })
-                await ws.send_bytes(data)
+            q = {'sids': query['streams'], 'count': query.get('count', 1), 'block': query.get('block')}
+            for sid, xs in await agent.run_commands(q, 'XREAD') or []:
+                for t, x in xs:
+                    metadata = {utils.maybe_decode(k): utils.maybe_decode(v) for k, v in x.items() if k != b'd'}
+                    await ws.send_json(serialize_metadata(utils.maybe_decode(sid), utils.maybe_decode(t), metadata))
+                    await ws.send_bytes(x[b'd'])
     except (WebSocketDisconnect, ConnectionClosed):
         pass
 
@@ -101,15 +159,42 @@ async def prompt_push_data_ws(
     agent = Agent(ws)
     try:
         async for query in recv_queries(ws):
-            results = await agent.run_commands([query], 'XADD')
+            q = {'sid': query['stream_id'], 'metadata': query.get('metadata')}
+            result = await agent.run_commands(q, 'XADD')
             if ack:
-                await ws.send_json(results)
+                await ws.send_json(utils.maybe_decode(result))
     except (WebSocketDisconnect, ConnectionClosed):
         pass
 
 
 # ----------------------------------- Utils ---------------------------------- #
 
+def prefix_command(q: dict, prefix: str) -> dict:
+    '''Add the device prefix to the stream IDs of a command.'''
+    if not isinstance(q, dict):
+        raise ValueError(f"Commands must be objects, got {q!r}.")
+    q = dict(q, cmd=str(q.get('cmd') or ''))
+    if 'sid' in q:
+        q['sid'] = f'{prefix}{q["sid"]}'
+    if 'sids' in q:
+        if not isinstance(q['sids'], dict):
+            raise ValueError("sids must be an object of {stream_id: last_entry_id}.")
+        q['sids'] = {f'{prefix}{s}': t for s, t in q['sids'].items()}
+    if any(s.startswith(':') for s in [q.get('sid') or '', *(q.get('sids') or ())]):
+        raise ValueError("Stream IDs can't start with ':' (those keys are reserved).")
+    return q
+
+def pack_into(content: bytearray, entries, prefix: str=''):
+    '''Like ``utils.pack_entries``, but appending to an existing buffer.'''
+    offsets = []
+    for sid, xs in entries:
+        sid = utils.maybe_decode(sid)
+        sid = sid[len(prefix):] if prefix and sid.startswith(prefix) else sid
+        for t, x in xs:
+            content += x[b'd']
+            offsets.append((sid, utils.maybe_decode(t), len(content)))
+    return offsets, content
+
 def serialize_metadata(sid, t, metadata):
     return {
         'stream_id': sid,
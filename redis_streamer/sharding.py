@@ -0,0 +1,46 @@
+'''Spread streams across multiple redis instances.
+
+Set ``REDIS_URLS`` to a comma separated list of redis URLs. Streams are placed on a
+consistent hash ring by device ID (the part of the stream key before the first ``:``),
+so all of a device's streams live on the same instance and can be read with one XREAD.
+Adding an instance only moves about ``1/n`` of the devices.
+
+Keys starting with ``:`` (events, presence, registry, metrics) and stream meta always
+live on the first instance, so control-plane queries don't need to fan out.
+'''
+from __future__ import annotations
+import os
+import bisect
+import hashlib
+
+VNODES = int(os.getenv('REDIS_SHARD_VNODES') or 160)
+CACHE_SIZE = int(os.getenv('REDIS_SHARD_CACHE_SIZE') or 65536)
+
+
+def shard_key(sid: str) -> str:
+    '''The part of a stream key that decides its shard (the device ID).'''
+    return sid.split(':', 1)[0]
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    '''A consistent hash ring with virtual nodes.'''
+    def __init__(self, nodes: list[str], vnodes: int=VNODES):
+        self.nodes = list(nodes)
+        ring = sorted((_hash(f'{node}#{i}'), n) for n, node in enumerate(self.nodes) for i in range(vnodes))
+        self._hashes = [h for h, _ in ring]
+        self._nodes = [n for _, n in ring]
+        self._cache: dict[str, int] = {}
+
+    def get(self, key: str) -> int:
+        '''Get the index of the node that owns a key.'''
+        n = self._cache.get(key)
+        if n is None:
+            if len(self._cache) >= CACHE_SIZE:  # keys are device IDs, which can be anything
+                self._cache.clear()
+            i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+            n = self._cache[key] = self._nodes[i]
+        return n
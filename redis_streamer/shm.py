@@ -0,0 +1,301 @@
+'''Shared-memory rings for producers and consumers on the same host.
+
+Local processes can skip the websocket and redis hops by writing frames into an
+mmap-backed ring buffer per stream (under ``SHM_DIR``, ``/dev/shm`` by default)
+and reading them straight out of shared memory. The server drains each ring into
+its redis stream in batches, so remote consumers and history work as usual.
+
+Attach a ring with the ``attachSharedMemory`` mutation - it returns the ring's path,
+which is also announced in the stream meta under ``shm``.
+
+    ring = Ring.open(path)
+    ring.write(frame)                      # producer
+
+    reader = ring.reader()                 # consumer, starting from new frames
+    for view, pos in reader:               # memoryviews into the ring (zero-copy)
+        process(view)
+        if not reader.valid(pos):          # the producer lapped us while we were reading
+            ...
+
+Layout: a 64 byte header (magic, capacity, write position, record count, drain
+position, reserved position) followed by ``capacity`` bytes of records. Each record
+is a ``u32`` length, 4 reserved bytes and the payload, padded to 8 bytes. Positions are
+logical (they only grow), so readers can tell when they've been overrun. Writers
+bump the reserved position before copying a record and the write position after, so a
+reader that checks ``valid`` after copying a payload knows it wasn't being overwritten.
+'''
+from __future__ import annotations
+import os
+import mmap
+import fcntl
+import socket
+import struct
+import asyncio
+import orjson
+
+from redis_streamer import metrics, tensors, claims
+from redis_streamer.core import ctx, Agent
+from redis_streamer.indexing import after_write
+from redis_streamer.config import STREAM_META_PREFIX, SHM_RINGS_KEY
+
+SHM_DIR = os.getenv('SHM_DIR') or '/dev/shm/redis-streamer'
+SHM_DEFAULT_CAPACITY = int(os.getenv('SHM_DEFAULT_CAPACITY') or 64 * 1024 * 1024)
+SHM_POLL_INTERVAL = float(os.getenv('SHM_POLL_INTERVAL') or 0.002)
+SHM_DRAIN_BATCH = int(os.getenv('SHM_DRAIN_BATCH') or 64)
+SHM_CLAIM_INTERVAL = float(os.getenv('SHM_CLAIM_INTERVAL') or 2)
+
+MAGIC = b'RSRING1\0'
+HEADER = struct.Struct('<8sQQQQQ')  # magic, capacity, write_pos, count, drain_pos, reserve_pos
+HEADER_SIZE = 64
+WRITE_POS, COUNT, DRAIN_POS, RESERVE_POS = 16, 24, 32, 40
+RECORD = struct.Struct('<II')  # length, reserved
+WRAP = 0xFFFFFFFF
+
+_u64 = struct.Struct('<Q')
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+# ---------------------------------------------------------------------------- #
+#                                     Ring                                     #
+# ---------------------------------------------------------------------------- #
+
+class Ring:
+    '''An mmap-backed ring buffer of variable sized records.'''
+    def __init__(self, path: str, fd: int, mm: mmap.mmap):
+        self.path = path
+        self.fd = fd
+        self.mm = mm
+        magic, self.capacity, *_ = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a redis-streamer ring.")
+
+    @classmethod
+    def create(cls, path: str, capacity: int=SHM_DEFAULT_CAPACITY) -> Ring:
+        '''Open a ring, creating it if it doesn't exist.'''
+        capacity = _align(capacity)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < HEADER_SIZE:
+                os.ftruncate(fd, HEADER_SIZE + capacity)
+                mm = mmap.mmap(fd, HEADER_SIZE + capacity)
+                HEADER.pack_into(mm, 0, MAGIC, capacity, 0, 0, 0, 0)
+            else:
+                mm = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN)
+        return cls(path, fd, mm)
+
+    @classmethod
+    def open(cls, path: str) -> Ring:
+        fd = os.open(path, os.O_RDWR)
+        return cls(path, fd, mmap.mmap(fd, os.fstat(fd).st_size))
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+    @property
+    def write_pos(self) -> int:
+        return _u64.unpack_from(self.mm, WRITE_POS)[0]
+
+    @property
+    def reserve_pos(self) -> int:
+        '''The end of the record being written (rings from older writers only have write_pos).'''
+        return max(_u64.unpack_from(self.mm, RESERVE_POS)[0], self.write_pos)
+
+    @property
+    def count(self) -> int:
+        return _u64.unpack_from(self.mm, COUNT)[0]
+
+    @property
+    def drain_pos(self) -> int:
+        return _u64.unpack_from(self.mm, DRAIN_POS)[0]
+
+    @drain_pos.setter
+    def drain_pos(self, pos: int):
+        _u64.pack_into(self.mm, DRAIN_POS, pos)
+
+    def write(self, data: bytes|memoryview) -> int:
+        '''Append a record. Returns its position. Safe to call from multiple processes.'''
+        size = _align(RECORD.size + len(data))
+        if size > self.capacity:
+            raise ValueError(f"Record of {len(data)} bytes doesn't fit in a ring of {self.capacity} bytes.")
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            pos = self.write_pos
+            i = pos % self.capacity
+            wrap = i + size > self.capacity  # doesn't fit before the end - wrap around
+            # claim the space first, so readers of the records we're overwriting can tell
+            _u64.pack_into(self.mm, RESERVE_POS, pos + (self.capacity - i if wrap else 0) + size)
+            if wrap:
+                if self.capacity - i >= RECORD.size:
+                    RECORD.pack_into(self.mm, HEADER_SIZE + i, WRAP, 0)
+                pos += self.capacity - i
+                i = 0
+            RECORD.pack_into(self.mm, HEADER_SIZE + i, len(data), 0)
+            self.mm[HEADER_SIZE + i + RECORD.size:HEADER_SIZE + i + RECORD.size + len(data)] = data
+            # publish the record only once it's fully written
+            _u64.pack_into(self.mm, COUNT, self.count + 1)
+            _u64.pack_into(self.mm, WRITE_POS, pos + size)
+            return pos
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def reader(self, pos: int|None=None) -> RingReader:
+        '''Read records starting at ``pos`` (default: only new records).'''
+        return RingReader(self, self.write_pos if pos is None else pos)
+
+
+class RingReader:
+    '''A reader's position in a ring. Each reader keeps its own position.'''
+    def __init__(self, ring: Ring, pos: int):
+        self.ring = ring
+        self.pos = pos
+        self.dropped = 0
+
+    def valid(self, pos: int) -> bool:
+        '''Is the record at ``pos`` still intact (i.e. the writer hasn't lapped it, or started to)?'''
+        return self.ring.reserve_pos - pos <= self.ring.capacity
+
+    def read(self) -> tuple[memoryview, int]|None:
+        '''Get the next record (a zero-copy view) and its position, or None if we're caught up.'''
+        cap = self.ring.capacity
+        while True:
+            wpos = self.ring.write_pos
+            if self.pos >= wpos:
+                return None
+            if wpos - self.pos > cap:  # overrun - skip ahead to the writer
+                self.dropped += 1
+                self.pos = wpos
+                return None
+            i = self.pos % cap
+            if cap - i < RECORD.size:
+                self.pos += cap - i
+                continue
+            length, _ = RECORD.unpack_from(self.ring.mm, HEADER_SIZE + i)
+            if length != WRAP and (length > cap - RECORD.size or not self.valid(self.pos)):
+                # the writer lapped us while we were reading the length
+                self.dropped += 1
+                self.pos = self.ring.write_pos
+                return None
+            if length == WRAP:
+                self.pos += cap - i
+                continue
+            pos = self.pos
+            self.pos += _align(RECORD.size + length)
+            start = HEADER_SIZE + i + RECORD.size
+            return memoryview(self.ring.mm)[start:start + length], pos
+
+    def __iter__(self):
+        while (x := self.read()) is not None:
+            yield x
+
+
+def ring_path(sid: str) -> str:
+    return os.path.join(SHM_DIR, sid.replace('/', '_'))
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Draining                                   #
+# ---------------------------------------------------------------------------- #
+
+shm_entries = metrics.Counter('shm_entries_total', 'Entries drained from shared-memory rings into redis.', ('stream',))
+shm_dropped = metrics.Counter('shm_dropped_total', 'Entries overwritten in a shared-memory ring before they were drained.', ('stream',))
+shm_rejected = metrics.Counter('shm_rejected_total', "Entries from a shared-memory ring that didn't match the stream's tensor spec.", ('stream',))
+
+HOSTNAME = socket.gethostname()
+drainers: dict[str, asyncio.Task] = {}
+
+
+async def drain(sid: str, ring: Ring):
+    '''Move records from the ring into the redis stream, starting where the last drainer stopped.'''
+    reader = ring.reader(ring.drain_pos)
+    agent = Agent()
+    try:
+        await _drain(sid, ring, reader, agent)
+    finally:
+        ring.close()
+
+async def _drain(sid: str, ring: Ring, reader: RingReader, agent: Agent):
+    while True:
+        batch = []
+        while len(batch) < SHM_DRAIN_BATCH and (x := reader.read()) is not None:
+            view, pos = x
+            data = bytes(view)
+            view.release()
+            if reader.valid(pos):
+                batch.append(data)
+            else:
+                reader.dropped += 1
+        if reader.dropped:
+            shm_dropped.inc(sid, value=reader.dropped)
+            reader.dropped = 0
+        if not batch:
+            ring.drain_pos = reader.pos
+            await asyncio.sleep(SHM_POLL_INTERVAL)
+            continue
+        # writers skip the API, so check tensor streams here (entries of the wrong size are dropped)
+        spec = (await tensors.get_specs([sid]))[sid]
+        if spec is not None:
+            n = len(batch)
+            batch = [d for d in batch if len(d) == spec.nbytes]
+            if len(batch) < n:
+                shm_rejected.inc(sid, value=n - len(batch))
+        ids = await agent.add_entries([(sid, None, d) for d in batch]) if batch else []
+        ring.drain_pos = reader.pos
+        await after_write([sid] * len(batch), ids, batch)
+        shm_entries.inc(sid, value=len(batch))
+
+
+async def attach(sid: str, capacity: int=SHM_DEFAULT_CAPACITY) -> dict:
+    '''Create a ring for a stream and announce it in the stream meta.'''
+    ring = Ring.create(ring_path(sid), capacity)
+    info = {'path': ring.path, 'capacity': ring.capacity, 'host': HOSTNAME}
+    ring.close()
+    await ctx.r.hset(SHM_RINGS_KEY, sid, orjson.dumps(info))
+    meta_key = f'{STREAM_META_PREFIX}:{sid}'
+    meta = orjson.loads(await ctx.r.get(meta_key) or b'{}')
+    await ctx.r.set(meta_key, orjson.dumps({**meta, 'shm': info}))
+    await claim()
+    return info
+
+
+async def detach(sid: str) -> bool:
+    removed = await ctx.r.hdel(SHM_RINGS_KEY, sid)
+    meta_key = f'{STREAM_META_PREFIX}:{sid}'
+    meta = orjson.loads(await ctx.r.get(meta_key) or b'{}')
+    if meta.pop('shm', None) is not None:
+        await ctx.r.set(meta_key, orjson.dumps(meta))
+    await claim()
+    return bool(removed)
+
+
+async def claim():
+    '''Drain the rings on this host that no other worker is draining.'''
+    rings = {
+        sid.decode('utf-8'): orjson.loads(info)
+        for sid, info in (await ctx.r.hgetall(SHM_RINGS_KEY)).items()
+    }
+    for sid, info in rings.items():
+        if info.get('host') != HOSTNAME or not os.path.exists(info['path']):
+            continue
+        owner = await claims.own(f'{SHM_RINGS_KEY}:owner:{sid}', SHM_CLAIM_INTERVAL)
+        task = drainers.get(sid)
+        if owner and (task is None or task.done()):
+            drainers[sid] = asyncio.create_task(drain(sid, Ring.open(info['path'])))
+        elif not owner and task is not None:
+            task.cancel()
+            drainers.pop(sid, None)
+    # stop draining detached rings
+    for sid in set(drainers) - set(rings):
+        drainers.pop(sid).cancel()
+
+
+_claimer = claims.Claimer(claim, SHM_CLAIM_INTERVAL, "Shared-memory ring")
+
+def start():
+    return _claimer.start()
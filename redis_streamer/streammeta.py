@@ -0,0 +1,96 @@
+'''A per-worker cache of settings declared in stream meta.
+
+Some stream meta (tensor specs, field indexes) is needed on every write, so it's read
+once per ``STREAM_META_TTL`` seconds and parsed once. ``updateStreamMeta`` clears the
+cache on the worker that handles it, and the other workers pick up the change when
+their copy expires. With ``stale=True`` (the write path, when the write-ahead log is
+on), redis is read in the background: expired values are used while they're refreshed,
+and streams that aren't cached yet are waited for up to ``STREAM_META_WAIT`` seconds.
+'''
+from __future__ import annotations
+import os
+import time
+import asyncio
+import orjson
+
+from redis_streamer.core import ctx
+from redis_streamer.config import STREAM_META_PREFIX
+
+STREAM_META_TTL = float(os.getenv('STREAM_META_TTL') or os.getenv('TENSOR_META_TTL') or 5)
+STREAM_META_WAIT = float(os.getenv('STREAM_META_WAIT') or 0.1)
+
+_caches: list[MetaCache] = []
+
+
+class MetaCache:
+    '''Caches ``parse(meta)`` for each stream. Meta that doesn't parse counts as ``None``
+    (it can't be set through the API).'''
+    def __init__(self, parse, ttl: float=STREAM_META_TTL):
+        self.parse = parse
+        self.ttl = ttl
+        self.items: dict[str, tuple[float, object]] = {}
+        self._loading: dict[str, asyncio.Task] = {}
+        _caches.append(self)
+
+    async def get(self, sids, stale: bool=False) -> dict[str, object]:
+        '''Get the parsed meta of each stream. With ``stale``, expired values are returned
+        right away and refreshed in the background, and streams that aren't cached yet
+        get ``None`` if they can't be loaded within ``STREAM_META_WAIT`` seconds (redis is
+        slow or unavailable).'''
+        now = time.time()
+        sids = set(sids)
+        expired = [s for s in sids if s not in self.items or self.items[s][0] < now]
+        if not stale:
+            await self._load(expired)
+        elif expired:
+            self._load_in_background(expired)
+            missing = {self._loading[s] for s in expired if s not in self.items and s in self._loading}
+            if missing:
+                await asyncio.wait(missing, timeout=STREAM_META_WAIT)
+        return {s: self.items[s][1] if s in self.items else None for s in sids}
+
+    async def _load(self, sids: list[str]):
+        if not sids:
+            return
+        metas = await ctx.r.mget([f'{STREAM_META_PREFIX}:{s}' for s in sids])
+        expires = time.time() + self.ttl
+        for sid, meta in zip(sids, metas):
+            try:
+                value = self.parse(orjson.loads(meta)) if meta else None
+            except (ValueError, orjson.JSONDecodeError):
+                value = None
+            self.items[sid] = (expires, value)
+
+    def _load_in_background(self, sids: list[str]):
+        '''Load the streams that aren't already being loaded, in one task.'''
+        sids = [s for s in sids if s not in self._loading]
+        if not sids:
+            return
+        task = asyncio.create_task(self._load_quietly(sids))
+        for s in sids:
+            self._loading[s] = task
+        task.add_done_callback(lambda _: self._loaded(task, sids))
+
+    def _loaded(self, task: asyncio.Task, sids: list[str]):
+        for s in sids:
+            if self._loading.get(s) is task:
+                del self._loading[s]
+
+    async def _load_quietly(self, sids: list[str]):
+        try:
+            await self._load(sids)
+        except Exception as e:
+            print("Loading stream meta failed:", type(e).__name__, e)
+
+    def invalidate(self, sid: str):
+        self.items.pop(sid, None)
+
+    def clear(self):
+        self.items.clear()
+        self._loading.clear()
+
+
+def invalidate(sid: str):
+    '''Forget the cached meta of a stream (e.g. after it was changed).'''
+    for cache in _caches:
+        cache.invalidate(sid)
@@ -0,0 +1,86 @@
+'''Typed tensor streams.
+
+A stream's meta can declare the dtype and shape of its entries (e.g. with the
+``updateStreamMeta`` mutation):
+
+    {"dtype": "float32", "shape": [480, 640, 3]}
+
+Entries pushed to the stream are checked against it (each must be exactly one array
+of that dtype and shape), and readers can ask for batches as one array: with
+``stack=true``, a pull or GET of ``count`` entries comes with the dtype and the stacked
+shape ``[n, *shape]``. Entries are already sent back to back, so the payload is the
+array's buffer, and ``np.frombuffer(data, dtype).reshape(shape)`` gives the batch
+without copying.
+
+Specs are cached per worker (see ``streammeta``), so other workers notice a changed
+spec within ``STREAM_META_TTL`` seconds.
+'''
+from __future__ import annotations
+import math
+from typing import NamedTuple
+import numpy as np
+
+from redis_streamer.streammeta import MetaCache
+
+
+class TensorSpec(NamedTuple):
+    dtype: str  # e.g. '<f4'
+    shape: tuple[int, ...]
+    nbytes: int  # the size of an entry
+
+
+def parse_spec(meta: dict|None) -> TensorSpec|None:
+    '''Get the tensor spec from stream meta (``None`` if it doesn't declare one).'''
+    if not isinstance(meta, dict) or ('dtype' not in meta and 'shape' not in meta):
+        return None
+    if 'dtype' not in meta or 'shape' not in meta:
+        raise ValueError("Tensor streams need both a dtype and a shape.")
+    try:
+        dtype = np.dtype(meta['dtype'])
+    except TypeError:
+        raise ValueError(f"Invalid dtype {meta['dtype']!r}.") from None
+    if dtype.hasobject or not dtype.itemsize:
+        raise ValueError(f"Invalid dtype {meta['dtype']!r}. It must have a fixed size.")
+    shape = meta['shape']
+    if not isinstance(shape, list) or not all(isinstance(x, int) and not isinstance(x, bool) and x >= 0 for x in shape):
+        raise ValueError(f"Invalid shape {shape!r}. Expected a list of non-negative integers.")
+    return TensorSpec(dtype.str, tuple(shape), dtype.itemsize * math.prod(shape))
+
+
+_specs = MetaCache(parse_spec)
+
+async def get_specs(sids, stale: bool=False) -> dict[str, TensorSpec|None]:
+    '''Get the tensor spec of each stream (see ``MetaCache.get`` for ``stale``).'''
+    return await _specs.get(sids, stale=stale)
+
+
+async def validate(entries, stale: bool=False) -> None:
+    '''Check ``(stream_id, data)`` pairs against their streams' specs. Raises ValueError.'''
+    entries = list(entries)
+    specs = await get_specs((sid for sid, _ in entries), stale=stale)
+    for sid, data in entries:
+        spec = specs[sid]
+        if spec is not None and len(data) != spec.nbytes:
+            raise ValueError(
+                f"Entries of {sid} must be {spec.nbytes} bytes (dtype {spec.dtype}, shape {list(spec.shape)}), got {len(data)}.")
+
+
+async def stack_spec(sids) -> TensorSpec:
+    '''Get the spec that entries of all of these streams share, so they can be stacked.'''
+    specs = await get_specs(sids)
+    for sid, spec in specs.items():
+        if spec is None:
+            raise ValueError(f"Can't stack {sid}: its meta has no dtype and shape.")
+    if len(set(specs.values())) > 1:
+        raise ValueError("Can't stack streams with different dtypes or shapes.")
+    return next(iter(specs.values()))
+
+
+def fitting(results: list, spec: TensorSpec) -> list:
+    '''Drop entries that don't fit the spec (e.g. written before it was set).'''
+    n = spec.nbytes
+    return [(sid, [(t, x) for t, x in xs if len(x[b'd']) == n]) for sid, xs in results]
+
+
+def stack_header(spec: TensorSpec, offsets: list) -> dict:
+    return {'dtype': spec.dtype, 'shape': [len(offsets), *spec.shape], 'offsets': offsets}
@@ -0,0 +1,138 @@
+'''Sampled per-stage latency tracing.
+
+Tracing is opt-in: set ``TRACE_SAMPLE_RATE`` (0-1) or change it at runtime with
+``/admin/traces/config``. A sampled loop iteration records how long each stage took
+and is kept in a bounded in-memory ring (per worker) that can be dumped as JSON or
+as a Chrome trace (load it in chrome://tracing or https://ui.perfetto.dev).
+
+    with tracing.trace('pull', stream=stream_id):
+        with tracing.span('read'):
+            ...
+
+When an iteration isn't sampled, ``trace`` and ``span`` return a shared no-op
+context manager, so the overhead is a random() call and a context var lookup.
+'''
+from __future__ import annotations
+import os
+import time
+import random
+import collections
+from contextvars import ContextVar
+
+SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE') or 0)
+BUFFER_SIZE = int(os.getenv('TRACE_BUFFER_SIZE') or 1000)
+
+traces: collections.deque[Trace] = collections.deque(maxlen=BUFFER_SIZE)
+
+
+class _NoOp:
+    '''Stands in for both a trace and a span when an iteration isn't sampled.'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        pass
+
+    def span(self, name: str):
+        return self
+
+NO_TRACE = _NoOp()
+_current: ContextVar[Trace|_NoOp] = ContextVar('trace', default=NO_TRACE)
+
+
+class Span:
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *a):
+        t1 = time.perf_counter()
+        self.trace.spans.append((self.name, self.t0 - self.trace.t0, t1 - self.t0))
+
+
+class Trace:
+    '''The stage timings for one iteration of a loop.'''
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.spans: list[tuple[str, float, float]] = []
+        self.duration = 0.
+
+    def span(self, name: str) -> Span:
+        return Span(self, name)
+
+    def __enter__(self):
+        self.time = time.time()
+        self.t0 = time.perf_counter()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *a):
+        self.duration = time.perf_counter() - self.t0
+        _current.reset(self._token)
+        traces.append(self)
+
+    def as_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'time': self.time,
+            'duration': self.duration,
+            'attrs': self.attrs,
+            'spans': [{'name': n, 'start': t, 'duration': d} for n, t, d in self.spans],
+        }
+
+
+def trace(name: str, **attrs) -> Trace|_NoOp:
+    '''Start a (possibly) sampled trace. Use it as a context manager.'''
+    if SAMPLE_RATE and random.random() < SAMPLE_RATE:
+        return Trace(name, **attrs)
+    return NO_TRACE
+
+
+def span(name: str) -> Span|_NoOp:
+    '''Time a stage of the current trace.'''
+    return _current.get().span(name)
+
+
+def set_sample_rate(rate: float):
+    global SAMPLE_RATE
+    SAMPLE_RATE = max(0., min(1., rate))
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Exporting                                  #
+# ---------------------------------------------------------------------------- #
+
+def get_traces(name: str|None=None, limit: int=100) -> list[Trace]:
+    xs = [t for t in traces if name is None or t.name == name]
+    return xs[-limit:] if limit else xs
+
+
+def summarize(xs: list[Trace]) -> dict:
+    '''Mean and max time per stage, per trace name.'''
+    out: dict = {}
+    for t in xs:
+        stages = out.setdefault(t.name, {})
+        for n, _, d in t.spans + [('total', 0, t.duration)]:
+            s = stages.setdefault(n, {'count': 0, 'mean': 0., 'max': 0.})
+            s['count'] += 1
+            s['mean'] += (d - s['mean']) / s['count']
+            s['max'] = max(s['max'], d)
+    return out
+
+
+def as_chrome_trace(xs: list[Trace]) -> dict:
+    '''Format traces using the Chrome trace event format.'''
+    pid = os.getpid()
+    events = []
+    for i, t in enumerate(xs):
+        ts = t.time * 1e6
+        events.append({'name': t.name, 'ph': 'X', 'ts': ts, 'dur': t.duration * 1e6, 'pid': pid, 'tid': i, 'args': t.attrs})
+        events.extend(
+            {'name': n, 'ph': 'X', 'ts': ts + start * 1e6, 'dur': d * 1e6, 'pid': pid, 'tid': i}
+            for n, start, d in t.spans)
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
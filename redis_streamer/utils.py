@@ -1,5 +1,7 @@
 from __future__ import annotations
+import struct
 import datetime
+import orjson
 
 
 
@@ -24,6 +26,11 @@ def format_epoch_time(tid: float, i='0'):
     '''Format a redis timestamp from epoch seconds.'''
     return f'{int(tid * 1000)}-{i}'
 
+def parse_entry_id(tid: str|bytes) -> tuple[int, int]:
+    '''Split a redis timestamp into (milliseconds, sequence) so they can be compared.'''
+    ms, _, seq = maybe_decode(tid).partition('-')
+    return int(ms), int(seq or 0)
+
 def parse_datetime(tid: str|bytes):
     '''Convert a redis timestamp to a datetime object.'''
     return datetime.datetime.fromtimestamp(parse_epoch_time(tid))
@@ -53,3 +60,28 @@ def pack_entries(entries):
             offsets.append((sid, maybe_decode(ts), len(content)))
     # jsonOffsets = orjson.dumps(offsets).decode('utf-8')
     return offsets, content
+
+FRAME_HEADER = struct.Struct('<I')
+
+def pack_frame(header, data: bytes=b'') -> bytes:
+    '''Pack a JSON header and a binary payload into one message: a u32 (little endian)
+    header length, the JSON header, then the payload.'''
+    h = orjson.dumps(header)
+    return b''.join((FRAME_HEADER.pack(len(h)), h, data))
+
+def unpack_frame(frame: bytes) -> tuple[object, memoryview]:
+    '''The inverse of ``pack_frame``. The payload is a zero-copy view of the frame.'''
+    n, = FRAME_HEADER.unpack_from(frame)
+    view = memoryview(frame)
+    return orjson.loads(view[FRAME_HEADER.size:FRAME_HEADER.size + n]), view[FRAME_HEADER.size + n:]
+
+JSON_CACHE_KEY = 'json'
+
+def entry_json(entry: dict):
+    '''Parse an entry's data as json, caching the result on the entry so that
+    subscribers sharing the same entry only decode it once.'''
+    try:
+        return entry[JSON_CACHE_KEY]
+    except KeyError:
+        x = entry[JSON_CACHE_KEY] = orjson.loads(entry[b'd'])
+        return x
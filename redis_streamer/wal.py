@@ -0,0 +1,387 @@
+'''A disk-backed write-ahead log for ingest.
+
+When redis stalls (a BGSAVE fork, a failover, memory pressure), writes wait, and so do
+the devices pushing to us. With ``WAL_DIR`` set, pushes, POSTs and mux publishes are
+appended to a memory-mapped log file and acknowledged right away, and a background task
+replays the log into redis in pipelines of up to ``WAL_BATCH`` entries, in the order
+they were written (explicit entry IDs are kept). Acks can't carry the IDs redis will
+assign, so they're ``null`` for entries without an explicit ID. Frame groups (see
+``groups``) are logged as one record and written with their script when they're
+replayed, so their acks are ``null`` too.
+
+Each worker writes its own log (``WAL_DIR/<worker id>``) and holds an ``flock`` on it
+while it runs. At startup, workers take over the logs whose lock is free (their worker
+stopped or died) and replay what's left, before draining their own log, so the older
+entries keep their place in each stream. The log survives the process crashing, not the
+machine (it isn't fsynced). Entries are replayed twice if the worker dies between
+writing a batch and recording its position. If redis is down long enough for the log
+to reach ``WAL_MAX_BYTES``, appends wait for it to drain, as they would without it.
+
+A batch is retried while redis can't take writes (disconnected, or answering OOM,
+READONLY, LOADING, BUSY, ...). Only entries redis rejects on their own (e.g. an
+explicit ID that's too old) are skipped. If draining fails any other way, the error is
+logged and draining starts again from the last recorded position. With the log, the
+write path doesn't wait for redis otherwise either: device heartbeats are written in
+the background and tensor specs are served from the cache while they're refreshed
+(streams that aren't cached yet aren't checked if redis doesn't answer in time).
+
+Layout: segments of ``WAL_SEGMENT_SIZE`` bytes (``00000001.wal``, ...), preallocated and
+filled with records: a header (size, crc32, stream ID length, entry ID length, meta
+length) then the stream ID, entry ID, meta (JSON) and payload. A zero size marks the
+end of a segment. The drain position (segment, offset) is kept in ``position``.
+'''
+from __future__ import annotations
+import os
+import glob
+import mmap
+import zlib
+import fcntl
+import shutil
+import struct
+import asyncio
+import orjson
+from redis import exceptions as redis_errors
+
+from redis_streamer import utils, metrics, groups
+from redis_streamer.core import Agent, REPLICA_ERRORS
+from redis_streamer.indexing import after_write
+
+WAL_DIR = os.getenv('WAL_DIR') or ''
+WAL_SEGMENT_SIZE = int(os.getenv('WAL_SEGMENT_SIZE') or 64 * 1024 * 1024)
+WAL_MAX_BYTES = int(os.getenv('WAL_MAX_BYTES') or 1024 * 1024 * 1024)
+WAL_BATCH = int(os.getenv('WAL_BATCH') or 1000)
+WAL_RETRY_INTERVAL = float(os.getenv('WAL_RETRY_INTERVAL') or 1)
+
+RECORD = struct.Struct('<IIHHI')  # size, crc32 (of everything after it), sid length, id length, meta length
+POSITION = struct.Struct('<QQ')  # segment, offset
+_SIZE_CRC, _LENGTHS = struct.Struct('<II'), struct.Struct('<HHI')
+_CRC_START = _SIZE_CRC.size
+GROUP_META = ':group'  # the meta of a frame group record: {sids, sizes, metas}
+
+wal_entries = metrics.Counter('wal_entries_total', 'Entries replayed from the write-ahead log into redis.')
+wal_errors = metrics.Counter('wal_errors_total', 'Entries from the write-ahead log that redis rejected (e.g. out of order IDs).')
+wal_retries = metrics.Counter('wal_retries_total', 'Write-ahead log batches retried because redis was unavailable.')
+wal_restarts = metrics.Counter('wal_restarts_total', 'Times the write-ahead log drain (or recovery) failed and was restarted.')
+wal_backlog = metrics.Gauge('wal_backlog_bytes', 'Bytes in the write-ahead log that are waiting to be written to redis.')
+
+
+# ---------------------------------------------------------------------------- #
+#                                      Log                                     #
+# ---------------------------------------------------------------------------- #
+
+class Segment:
+    '''One preallocated, memory-mapped file of records.'''
+    def __init__(self, path: str, size: int|None=None):
+        '''Open a segment, or create it with ``size`` bytes.'''
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT | os.O_EXCL if size else 0), 0o644)
+        try:
+            if size:
+                os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)  # the mapping keeps the file open
+        self.path = path
+        self.number = int(os.path.basename(path).split('.')[0])
+        self.end = 0 if size else self._scan()
+
+    def _scan(self) -> int:
+        '''Find the end of the intact records (e.g. after a crash mid-write).'''
+        pos = 0
+        while self.read(pos) is not None:
+            pos += RECORD.unpack_from(self.mm, pos)[0]
+        return pos
+
+    def close(self):
+        self.mm.close()
+
+    def write(self, sid: bytes, t: bytes, meta: bytes, data: bytes) -> bool:
+        '''Append a record. Returns False if it doesn't fit.'''
+        size = RECORD.size + len(sid) + len(t) + len(meta) + len(data)
+        pos = self.end
+        if pos + size > len(self.mm):
+            return False
+        i = pos + RECORD.size
+        for x in (sid, t, meta, data):
+            self.mm[i:i + len(x)] = x
+            i += len(x)
+        # the size and checksum go last, so a record is only there once it's complete
+        _LENGTHS.pack_into(self.mm, pos + _CRC_START, len(sid), len(t), len(meta))
+        crc = zlib.crc32(memoryview(self.mm)[pos + _CRC_START:pos + size])
+        _SIZE_CRC.pack_into(self.mm, pos, size, crc)
+        self.end = pos + size
+        return True
+
+    def read(self, pos: int) -> tuple[str, str|None, dict|None, bytes]|None:
+        '''Get the record at ``pos`` as (stream ID, entry ID, meta, payload), or None at the end.'''
+        if pos + RECORD.size > len(self.mm):
+            return None
+        size, crc, n_sid, n_t, n_meta = RECORD.unpack_from(self.mm, pos)
+        if size < RECORD.size or pos + size > len(self.mm) or zlib.crc32(memoryview(self.mm)[pos + _CRC_START:pos + size]) != crc:
+            return None
+        i = pos + RECORD.size
+        sid = self.mm[i:i + n_sid].decode('utf-8'); i += n_sid
+        t = self.mm[i:i + n_t].decode('utf-8') or None; i += n_t
+        meta = orjson.loads(self.mm[i:i + n_meta]) if n_meta else None; i += n_meta
+        return sid, t, meta, self.mm[i:pos + size]
+
+
+class WriteAheadLog:
+    '''A directory of segments, locked by the process that writes or drains it.'''
+    def __init__(self, path: str):
+        '''Open (or create) a log. Raises BlockingIOError if another process has it.'''
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.lock_fd = os.open(os.path.join(path, 'lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self.lock_fd)
+            raise
+        self.position_fd = os.open(os.path.join(path, 'position'), os.O_RDWR | os.O_CREAT, 0o644)
+        self.segments = [Segment(p) for p in sorted(glob.glob(os.path.join(path, '*.wal')))]
+        data = os.pread(self.position_fd, POSITION.size, 0)
+        self.position = POSITION.unpack(data) if len(data) == POSITION.size else (0, 0)
+        self.appended = asyncio.Event()
+        self.committed = asyncio.Event()
+        self._remove_drained()
+
+    def close(self):
+        for s in self.segments:
+            s.close()
+        self.segments = []
+        os.close(self.position_fd)
+        os.close(self.lock_fd)  # releases the lock
+
+    def remove(self):
+        '''Delete the log (once it's drained).'''
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    @property
+    def backlog(self) -> int:
+        '''The number of bytes that haven't been drained.'''
+        number, offset = self.position
+        return sum(s.end for s in self.segments) - (offset if self.segments and self.segments[0].number == number else 0)
+
+    def append(self, entries) -> None:
+        '''Append ``(stream_id, entry_id, meta, data)`` entries.'''
+        for sid, t, meta, data in entries:
+            sid = sid.encode('utf-8')
+            t = (utils.maybe_decode(t) or '').encode('utf-8')
+            meta = orjson.dumps(meta) if meta else b''
+            if not self.segments or not self.segments[-1].write(sid, t, meta, data):
+                size = max(WAL_SEGMENT_SIZE, RECORD.size + len(sid) + len(t) + len(meta) + len(data))
+                number = self.segments[-1].number + 1 if self.segments else 1
+                self.segments.append(Segment(os.path.join(self.path, f'{number:08d}.wal'), size))
+                self.segments[-1].write(sid, t, meta, data)
+        self.appended.set()
+        wal_backlog.set(value=self.backlog)
+
+    def read(self, count: int) -> tuple[list, tuple[int, int]]:
+        '''Get up to ``count`` entries from the drain position, and the position after them.'''
+        number, offset = self.position
+        out = []
+        for i, s in enumerate(self.segments):
+            if s.number < number:
+                continue
+            if s.number > number:
+                number, offset = s.number, 0
+            while len(out) < count and offset < s.end:
+                out.append(s.read(offset))
+                offset += RECORD.unpack_from(s.mm, offset)[0]
+            if len(out) >= count or i == len(self.segments) - 1:
+                break
+        return out, (number, offset)
+
+    def commit(self, position: tuple[int, int]) -> None:
+        '''Record that everything before ``position`` is in redis.'''
+        self.position = position
+        os.pwrite(self.position_fd, POSITION.pack(*position), 0)
+        self._remove_drained()
+        self.committed.set()
+        wal_backlog.set(value=self.backlog)
+
+    def _remove_drained(self):
+        number, offset = self.position
+        # keep the last segment to write to, unless it's drained and full
+        while self.segments and (self.segments[0].number < number or (
+                len(self.segments) > 1 and self.segments[0].number == number and offset >= self.segments[0].end)):
+            s = self.segments.pop(0)
+            s.close()
+            os.unlink(s.path)
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Draining                                   #
+# ---------------------------------------------------------------------------- #
+
+# error replies that mean redis can't take writes right now, rather than that it rejects the entry
+RETRY_ERRORS = ('OOM', 'READONLY', 'LOADING', 'BUSY', 'MASTERDOWN', 'TRYAGAIN', 'CLUSTERDOWN')
+
+def unpack_group(meta: dict, data: bytes) -> tuple[list, list, list]:
+    '''Split a frame group record into its stream IDs, entries and metas.'''
+    group = meta[GROUP_META]
+    entries, i = [], 0
+    for size in group['sizes']:
+        entries.append(data[i:i + size])
+        i += size
+    return group['sids'], entries, group['metas'] or [None] * len(entries)
+
+
+def is_group(meta) -> bool:
+    return isinstance(meta, dict) and GROUP_META in meta
+
+
+def unavailable(e: BaseException) -> bool:
+    '''Should a batch that failed with ``e`` be retried as a whole?'''
+    return isinstance(e, (*REPLICA_ERRORS, redis_errors.ReadOnlyError, redis_errors.OutOfMemoryError, redis_errors.ExecAbortError)) or (
+        isinstance(e, redis_errors.ResponseError) and str(e).split(' ', 1)[0] in RETRY_ERRORS)
+
+
+async def drain(log: WriteAheadLog, until_empty: bool=False):
+    '''Replay the log into redis, in order. Retries while redis is unavailable.'''
+    agent = Agent()
+    while True:
+        log.appended.clear()
+        records, position = log.read(WAL_BATCH)
+        if not records:
+            if until_empty:
+                return
+            await log.appended.wait()
+            continue
+        # frame groups are written on their own, in order with the entries around them
+        k = next((i for i, (_, _, meta, _) in enumerate(records) if is_group(meta)), None)
+        if k is not None:
+            records, position = log.read(k or 1)
+        sids, ts, metas, entries = (list(x) for x in zip(*records))
+        try:
+            if is_group(metas[0]):
+                sids, entries, metas = unpack_group(metas[0], entries[0])
+                try:
+                    t = await groups.add_group(zip(sids, entries))
+                except (redis_errors.ResponseError, ValueError) as e:  # unavailable ones are retried below
+                    t = e
+                ids = [t] * len(sids)
+            else:
+                ids = await agent.add_entries(zip(sids, ts, entries), raise_on_error=False)
+            # e.g. redis started refusing writes halfway through the transaction
+            e = next((x for x in ids if isinstance(x, Exception) and unavailable(x)), None)
+            if e is not None:
+                raise e
+        except Exception as e:
+            if not unavailable(e):
+                raise
+            wal_retries.inc()
+            print("Write-ahead log: redis is unavailable, retrying:", type(e).__name__, e)
+            await asyncio.sleep(WAL_RETRY_INTERVAL)
+            continue
+        log.commit(position)
+        ok = [i for i, x in enumerate(ids) if not isinstance(x, Exception)]
+        wal_entries.inc(value=len(ok))
+        if len(ok) < len(ids):
+            wal_errors.inc(value=len(ids) - len(ok))
+            print("Write-ahead log: redis rejected", len(ids) - len(ok), "entries:", next(x for x in ids if isinstance(x, Exception)))
+        await after_write(sids, ids, entries, metas)
+
+
+async def supervise(name: str, run):
+    '''Run a background task until it finishes, logging what kills it and starting it again.'''
+    while True:
+        try:
+            return await run()
+        except Exception as e:
+            wal_restarts.inc()
+            print(f"Write-ahead log: {name} failed, restarting:", type(e).__name__, e)
+            await asyncio.sleep(WAL_RETRY_INTERVAL)
+
+
+async def replay(log: WriteAheadLog):
+    '''Replay the logs left behind, then keep draining ``log``.'''
+    await supervise('recovery', recover)
+    await supervise('draining', lambda: drain(log))
+
+
+async def recover():
+    '''Replay the logs of workers that are gone, then delete them.'''
+    for path in sorted(glob.glob(os.path.join(WAL_DIR, '*'))):
+        if not os.path.isdir(path) or _log is not None and path == _log.path:
+            continue
+        try:
+            log = WriteAheadLog(path)
+        except OSError:  # its worker is still running
+            continue
+        print("Write-ahead log: replaying", path, f'({log.backlog} bytes)')
+        try:
+            await drain(log, until_empty=True)
+        except BaseException:
+            log.close()
+            raise
+        log.remove()
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Ingest                                    #
+# ---------------------------------------------------------------------------- #
+
+_log: WriteAheadLog|None = None
+_tasks: list[asyncio.Task] = []
+
+
+async def _wait_for_room():
+    while _log.backlog > WAL_MAX_BYTES:  # redis has been gone for a while
+        _log.committed.clear()
+        await _log.committed.wait()
+
+
+def enabled() -> bool:
+    '''Whether writes go through this worker's log.'''
+    return _log is not None
+
+
+async def add_entries(agent: Agent, sids: list[str], ts: list, entries: list, metas: list|None=None) -> list:
+    '''Write entries to their streams, through the log if it's enabled. Returns their IDs
+    (with the log, the explicit IDs, or None).'''
+    if _log is None:
+        ids = await agent.add_entries(zip(sids, ts, entries))
+        await after_write(sids, ids, entries, metas)
+        return ids
+    await _wait_for_room()
+    _log.append(zip(sids, ts, metas or [None] * len(sids), entries))
+    return [utils.maybe_decode(t) for t in ts]
+
+
+async def add_group(sids: list[str], entries: list, metas: list|None=None) -> list:
+    '''Write a frame group (see ``groups.add_group``), through the log if it's enabled.
+    Returns the group's entry ID for each entry (with the log, None).'''
+    if _log is None:
+        ids = [await groups.add_group(zip(sids, entries))] * len(sids)
+        await after_write(sids, ids, entries, metas)
+        return ids
+    await _wait_for_room()
+    meta = {GROUP_META: {'sids': sids, 'sizes': [len(x) for x in entries], 'metas': metas}}
+    _log.append([(sids[0], None, meta, b''.join(entries))])
+    return [None] * len(sids)
+
+
+def start():
+    '''Open this worker's log (if ``WAL_DIR`` is set), and drain it and any left behind.'''
+    global _log
+    if not WAL_DIR or _log is not None:
+        return
+    _log = WriteAheadLog(os.path.join(WAL_DIR, metrics.WORKER_ID))
+    _tasks.append(asyncio.create_task(replay(_log)))
+
+
+async def stop():
+    '''Stop draining and release the log. What's left is replayed by the next worker to start.'''
+    global _log
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
+    if _log is not None:
+        if not _log.backlog:
+            _log.remove()
+        else:
+            _log.close()
+        _log = None
@@ -166,6 +166,18 @@ class API:
 
             pbar.update()
 
+    def export(self, sid, out=None, format='npz', **kw):
+        '''Download a range of a stream as a columnar file (see GET /data/{sid}/export).'''
+        out = out or f'{sid}.{"npz" if format == "npz" else "arrows"}'
+        with self.sess.get(self.asurl(f'data/{sid}/export', format=format, **kw), stream=True) as r:
+            if r.status_code >= 500: # show internal server errors
+                raise requests.HTTPError(r.text)
+            r.raise_for_status()
+            with open(out, 'wb') as f:
+                for chunk in r.iter_content(None):
+                    f.write(chunk)
+        return out
+
     # ---------------------------------------------------------------------------- #
     #                          Websocket Context Managers                          #
     # ---------------------------------------------------------------------------- #
@@ -195,6 +207,11 @@ def unpack_entries(header: list[tuple[str, str, int]], entries: bytes) -> list[t
         for sid, t, start, end in zip(sids, ts, (0,) + offsets, offsets)
     ]
 
+def unpack_tensors(header: dict, data: bytes) -> np.ndarray:
+    '''Get a stacked batch (pull with stack=true) as one array, without copying.
+    For a GET, use the x-dtype and x-shape headers.'''
+    return np.frombuffer(data, dtype=header['dtype']).reshape(header['shape'])
+
 class WebsocketStream:
     _pbar = None
     def __init__(self, url, show_pbar=True, **kw) -> None:
@@ -0,0 +1,375 @@
+'''Load test the push/pull throughput and latency of a redis streamer server.
+
+This starts the app (and a local ``redis-server`` if one is installed, otherwise an
+in-process fakeredis stand-in), drives producers and consumers through it and writes
+throughput and latency percentiles to JSON so runs can be compared between commits.
+
+    # websocket push/pull with 4 producers, 16 consumers, 100KB frames across 4 streams
+    python tests/benchmark.py run ws --producers 4 --consumers 16 --streams 4 --size 100000 --out before.json
+    # the same through POST/GET /data or graphql subscriptions
+    python tests/benchmark.py run http --out http.json
+    python tests/benchmark.py run graphql --out graphql.json
+    # against a server that's already running (only the benchmark's own streams are touched)
+    python tests/benchmark.py run ws --url http://localhost:8000
+    # compare two runs
+    python tests/benchmark.py compare before.json after.json
+
+Latency is measured from the moment a producer sends a message to the moment a
+consumer receives it (the send time is written into the first 8 bytes of the payload).
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import shutil
+import socket
+import struct
+import asyncio
+import subprocess
+import contextlib
+
+import requests
+import websockets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ('ws', 'http', 'graphql')
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Servers                                   #
+# ---------------------------------------------------------------------------- #
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for(url, timeout=20):
+    t0 = time.time()
+    while time.time() - t0 < timeout:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Server at {url} didn't start.")
+
+@contextlib.contextmanager
+def local_server(redis='auto', workers=1, env=None):
+    '''Start the app (and redis) on free ports. Yields the app URL.'''
+    procs = []
+    env = {**os.environ, 'PYTHONPATH': f'{ROOT}:{os.path.join(ROOT, "redis_streamer")}', **(env or {})}
+    try:
+        port = free_port()
+        if redis == 'auto':
+            redis = 'server' if shutil.which('redis-server') else 'fake'
+        if redis == 'server':
+            redis_port = free_port()
+            procs.append(subprocess.Popen(
+                ['redis-server', '--port', str(redis_port), '--save', '', '--appendonly', 'no'],
+                stdout=subprocess.DEVNULL))
+            env['REDIS_URL'] = f'redis://127.0.0.1:{redis_port}'
+            cmd = [sys.executable, '-m', 'gunicorn', 'redis_streamer.main:app', '-w', str(workers),
+                   '-k', 'uvicorn.workers.UvicornWorker', '-b', f'127.0.0.1:{port}']
+        elif redis == 'fake':
+            # fakeredis only lives inside a single process
+            cmd = [sys.executable, os.path.abspath(__file__), 'serve_fake', '--port', str(port)]
+        else:
+            env['REDIS_URL'] = redis
+            cmd = [sys.executable, '-m', 'gunicorn', 'redis_streamer.main:app', '-w', str(workers),
+                   '-k', 'uvicorn.workers.UvicornWorker', '-b', f'127.0.0.1:{port}']
+        procs.append(subprocess.Popen(cmd, env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        url = f'http://127.0.0.1:{port}'
+        wait_for(url)
+        yield url, redis
+    finally:
+        for p in procs[::-1]:
+            p.terminate()
+            p.wait()
+
+def serve_fake(port=8000):
+    '''Run the app against an in-process fakeredis (pip install fakeredis lupa).'''
+    import fakeredis
+    import uvicorn
+    from redis_streamer import core
+    async def init(self):
+        self.set_shards({'fake': fakeredis.FakeAsyncRedis()})
+    core.Context.init = init
+    from redis_streamer.main import app
+    uvicorn.run(app, host='127.0.0.1', port=port, log_level='warning')
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Stats                                     #
+# ---------------------------------------------------------------------------- #
+
+def make_payload(size):
+    return struct.pack('d', time.time()) + b'\0' * max(0, size - 8)
+
+def payload_latency(data, now=None):
+    return (now or time.time()) - struct.unpack('d', data[:8])[0]
+
+def percentiles(xs, ps=(50, 90, 99, 99.9)):
+    xs = sorted(xs)
+    if not xs:
+        return {}
+    out = {f'p{p:g}': xs[min(len(xs) - 1, int(len(xs) * p / 100))] * 1000 for p in ps}
+    out['max'] = xs[-1] * 1000
+    out['mean'] = sum(xs) / len(xs) * 1000
+    return out
+
+class Stats:
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.latencies = []
+        self.errors = 0
+        self.t0 = self.t1 = None
+
+    def add(self, data, latency=None):
+        self.t0 = self.t0 or time.time()
+        self.t1 = time.time()
+        self.count += 1
+        self.bytes += len(data)
+        if latency is not None:
+            self.latencies.append(latency)
+
+    def summary(self, duration=None):
+        duration = duration or ((self.t1 - self.t0) if self.t0 else 0) or 1e-9
+        return {
+            'messages': self.count,
+            'seconds': duration,
+            'msgs_per_sec': self.count / duration,
+            'mb_per_sec': self.bytes / duration / 1e6,
+            'errors': self.errors,
+            **({'latency_ms': percentiles(self.latencies)} if self.latencies else {}),
+        }
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Producers                                  #
+# ---------------------------------------------------------------------------- #
+
+def ws_url(url, path, **params):
+    q = '&'.join(f'{k}={v}' for k, v in params.items())
+    return f"ws{url[4:]}/{path}" + (f'?{q}' if q else '')
+
+async def produce_ws(url, sid, n, size, rate, batch, stats):
+    async with websockets.connect(ws_url(url, f'data/{sid}/push'), max_size=None) as ws:
+        for i in range(0, n, batch):
+            t0 = time.time()
+            xs = [make_payload(size) for _ in range(min(batch, n - i))]
+            offsets = [sum(len(x) for x in xs[:j + 1]) for j in range(len(xs))]
+            await ws.send(json.dumps(offsets))
+            await ws.send(b''.join(xs))
+            for x in xs:
+                stats.add(x)
+            if rate:
+                await asyncio.sleep(max(0, len(xs) / rate - (time.time() - t0)))
+
+async def produce_http(url, sid, n, size, rate, batch, stats):
+    sess = requests.Session()
+    for i in range(0, n, batch):
+        t0 = time.time()
+        xs = [make_payload(size) for _ in range(min(batch, n - i))]
+        try:
+            r = await asyncio.to_thread(sess.post, f'{url}/data/{sid}', files=[('entries', (sid, x)) for x in xs])
+            r.raise_for_status()
+        except Exception:
+            stats.errors += 1
+            continue
+        for x in xs:
+            stats.add(x)
+        if rate:
+            await asyncio.sleep(max(0, len(xs) / rate - (time.time() - t0)))
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Consumers                                  #
+# ---------------------------------------------------------------------------- #
+
+def unpack_entries(header, entries):
+    start = 0
+    for sid, t, end in header:
+        yield sid, t, entries[start:end]
+        start = end
+
+async def consume_ws(url, sid, expected, stats, ready, count=100):
+    async with websockets.connect(ws_url(url, f'data/{sid}/pull', count=count, block=1000), max_size=None) as ws:
+        ready.set()
+        while stats.count < expected:
+            header = json.loads(await ws.recv())
+            entries = await ws.recv()
+            now = time.time()
+            for _, _, data in unpack_entries(header, entries):
+                stats.add(data, payload_latency(data, now))
+
+async def consume_http(url, sid, expected, stats, ready, count=100):
+    sess = requests.Session()
+    r = await asyncio.to_thread(sess.get, f'{url}/data/{sid}', params={'last_entry_id': '$', 'count': 1, 'block': 1})
+    last = r.headers['x-last-entry-id']
+    ready.set()
+    while stats.count < expected:
+        r = await asyncio.to_thread(sess.get, f'{url}/data/{sid}', params={'last_entry_id': last, 'count': count, 'block': 1000})
+        if r.status_code != 200:
+            stats.errors += 1
+            continue
+        now = time.time()
+        last = r.headers['x-last-entry-id']
+        for _, _, data in unpack_entries(json.loads(r.headers['x-offsets']), r.content):
+            stats.add(data, payload_latency(data, now))
+
+async def consume_graphql(url, sid, expected, stats, ready, count=100):
+    device, _, sid = sid.rpartition(':')
+    query = '''subscription ($sids: JSON!, $device: String, $count: Int!) {
+        streams(streamIds: $sids, device: $device, count: $count) { ... on DataPayloads { data } }
+    }'''
+    async with websockets.connect(ws_url(url, 'graphql'), subprotocols=['graphql-transport-ws'], max_size=None) as ws:
+        await ws.send(json.dumps({'type': 'connection_init'}))
+        await ws.recv()
+        await ws.send(json.dumps({'id': '1', 'type': 'subscribe', 'payload': {
+            'query': query, 'variables': {'sids': [sid], 'device': device or 'default', 'count': count}}}))
+        ready.set()
+        while stats.count < expected:
+            msg = json.loads(await ws.recv())
+            if msg['type'] != 'next' or msg['payload'].get('errors'):
+                stats.errors += 1
+                continue
+            now = time.time()
+            for data in msg['payload']['data']['streams']['data']:
+                data = base64.b64decode(data)
+                stats.add(data, payload_latency(data, now))
+
+PRODUCERS = {'ws': produce_ws, 'http': produce_http, 'graphql': produce_ws}
+CONSUMERS = {'ws': consume_ws, 'http': consume_http, 'graphql': consume_graphql}
+
+
+# ---------------------------------------------------------------------------- #
+#                                      CLI                                     #
+# ---------------------------------------------------------------------------- #
+
+async def run_scenario(url, scenario, producers=1, consumers=1, streams=1, count=1000, size=1000, rate=0, batch=1, timeout=60, prefix='bench'):
+    sids = stream_ids(prefix, streams)
+    # consumers read a single stream each, so we know how many messages each should get
+    produced_per_stream = [count * len(range(i, producers, streams)) for i in range(streams)]
+    producer_stats = [Stats() for _ in range(producers)]
+    consumer_stats = [Stats() for _ in range(consumers)]
+
+    readies = [asyncio.Event() for _ in range(consumers)]
+    consumer_tasks = [
+        asyncio.create_task(CONSUMERS[scenario](url, sids[i % streams], produced_per_stream[i % streams], s, ready))
+        for i, (s, ready) in enumerate(zip(consumer_stats, readies))
+    ]
+    await asyncio.wait_for(asyncio.gather(*(r.wait() for r in readies)), timeout)
+    await asyncio.sleep(0.5)
+
+    t0 = time.time()
+    await asyncio.wait_for(asyncio.gather(*(
+        PRODUCERS[scenario](url, sids[i % streams], count, size, rate, batch, s)
+        for i, s in enumerate(producer_stats)
+    )), timeout)
+    t_produced = time.time() - t0
+    done, pending = await asyncio.wait(consumer_tasks, timeout=timeout)
+    for t in pending:
+        t.cancel()
+    t_consumed = time.time() - t0
+
+    def merge(xs):
+        m = Stats()
+        for s in xs:
+            m.count += s.count
+            m.bytes += s.bytes
+            m.errors += s.errors
+            m.latencies.extend(s.latencies)
+        return m
+    return {
+        'produce': merge(producer_stats).summary(t_produced),
+        'consume': {
+            **merge(consumer_stats).summary(t_consumed),
+            'timed_out': len(pending),
+            'failed': sum(1 for t in done if t.exception()),
+        },
+    }
+
+
+def stream_ids(prefix, streams):
+    return [f'{prefix}{i}' for i in range(streams)]
+
+
+def delete_streams(url, sids):
+    for sid in sids:
+        requests.post(f'{url}/graphql', json={
+            'query': 'mutation($sid: String!) { deleteStream(streamId: $sid) }', 'variables': {'sid': sid}})
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(*scenarios, url=None, redis='auto', workers=1, producers=1, consumers=1, streams=1, count=1000, size=1000,
+        rate=0, batch=1, timeout=60, out=None):
+    '''Run one or more scenarios (ws, http, graphql) and report throughput and latency.
+
+    Arguments:
+        url: Use an already running server instead of starting one. Its data is left alone: the
+            benchmark writes to streams with a unique prefix and deletes them afterwards.
+        redis: When starting a server: "server" (local redis-server), "fake" (fakeredis), a redis URL, or "auto".
+        workers: Number of gunicorn workers when starting a server (fakeredis is always one process).
+        producers, consumers: How many concurrent producer/consumer connections.
+        streams: How many streams to spread producers and consumers across.
+        count: Messages sent per producer.
+        size: Payload size in bytes.
+        rate: Messages/sec per producer (0 is as fast as possible).
+        batch: Messages sent per push/POST.
+        out: Write the results to this JSON file.
+    '''
+    scenarios = scenarios or SCENARIOS
+    params = dict(producers=producers, consumers=consumers, streams=streams, count=count, size=size, rate=rate, batch=batch, timeout=timeout)
+    external = bool(url)
+    with (contextlib.nullcontext((url, 'external')) if external else local_server(redis, workers)) as (url, redis):
+        results = {}
+        for scenario in scenarios:
+            if external:
+                prefix = f'bench-{uuid.uuid4().hex[:8]}-'
+            else:
+                # our own throwaway server, so start from an empty redis
+                prefix = 'bench'
+                requests.post(f'{url}/graphql', json={'query': 'mutation { flush }'})
+            try:
+                results[scenario] = asyncio.run(run_scenario(url, scenario, **params, prefix=prefix))
+            finally:
+                if external:
+                    delete_streams(url, stream_ids(prefix, streams))
+            print(scenario, json.dumps(results[scenario], indent=2))
+    report = {'commit': git_commit(), 'time': time.time(), 'redis': redis, 'workers': workers, 'params': params, 'results': results}
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def compare(before, after):
+    '''Compare two benchmark result files.'''
+    a, b = (json.load(open(f)) for f in (before, after))
+    print(f"{a.get('commit')} -> {b.get('commit')}")
+    for scenario in sorted(set(a['results']) & set(b['results'])):
+        for side in ('produce', 'consume'):
+            x, y = a['results'][scenario][side], b['results'][scenario][side]
+            keys = [('msgs_per_sec', x, y)] + [
+                (f'latency_ms.{k}', x.get('latency_ms', {}), y.get('latency_ms', {}))
+                for k in ('p50', 'p99', 'p99.9')]
+            for k, xs, ys in keys:
+                k2 = k.split('.')[-1]
+                if k2 in xs and k2 in ys:
+                    change = (ys[k2] - xs[k2]) / xs[k2] * 100 if xs[k2] else 0
+                    print(f'{scenario:8s} {side:8s} {k:16s} {xs[k2]:12.2f} -> {ys[k2]:12.2f} ({change:+.1f}%)')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire({'run': run, 'compare': compare, 'serve_fake': serve_fake})
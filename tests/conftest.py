@@ -0,0 +1,19 @@
+import pytest
+
+
+@pytest.fixture
+def fake_redis():
+    '''Point ``ctx`` at an empty fakeredis (with no cached stream meta) for the test, and
+    put the previous shards back afterwards. Yields ``ctx``.'''
+    from fakeredis import FakeAsyncRedis
+    from redis_streamer import streammeta
+    from redis_streamer.core import ctx
+    saved = dict(vars(ctx))
+    ctx.set_shards({'fake': FakeAsyncRedis()})
+    for cache in streammeta._caches:
+        cache.clear()
+    yield ctx
+    for cache in streammeta._caches:
+        cache.clear()
+    vars(ctx).clear()
+    vars(ctx).update(saved)
@@ -0,0 +1,142 @@
+'''Microbenchmarks for the per-message framing and cursor functions.
+
+Each case builds a synthetic batch (from tiny IMU records to multi-MB frames, across
+1-100 streams) and measures ops/sec and peak allocated bytes for one call.
+
+    # measure and print
+    python tests/microbenchmark.py run
+    # save the current numbers as the baseline (do this on the machine you compare on)
+    python tests/microbenchmark.py save
+    # fail if anything got slower or allocates more than the baseline
+    python tests/microbenchmark.py check --speed_threshold 0.3 --alloc_threshold 0.1
+
+``check`` is also run by ``tests/test_hot_path.py`` when ``RUN_BENCHMARKS=1``.
+'''
+import os
+import sys
+import json
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from redis_streamer import utils
+from redis_streamer.core import Agent, decode_xread_format
+from redis_streamer.routes.data_ws import parse_offsets, get_data_from_offsets
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines', 'microbenchmark.json')
+
+# name: (payload size, number of streams, entries per stream)
+BATCHES = {
+    'imu-1x100': (64, 1, 100),
+    'imu-100x10': (64, 100, 10),
+    'json-10x10': (1_000, 10, 10),
+    'jpeg-10x1': (100_000, 10, 1),
+    'frame-1x1': (4_000_000, 1, 1),
+}
+
+
+def make_raw_batch(size, n_streams, n_entries, t0=1_700_000_000_000):
+    '''A batch the way redis returns it from xread (bytes IDs and fields).'''
+    return [
+        (f'device:stream{i}'.encode(), [
+            (f'{t0 + j // 4}-{j % 4}'.encode(), {b'd': b'x' * size})
+            for j in range(n_entries)
+        ])
+        for i in range(n_streams)
+    ]
+
+
+def make_cases():
+    agent = Agent()
+    cases = {}
+    for name, (size, n_streams, n_entries) in BATCHES.items():
+        raw = make_raw_batch(size, n_streams, n_entries)
+        decoded = decode_xread_format(raw)
+        offsets, content = utils.pack_entries(decoded)
+        sids = [s for s, _ in decoded]
+        header = [list(o) for o in offsets]
+        ends = [end for _, _, end in offsets]
+        cursor = {s: '0-0' for s in sids}
+        cases[f'decode_xread_format[{name}]'] = lambda raw=raw: decode_xread_format(raw)
+        cases[f'pack_entries[{name}]'] = lambda decoded=decoded: utils.pack_entries(decoded)
+        cases[f'update_cursor[{name}]'] = lambda cursor=cursor, decoded=decoded: agent.update_cursor(dict(cursor), decoded)
+        cases[f'parse_offsets[{name}]'] = lambda header=header, sids=sids: parse_offsets(header, sids)
+        cases[f'get_data_from_offsets[{name}]'] = lambda content=content, ends=ends: get_data_from_offsets(content, ends)
+    for n in (1, 10, 100):
+        sids = [f'stream{i}' for i in range(n)]
+        cases[f'init_cursor[{n}]'] = lambda sids=sids: agent.init_cursor(list(sids), prefix='device:')
+    return cases
+
+
+def measure(func, min_time=0.2):
+    '''Get ops/sec (best of 5) and the peak bytes allocated by a single call.'''
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    ops = max(number / t for t in timer.repeat(5, number))
+
+    tracemalloc.start()
+    func()  # warm up caches so we only count per-call allocations
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'ops_per_sec': ops, 'peak_bytes': peak - base}
+
+
+def measure_all(*names, min_time=0.2, quiet=True):
+    '''Measure each case (optionally only those containing one of ``names``).'''
+    results = {}
+    for name, func in make_cases().items():
+        if names and not any(n in name for n in names):
+            continue
+        results[name] = r = measure(func, min_time)
+        if not quiet:
+            print(f'{name:44s} {r["ops_per_sec"]:14,.0f} ops/s {r["peak_bytes"]:14,d} B')
+    return results
+
+
+def run(*names, min_time=0.2, out=None):
+    '''Run the microbenchmarks (optionally only those containing one of ``names``).'''
+    results = measure_all(*names, min_time=min_time, quiet=False)
+    if out:
+        with open(out, 'w') as f:
+            json.dump({'time': time.time(), 'python': sys.version.split()[0], 'results': results}, f, indent=2)
+
+
+def save(out=BASELINE, min_time=0.5):
+    '''Store the current numbers as the baseline.'''
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    run(min_time=min_time, out=out)
+
+
+def compare(results, baseline, speed_threshold=0.3, alloc_threshold=0.1, alloc_slack=1024):
+    '''Get the cases that are slower or allocate more than the baseline allows.'''
+    regressions = []
+    for name, b in baseline.items():
+        r = results.get(name)
+        if r is None:
+            continue
+        if r['ops_per_sec'] < b['ops_per_sec'] * (1 - speed_threshold):
+            regressions.append(f'{name}: {r["ops_per_sec"]:,.0f} ops/s < baseline {b["ops_per_sec"]:,.0f}')
+        if r['peak_bytes'] > b['peak_bytes'] * (1 + alloc_threshold) + alloc_slack:
+            regressions.append(f'{name}: {r["peak_bytes"]:,d} B > baseline {b["peak_bytes"]:,d}')
+    return regressions
+
+
+def check(baseline=BASELINE, speed_threshold=0.3, alloc_threshold=0.1, min_time=0.2):
+    '''Fail if any case regressed beyond the thresholds (fractions of the baseline).'''
+    with open(baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(measure_all(min_time=min_time, quiet=False), baseline, speed_threshold, alloc_threshold)
+    for r in regressions:
+        print('REGRESSION', r)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire({'run': run, 'save': save, 'check': check})
@@ -0,0 +1,43 @@
+import asyncio
+import orjson
+import numpy as np
+from redis_streamer import aggregate as agg
+from redis_streamer.core import ctx
+
+
+def entries(*xs):
+    return [(f'{t}-0'.encode(), {b'd': orjson.dumps(x) if not isinstance(x, bytes) else x}) for t, x in xs]
+
+
+def test_decode_page():
+    ms, values = agg.decode_page(entries((1, {'a': {'b': [1, 2]}}), (2, {'a': 'x'}), (3, b'not json')), ['a.b.1', 'a'])
+    assert ms.tolist() == [1, 2, 3]
+    assert values[0, 0] == 2
+    assert np.isnan(values[1:, 0]).all() and np.isnan(values[:, 1]).all()
+
+
+def test_reduce_buckets():
+    ms = np.array([0, 5, 9, 20, 25])
+    values = np.array([[1.], [3.], [np.nan], [4.], [np.nan]])
+    idx, stats = agg.reduce_buckets(ms, values, 10)
+    assert idx.tolist() == [0, 2]
+    assert stats['count'][:, 0].tolist() == [2, 1]
+    assert stats['min'][:, 0].tolist() == [1, 4]
+    assert stats['max'][:, 0].tolist() == [3, 4]
+    assert stats['mean'][:, 0].tolist() == [2, 4]
+    assert stats['last'][:, 0].tolist() == [3, 4]
+
+
+def test_aggregate_window_and_cache(fake_redis):
+    async def main():
+        for t in range(1000, 5000, 100):
+            await ctx.r.xadd('agg', {'d': orjson.dumps({'v': t})}, f'{t}-0')
+        full = await agg.aggregate('agg', ['v'], 1000)
+        assert full['buckets'] == [1000, 2000, 3000, 4000]
+        assert full['fields']['v']['count'] == [10, 10, 10, 10]
+        # the completed buckets are cached, but partial buckets at the window edges aren't used
+        assert await agg.aggregate('agg', ['v'], 1000) == full
+        part = await agg.aggregate('agg', ['v'], 1000, start='1500', end='3200')
+        assert part['fields']['v']['count'] == [5, 10, 3]
+        assert part['fields']['v']['max'] == [1900, 2900, 3200]
+    asyncio.run(main())
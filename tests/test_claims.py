@@ -0,0 +1,18 @@
+import asyncio
+
+from redis_streamer import claims, metrics
+
+
+def test_own(fake_redis, monkeypatch):
+    async def main():
+        assert await claims.own('job:owner', 1)
+        assert await fake_redis.r.ttl('job:owner') == 4
+        await fake_redis.r.expire('job:owner', 1)
+        assert await claims.own('job:owner', 1)  # renewed
+        assert await fake_redis.r.ttl('job:owner') == 4
+
+        monkeypatch.setattr(metrics, 'WORKER_ID', 'someone-else')
+        assert not await claims.own('job:owner', 1)
+        await fake_redis.r.delete('job:owner')  # the owner went away
+        assert await claims.own('job:owner', 1)
+    asyncio.run(main())
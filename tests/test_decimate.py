@@ -0,0 +1,20 @@
+import pytest
+from redis_streamer.decimate import bucket_width, bucket_end, MAX_SEQ
+
+
+def test_bucket_width():
+    assert bucket_width(hz=2) == 500
+    assert bucket_width(bucket=250) == 250
+    assert bucket_width() is None
+    with pytest.raises(ValueError):
+        bucket_width(hz=1, bucket=1000)
+    for kw in ({'hz': 0}, {'hz': -2}, {'bucket': -250}, {'bucket': float('nan')}):
+        with pytest.raises(ValueError):
+            bucket_width(**kw)
+
+
+def test_bucket_end():
+    assert bucket_end('1999-3', 1000) == f'1999-{MAX_SEQ}'
+    assert bucket_end('2000-0', 1000) == f'2999-{MAX_SEQ}'
+    # fractional widths (e.g. 3 Hz) round up to whole milliseconds
+    assert bucket_end('0-0', 1000 / 3) == f'333-{MAX_SEQ}'
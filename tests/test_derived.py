@@ -0,0 +1,40 @@
+import pytest
+from redis_streamer import derived
+
+
+def upper(entries):
+    return [data.upper() if sid.endswith('a') else data.decode() for sid, t, data in entries]
+
+
+def test_resolve():
+    assert derived.resolve(f'{__name__}:upper') is upper
+    assert derived.resolve('os.path:join') is not None
+    with pytest.raises(ValueError):
+        derived.resolve('no-such-transform')
+    with pytest.raises(AttributeError):
+        derived.resolve(f'{__name__}:missing')
+
+
+def test_run_transform():
+    out, seconds = derived.run_transform(f'{__name__}:upper', [('a', '1-0', b'x'), ('b', '1-0', b'y')])
+    assert out == [b'X', b'y']  # strings are encoded
+    assert seconds >= 0
+
+
+def test_check_allowed(monkeypatch):
+    monkeypatch.setattr(derived, 'DERIVED_TRANSFORM_MODULES', ['my_package'])
+    derived.check_allowed('thumbnail')  # entry points are always allowed
+    derived.check_allowed('my_package:f')
+    derived.check_allowed('my_package.transforms:f')
+    for spec in ['os:system', 'my_package_evil:f']:
+        with pytest.raises(ValueError):
+            derived.check_allowed(spec)
+
+
+def test_reset_pool_only_once():
+    broken = derived.get_pool()
+    derived.reset_pool(broken)
+    replacement = derived.get_pool()
+    derived.reset_pool(broken)  # another runner seeing the same broken pool
+    assert derived._pool is replacement
+    derived.reset_pool(replacement)
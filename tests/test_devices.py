@@ -128,7 +128,10 @@ query GetEverythingDevices {
 }
     ''', {}) == {'data': {'devices': [{'streamIds': ['zxcv'], 'id': 'asdf', 'meta': {'x': 1}, 'streams': [
         {'id': 'zxcv', 'length': 2, 'entriesAdded': 2, 'error': '', 'firstEntryData': 'eyJ4IjogMn0=', 'firstEntryJson': {'x': 2}, 'firstEntryString': '{"x": 2}', 'groups': 0, 'lastEntryData': 'eyJ4IjogM30=', 'lastEntryJson': {'x': 3}, 'lastEntryString': '{"x": 3}', 'meta': {}, 'radixTreeKeys': 1, 'radixTreeNodes': 2}, 
-        {'id': 'zzzz', 'length': 0, 'entriesAdded': 0, 'error': 'no such key', 'firstEntryData': '', 'firstEntryJson': {}, 'firstEntryString': '', 'groups': 0, 'lastEntryData': '', 'lastEntryJson': {}, 'lastEntryString': '', 'meta': {'x': 1, 'z': 3}, 'radixTreeKeys': 0, 'radixTreeNodes': 0}]}]}}
+        {'id': 'zzzz', 'length': 0, 'entriesAdded': 0, 'error': 'no such key', 'firstEntryData': '', 'firstEntryJson': {}, 'firstEntryString': '', 'groups': 0, 'lastEntryData': '', 'lastEntryJson': {}, 'lastEntryString': '', 'meta': {'x': 1, 'z': 3}, 'radixTreeKeys': 0, 'radixTreeNodes': 0}]},
+        # pushing data marks the device as connected
+        {'streamIds': ['xxxx'], 'id': 'default', 'meta': {}, 'streams': [
+        {'id': 'xxxx', 'length': 2, 'entriesAdded': 2, 'error': '', 'firstEntryData': 'eyJ4IjogNX0=', 'firstEntryJson': {'x': 5}, 'firstEntryString': '{"x": 5}', 'groups': 0, 'lastEntryData': 'eyJ4IjogNn0=', 'lastEntryJson': {'x': 6}, 'lastEntryString': '{"x": 6}', 'meta': {}, 'radixTreeKeys': 1, 'radixTreeNodes': 2}]}]}}
 
 
 
@@ -137,7 +140,7 @@ query GetStreams {
     streams { id length }
 }
     ''', {}) == {   "data": {     "streams": [       
-        {         "id": ":event:device.connected",         "length": 2       },       
+        {         "id": ":event:device.connected",         "length": 3       },       
         {         "id": ":event:device.meta",         "length": 2       },       
         {         "id": "asdf:zxcv",         "length": 2       },       
         {         "id": "asdf:zzzz",         "length": 0       },       
@@ -157,6 +160,8 @@ query GetDeviceStreams {
     ''', {}) == {   "data": {     "devices": [       {         "streams": [           
         {             "id": "zxcv",             "length": 2,             "firstEntryJson": {"x": 2},             "lastEntryJson": {"x": 3}           },           
         {             "id": "zzzz",             "length": 0,             "firstEntryJson": {},             "lastEntryJson": {}           }         
+    ]       },       {         "streams": [           
+        {             "id": "xxxx",             "length": 2,             "firstEntryJson": {"x": 5},             "lastEntryJson": {"x": 6}           }         
     ]       }     ]   } }
 
     assert run_graphql('''
@@ -175,6 +180,6 @@ query GetStreams {
         streams { id }
     }
 }
-    ''', {}) == {   "data": {     "devices": [       {         "id": "asdf",         "streams": []       }     ]   } }
+    ''', {}) == {   "data": {     "devices": [       {         "id": "asdf",         "streams": []       },       {         "id": "default",         "streams": [{ "id": "xxxx" }]       }     ]   } }
 
 
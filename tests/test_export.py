@@ -0,0 +1,54 @@
+import io
+import asyncio
+import orjson
+import numpy as np
+import pytest
+from redis_streamer import export
+from redis_streamer.core import ctx
+
+
+def run_export(**kw):
+    async def main():
+        for t in range(1000, 3000, 100):
+            await ctx.r.xadd('exp', {'d': orjson.dumps({'v': t, 'label': f'x{t}'}), 'g': 'a+b'}, f'{t}-0')
+        await ctx.r.xadd('exp', {'d': b'not json'}, '3000-0')
+        return b''.join([x async for x in export.export('exp', **kw)])
+    return asyncio.run(main())
+
+
+def test_parse_fields():
+    assert export.parse_fields(['pose.x', 'label:str']) == [('pose.x', ('pose', 'x'), 'float'), ('label', ('label',), 'str')]
+    with pytest.raises(ValueError):
+        export.parse_fields(['label:bytes'])
+
+
+def test_npz(fake_redis, monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_PAGE_SIZE', 7)
+    f = np.load(io.BytesIO(run_export(format='npz', fields=['v', 'label:str'], meta=['g'], start='1500', end='3000')))
+    assert f['ms'].tolist() == list(range(1500, 3001, 100))
+    assert f['v'][:2].tolist() == [1500, 1600] and np.isnan(f['v'][-1])
+    assert f['label'][0] == 'x1500' and f['label'][-1] == ''
+    assert f['g'][0] == 'a+b'
+    data = bytes(f['data'])
+    assert data[f['data_offsets'][-2]:f['data_offsets'][-1]] == b'not json'
+
+
+def test_npz_spilled_in_chunks(fake_redis, monkeypatch):
+    monkeypatch.setattr(export, 'NPZ_CHUNK_SIZE', 16)
+    f = np.load(io.BytesIO(run_export(format='npz', fields=['label:str'], meta=['g'])))
+    assert f['label'].tolist() == [f'x{t}' for t in range(1000, 3000, 100)] + ['']
+    assert f['data_offsets'][-1] == len(f['data'])
+
+
+def test_npz_decimated(fake_redis):
+    f = np.load(io.BytesIO(run_export(format='npz', payload=False, width=500, count=3)))
+    assert f['ms'].tolist() == [1000, 1500, 2000]
+    assert 'data' not in f
+
+
+def test_arrow(fake_redis):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.ipc
+    table = pa.ipc.open_stream(run_export(format='arrow', fields=['v'], end='1200')).read_all()
+    assert table.column('ms').to_pylist() == [1000, 1100, 1200]
+    assert table.column('v').to_pylist() == [1000, 1100, 1200]
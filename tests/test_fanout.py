@@ -0,0 +1,18 @@
+import asyncio
+from redis_streamer import fanout
+
+
+def test_fanout_replaces_dead_reader(fake_redis):
+    async def main():
+        async def fail():
+            raise RuntimeError('boom')
+        dead = fanout.SharedReader({'a': '$'}, block=100)
+        dead.task = asyncio.create_task(fail())
+        await asyncio.gather(dead.task, return_exceptions=True)
+        key = (('a',), False, 1, 100, None)
+        fanout.readers[key] = dead
+        async with fanout.subscribe({'a': '$'}, block=100):
+            assert fanout.readers[key] is not dead
+            assert not fanout.readers[key].task.done()
+        assert key not in fanout.readers
+    asyncio.run(main())
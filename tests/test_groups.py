@@ -0,0 +1,31 @@
+from redis_streamer.groups import GroupBuffer
+
+
+def entry(g=None):
+    return {b'd': b'x', **({b'g': g} if g else {})}
+
+
+def test_group_buffer():
+    buf = GroupBuffer(['a', 'b'])
+    # half a group is held back, ungrouped entries go straight through
+    assert buf.add([('a', [('1-0', entry(b'a+b+c'))]), ('c', [('1-1', entry())])]) == [('c', [('1-1', entry())])]
+    assert buf.add([('b', [('1-0', entry(b'a+b+c'))])]) == [
+        ('a', [('1-0', entry(b'a+b+c'))]), ('b', [('1-0', entry(b'a+b+c'))])]
+    assert not buf.pending
+
+
+def test_group_buffer_drops_incomplete():
+    buf = GroupBuffer(['a', 'b'])
+    assert buf.add([('a', [('1-0', entry(b'a+b'))])]) == []
+    # b moved past 1-0 without it, so that group can never complete
+    assert buf.add([('b', [('2-0', entry(b'a+b'))])]) == []
+    assert buf.dropped == 1
+    assert list(buf.pending) == ['2-0']
+
+
+def test_check_group(fake_redis):
+    import pytest
+    from redis_streamer.groups import check_group
+    check_group(['dev:a', 'dev:b'])
+    with pytest.raises(ValueError):
+        check_group(['dev:a', 'dev:a'])
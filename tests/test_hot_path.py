@@ -0,0 +1,99 @@
+import os
+import json
+import pytest
+
+from redis_streamer import utils
+from redis_streamer.core import Agent, decode_xread_format
+from redis_streamer.routes.data_ws import parse_offsets, get_meta, get_data_from_offsets
+from redis_streamer.routes.mux_ws import pack_channel_frame, unpack_channel_frame, merge_cursors
+import microbenchmark
+
+
+def test_decode_xread_format():
+    raw = [(b'a', [(b'1-0', {b'd': b'x'})]), ('b', [('2-0', {b'd': b'y'})])]
+    assert decode_xread_format(raw) == [('a', [('1-0', {b'd': b'x'})]), ('b', [('2-0', {b'd': b'y'})])]
+
+
+def test_pack_entries():
+    offsets, content = utils.pack_entries([
+        ('a', [('1-0', {b'd': b'xx'}), ('1-1', {b'd': b'y'})]),
+        ('b', [('2-0', {b'd': b'zzz'})]),
+    ])
+    assert offsets == [('a', '1-0', 2), ('a', '1-1', 3), ('b', '2-0', 6)]
+    assert content == b'xxyzzz'
+
+
+def test_frame():
+    frame = utils.pack_frame([{'cmd': 'xadd', 'size': 3}], b'abc')
+    header, data = utils.unpack_frame(frame)
+    assert header == [{'cmd': 'xadd', 'size': 3}]
+    assert bytes(data) == b'abc'
+    assert utils.unpack_frame(utils.pack_frame({}))[0] == {}
+
+
+def test_channel_frame():
+    channel, offsets, data = unpack_channel_frame(pack_channel_frame(513, [['a', '1-0', 2]], b'xy'))
+    assert (channel, offsets, bytes(data)) == (513, [['a', '1-0', 2]], b'xy')
+
+
+def test_merge_cursors():
+    assert merge_cursors([{'a': '5-10', 'b': '1-0'}, {'a': '5-9'}]) == {'a': '5-9', 'b': '1-0'}
+
+
+def test_take_entries():
+    from types import SimpleNamespace
+    from redis_streamer.routes.mux_ws import take_entries
+    results = [('a', [(f'5-{i}', {}) for i in range(5)]), ('b', [('6-0', {})])]
+    sub = SimpleNamespace(cursor={'a': '5-1'}, count=2, latest=False)
+    assert take_entries(sub, results) == [('a', [('5-2', {}), ('5-3', {})])]
+    assert sub.cursor == {'a': '5-3'}
+    sub = SimpleNamespace(cursor={'a': '5-1', 'b': '6-0'}, count=1, latest=True)
+    assert take_entries(sub, results) == [('a', [('5-4', {})])]
+    assert sub.cursor == {'a': '5-4', 'b': '6-0'}
+
+
+def test_parse_offsets():
+    assert parse_offsets([3, 5], ['a', 'b']) == (['a', 'b'], (None, None), [3, 5])
+    assert parse_offsets([['a', 3], ['b', 5]], []) == (('a', 'b'), (None, None), (3, 5))
+    assert parse_offsets([['a', '1-0', 3], ['b', '*', 5]], []) == (('a', 'b'), ('1-0', '*'), (3, 5))
+    header = [['a', '1-0', 3, {'keyframe': True}], ['b', '*', 5]]
+    assert parse_offsets(header, []) == (('a', 'b'), ('1-0', '*'), (3, 5))
+    assert get_meta(header) == [{'keyframe': True}, None]
+    assert get_meta([['a', 3]]) is None
+    with pytest.raises(ValueError):
+        parse_offsets([3, 5], ['a'])
+
+
+def test_get_data_from_offsets():
+    assert get_data_from_offsets(b'xxyzzz', [2, 3, 6]) == [b'xx', b'y', b'zzz']
+    assert get_data_from_offsets(b'xxyzzz', [0, 2, 3]) == [b'xx', b'y', b'zzz']
+    assert get_data_from_offsets(b'xxyzzz', []) == [b'xxyzzz']
+
+
+def test_cursor():
+    agent = Agent()
+    cursor = agent.init_cursor(['a', 'b'], prefix='dev:')
+    assert list(cursor) == ['dev:a', 'dev:b']
+    assert all(utils.parse_entry_id(t) for t in cursor.values())
+    assert agent.init_cursor({'a': '0-0'}) == {'a': '0-0'}
+
+    # sequence numbers don't sort as strings
+    data = [('a', [('5-9', {}), ('5-10', {})]), ('b', []), ('c', [('7-10', {}), ('7-9', {})])]
+    assert agent.update_cursor({'a': '0', 'b': '1-0', 'c': '0'}, data) == {'a': '5-10', 'b': '1-0', 'c': '7-10'}
+
+
+def test_microbenchmarks_run():
+    results = microbenchmark.measure_all('[imu-1x100]', 'init_cursor[1]', min_time=0.001)
+    assert results and all(r['ops_per_sec'] > 0 for r in results.values())
+
+
+@pytest.mark.skipif(not os.getenv('RUN_BENCHMARKS'), reason='set RUN_BENCHMARKS=1 to check performance against the baseline')
+def test_no_regressions():
+    with open(microbenchmark.BASELINE) as f:
+        baseline = json.load(f)['results']
+    regressions = microbenchmark.compare(
+        microbenchmark.measure_all(),
+        baseline,
+        speed_threshold=float(os.getenv('BENCHMARK_SPEED_THRESHOLD') or 0.3),
+        alloc_threshold=float(os.getenv('BENCHMARK_ALLOC_THRESHOLD') or 0.1))
+    assert not regressions, '\n'.join(regressions)
@@ -0,0 +1,38 @@
+import pytest
+from redis_streamer.join import Joiner
+
+
+def entries(*ts):
+    return [(f'{t}-0', {b'd': str(t).encode()}) for t in ts]
+
+
+def aligned(out):
+    return [(s, t) for s, xs in out for t, _ in xs]
+
+
+def test_nearest():
+    j = Joiner(['main', 'depth'], 'nearest', tolerance=20)
+    # depth hasn't moved past 100 yet, so a closer match could still come
+    assert j.add([('main', entries(100)), ('depth', entries(90))]) == []
+    assert aligned(j.add([('depth', entries(105, 130))])) == [('main', '100-0'), ('depth', '105-0')]
+
+
+def test_asof():
+    j = Joiner(['main', 'depth'], 'asof', tolerance=20)
+    out = j.add([('main', entries(100, 120)), ('depth', entries(90, 105, 130))])
+    assert aligned(out) == [('main', '100-0'), ('depth', '90-0'), ('main', '120-0'), ('depth', '105-0')]
+
+
+def test_no_match_is_dropped():
+    j = Joiner(['main', 'depth'], 'nearest', tolerance=5)
+    assert j.add([('main', entries(100, 200)), ('depth', entries(150))]) == []
+    assert j.dropped == 1
+    assert aligned(j.add([], flush=True)) == []
+    assert j.dropped == 2
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        Joiner(['main'])
+    with pytest.raises(ValueError):
+        Joiner(['main', 'depth'], 'closest')
@@ -0,0 +1,43 @@
+import orjson
+import pytest
+from redis_streamer.jsonfilter import JsonFilter, compile_predicate
+
+
+DOC = {'label': 'car', 'confidence': 0.8, 'box': [10, 20, 30, 40], 'attrs': {'0': 'x'}}
+
+
+@pytest.mark.parametrize('expr, expected', [
+    ('confidence > 0.5', True),
+    ('confidence<=0.5', False),
+    ('label == "car"', True),
+    ('label == car', True),
+    ('label != car', False),
+    ('label in ["car", "bus"]', True),
+    ('label not in ["car"]', False),
+    ('box.0 >= 10', True),
+    ('box.-1 == 40', True),
+    ('attrs.0 == x', True),
+    ('label > 1', False),  # a string and a number never compare
+    ('track_id exists', False),
+    ('track_id missing', True),
+    ('missing.path == null', False),
+])
+def test_predicates(expr, expected):
+    assert compile_predicate(expr)(DOC) is expected
+
+
+@pytest.mark.parametrize('expr', ['confidence', 'label in "car"', 'label exists 1', 'a >'])
+def test_invalid_predicates(expr):
+    with pytest.raises(ValueError):
+        compile_predicate(expr)
+
+
+def test_apply():
+    f = JsonFilter(['label', 'box.1'], ['confidence > 0.5'])
+    entries = [('1-0', {b'd': orjson.dumps(DOC)}), ('2-0', {b'd': orjson.dumps({**DOC, 'confidence': 0.1})}), ('3-0', {b'd': b'\xff'})]
+    (sid, xs), = f.apply([('det', entries)])
+    assert [t for t, _ in xs] == ['1-0']
+    assert orjson.loads(xs[0][1][b'd']) == {'label': 'car', 'box.1': 20}
+    # the original entry (shared with other readers) is left alone
+    assert orjson.loads(entries[0][1][b'd']) == DOC
+    assert not JsonFilter()
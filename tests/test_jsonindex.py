@@ -0,0 +1,93 @@
+import asyncio
+import orjson
+import pytest
+from redis_streamer import jsonindex
+from redis_streamer.core import ctx
+from redis_streamer.config import STREAM_META_PREFIX
+
+
+def test_parse_index():
+    assert jsonindex.parse_index({'dtype': 'uint8'}) is None
+    assert [f for f, _ in jsonindex.parse_index({'index': ['label', 'box.0']})] == ['label', 'box.0']
+    with pytest.raises(ValueError):
+        jsonindex.parse_index({'index': 'label'})
+    assert jsonindex.encode_value(3.0) == jsonindex.encode_value(3) == '3'
+
+
+def test_search(fake_redis):
+    async def main():
+        await ctx.r.set(f'{STREAM_META_PREFIX}:dets', orjson.dumps({'index': ['label', 'tags']}))
+        docs = [
+            {'label': 'car', 'score': 0.9},
+            {'label': 'person', 'score': 0.4, 'tags': ['a', 'b']},
+            {'label': 'car', 'score': 0.2, 'tags': ['b']},
+            {'label': 'dog'},
+        ]
+        data = [orjson.dumps(d) for d in docs] + [b'not json']
+        ids = [await ctx.r.xadd('dets', {'d': x}, f'{t}-0') for t, x in enumerate(data, 1)]
+        assert await jsonindex.add(['dets'] * 5, ids, data) == 7
+
+        async def search(*where, **kw):
+            return [
+                (t, orjson.loads(x[b'd'])) for _, xs in await jsonindex.search('dets', list(where), **kw) for t, x in xs]
+
+        assert [t for t, _ in await search('label == car')] == ['1-0', '3-0']
+        assert [t for t, _ in await search('label == car', 'score > 0.5')] == ['1-0']
+        assert [t for t, _ in await search('label in ["dog", "person"]', latest=True, count=1)] == ['4-0']
+        assert [t for t, _ in await search('tags == b', 'label == car')] == ['3-0']
+        assert [t for t, _ in await search('label == car', start='2')] == ['3-0']
+        assert await search('label == car', fields=['score']) == [('1-0', {'score': 0.9}), ('3-0', {'score': 0.2})]
+        with pytest.raises(ValueError):
+            await search('score > 0.5')
+
+        # postings of trimmed entries are dropped
+        await ctx.r.xtrim('dets', minid='3')
+        assert [t for t, _ in await search('label == car')] == ['3-0']
+        assert await jsonindex.trim('dets') == 4
+        assert not await ctx.r.exists('%s:dets:label="person"' % jsonindex.INDEX_PREFIX)
+        await jsonindex.drop('dets')
+        assert await ctx.r.keys(f'{jsonindex.INDEX_PREFIX}*') == []
+    asyncio.run(main())
+
+
+def test_search_pages(fake_redis, monkeypatch):
+    monkeypatch.setattr(jsonindex, 'INDEX_PAGE_SIZE', 3)
+    monkeypatch.setattr(jsonindex, 'INDEX_TRIM_BATCH', 1)
+
+    async def main():
+        await ctx.r.set(f'{STREAM_META_PREFIX}:dets', orjson.dumps({'index': ['label', 'cam']}))
+        docs = [{'label': ['car', 'dog', 'cat'][i % 3], 'cam': i % 2} for i in range(30)]
+        data = [orjson.dumps(d) for d in docs]
+        ids = [await ctx.r.xadd('dets', {'d': x}, f'{t}-{t % 2}') for t, x in enumerate(data, 1)]
+        await jsonindex.add(['dets'] * 30, ids, data)
+
+        async def search(*where, **kw):
+            return [t for _, xs in await jsonindex.search('dets', list(where), **kw) for t, x in xs]
+
+        expected = [f'{i + 1}-{(i + 1) % 2}' for i, d in enumerate(docs) if d['label'] in ('car', 'cat') and d['cam'] == 1]
+        assert await search('label in ["car", "cat"]', 'cam == 1', count=100) == expected
+        assert await search('label in ["car", "cat"]', 'cam == 1', count=4) == expected[:4]
+        assert await search('label in ["car", "cat"]', 'cam == 1', count=4, latest=True) == expected[-4:]
+        await ctx.r.xtrim('dets', minid='11')
+        assert await jsonindex.trim('dets') == 20
+    asyncio.run(main())
+
+
+def test_trim_in_background(fake_redis, monkeypatch):
+    monkeypatch.setattr(jsonindex, 'INDEX_TRIM_INTERVAL', 0)
+    calls = []
+
+    async def slow_trim(sid):
+        calls.append(sid)
+        await asyncio.sleep(10)
+    monkeypatch.setattr(jsonindex, 'trim', slow_trim)
+
+    async def main():
+        await ctx.r.set(f'{STREAM_META_PREFIX}:dets', orjson.dumps({'index': ['label']}))
+        for t in (1, 2):
+            data = orjson.dumps({'label': 'car'})
+            await ctx.r.xadd('dets', {'d': data}, f'{t}-0')
+            await asyncio.wait_for(jsonindex.add(['dets'], [f'{t}-0'], [data]), 1)
+            await asyncio.sleep(0)
+        assert calls == ['dets']  # still running, so not started again
+    asyncio.run(main())
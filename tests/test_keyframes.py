@@ -0,0 +1,29 @@
+import asyncio
+from redis_streamer import keyframes
+from redis_streamer.core import ctx
+
+
+def test_entry_id_before():
+    assert keyframes.entry_id_before('5-1') == '5-0'
+    assert keyframes.entry_id_before('5-0') == f'4-{2**64 - 1}'
+
+
+def test_last_keyframe(fake_redis):
+    async def main():
+        ids = [await ctx.r.xadd('video', {'d': b'x'}, f'{t}-0') for t in range(1, 8)]
+        metas = [{'keyframe': t % 3 == 1} for t in range(1, 8)]  # 1, 4, 7
+        assert await keyframes.add(['video'] * 7, ids, metas) == 3
+        cursor = await keyframes.resolve_cursor({'video': 'last_keyframe', 'audio': 'last_keyframe', 'imu': '0'})
+        assert cursor == {'video': f'6-{2**64 - 1}', 'audio': '$', 'imu': '0'}
+        # trimmed past the last keyframe
+        await ctx.r.xtrim('video', minid='8')
+        assert await keyframes.last(['video']) == {}
+    asyncio.run(main())
+
+
+def test_same_millisecond_order(fake_redis):
+    async def main():
+        ids = [await ctx.r.xadd('video', {'d': b'x'}, f'5-{i}') for i in range(11)]
+        assert await keyframes.add(['video'] * 2, [ids[9], ids[10]], [{'keyframe': True}] * 2) == 2
+        assert await keyframes.last(['video']) == {'video': '5-10'}
+    asyncio.run(main())
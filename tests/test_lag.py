@@ -0,0 +1,34 @@
+from redis_streamer.lag import estimate_behind
+
+
+def test_estimate_behind():
+    info = {'length': 100, 'first-entry': (b'1000-0', {}), 'last-entry': (b'2000-0', {})}
+    assert estimate_behind('2000-0', info) == (0, '2000-0')
+    assert estimate_behind('999-0', info) == (100, '2000-0')
+    assert estimate_behind('1500-0', info) == (50, '2000-0')
+    assert estimate_behind('1999-5', info) == (1, '2000-0')
+    assert estimate_behind('0', {'length': 0}) == (0, None)
+
+
+def test_lag_metrics_by_route(fake_redis):
+    import asyncio
+    from fakeredis import FakeAsyncRedis, FakeServer
+    from redis_streamer import lag
+    from redis_streamer.core import ctx
+
+    async def main():
+        for t in range(1, 11):
+            await ctx.r.xadd('lag', {'d': b'x'}, f'{t * 1000}-0')
+        a, b = lag.Consumer('pull'), lag.Consumer('pull')
+        await a.check_lag({'lag': '10000-0'})
+        await b.check_lag({'lag': '0-1'})
+        assert lag.entries_behind.values == {('pull', 'lag'): 10}
+        await b.close()
+        assert lag.entries_behind.values == {('pull', 'lag'): 0}
+        await a.close()
+        assert lag.entries_behind.values == {}
+        server = FakeServer()
+        server.connected = False  # redis is gone: closing still works
+        ctx.set_shards({'fake': FakeAsyncRedis(server=server)})
+        await lag.Consumer('pull').close()
+    asyncio.run(main())
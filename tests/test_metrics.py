@@ -0,0 +1,9 @@
+from redis_streamer import metrics
+
+
+def test_metric_label_escaping():
+    c = metrics.Counter('test_escaping_total', 'Test.', ('stream',))
+    c.inc('a"b\\c\nd')
+    series = list(c.collect())
+    assert series == ['redis_streamer_test_escaping_total{stream="a\\"b\\\\c\\nd"}']
+    metrics.registry.pop(c.name)
@@ -0,0 +1,47 @@
+import asyncio
+import orjson
+
+from redis_streamer.config import STREAM_REGISTRY_KEY
+from redis_streamer.core import register_streams, STREAM_CREATED_EVENT, _registered
+from redis_streamer.patterns import PatternCursor, match_streams
+
+
+async def created_events(r, start, latest):
+    xs = [(t.decode(), x) for t, x in await r.xrange(STREAM_CREATED_EVENT, start)]
+    return [(STREAM_CREATED_EVENT, xs[-1:] if latest else xs)]
+
+
+def test_new_streams_from_events(fake_redis):
+    async def main():
+        for latest in [False, True]:
+            _registered.clear()
+            await fake_redis.r.delete(STREAM_REGISTRY_KEY, STREAM_CREATED_EVENT)
+            await register_streams(['cam1'])
+            watcher = PatternCursor(['cam*', '*'], latest=latest)
+            cursor = await watcher.init({})
+            assert set(cursor) == {'cam1', STREAM_CREATED_EVENT}
+
+            # streams come from the event payloads, not by re-reading the registry
+            await fake_redis.r.sadd(STREAM_REGISTRY_KEY, 'cam-unannounced')
+            await register_streams(['cam2', 'mic', ':internal'])
+            # with latest=True the read only returns the newest event
+            results = await created_events(fake_redis.r, cursor[STREAM_CREATED_EVENT], latest)
+            assert await watcher.update(cursor, results) == []
+            assert set(cursor) == {'cam1', 'cam2', 'mic', STREAM_CREATED_EVENT}
+            assert cursor['cam2'] == '0-0'
+
+            # events that were already handled don't add anything
+            cursor.pop('mic')
+            await watcher.update(cursor, results)
+            assert 'mic' not in cursor
+    asyncio.run(main())
+
+
+def test_internal_streams_need_colon_pattern(fake_redis):
+    async def main():
+        _registered.clear()
+        await register_streams(['cam1'])
+        await fake_redis.r.xadd(':event:x', {b'd': orjson.dumps({})})
+        assert await match_streams(['*'], scan=True) == {'cam1'}
+        assert await match_streams([':event:*'], scan=True) == {':event:x', STREAM_CREATED_EVENT}
+    asyncio.run(main())
@@ -0,0 +1,11 @@
+import pytest
+from redis_streamer.routes.prompt_ws import prefix_command
+
+
+def test_prefix_command():
+    assert prefix_command({'cmd': 'xlen', 'sid': 'camera'}, 'dev:') == {'cmd': 'xlen', 'sid': 'dev:camera'}
+    assert prefix_command({'cmd': 'xread', 'sids': {'a': '0'}}, 'dev:')['sids'] == {'dev:a': '0'}
+    with pytest.raises(ValueError):
+        prefix_command({'cmd': 'xlen', 'sid': ':stream:registry'}, '')
+    with pytest.raises(ValueError):
+        prefix_command(['xlen'], '')
@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+from redis_streamer import relay
+from redis_streamer.core import ctx, Agent
+
+
+def test_persist_keeps_pending_on_error(fake_redis, monkeypatch):
+    async def main():
+        r = relay.Relay('direct')
+        r.publish([b'1', b'2'])
+        add_entries = Agent.add_entries
+        async def fail(self, *a, **kw):
+            raise ConnectionError('redis is down')
+        monkeypatch.setattr(Agent, 'add_entries', fail)
+        with pytest.raises(ConnectionError):
+            await r.persist()
+        r.publish([b'3'])
+        assert [x[b'd'] for _, x in r.pending] == [b'1', b'2', b'3']
+        monkeypatch.setattr(Agent, 'add_entries', add_entries)
+        await r.persist()
+        assert not r.pending
+        assert [x[b'd'] for _, x in await ctx.r.xrange('direct')] == [b'1', b'2', b'3']
+    asyncio.run(main())
+
+
+def test_pending_is_bounded(fake_redis, monkeypatch):
+    monkeypatch.setattr(relay, 'DIRECT_MAX_PENDING_BYTES', 3)
+
+    async def main():
+        r = relay.Relay('direct')
+        r.publish([b'12', b'34'])
+        assert r.pending_bytes == 4
+        add_entries = Agent.add_entries
+        async def fail(self, *a, **kw):
+            raise ConnectionError('redis is down')
+        monkeypatch.setattr(Agent, 'add_entries', fail)
+        waiting = asyncio.create_task(r.wait_for_room())
+        with pytest.raises(ConnectionError):
+            await r.persist()
+        await asyncio.sleep(0)
+        assert not waiting.done() and r.pending_bytes == 4
+        monkeypatch.setattr(Agent, 'add_entries', add_entries)
+        await r.persist()
+        await asyncio.wait_for(waiting, 1)
+        assert r.pending_bytes == 0
+    asyncio.run(main())
+
+
+def test_persist_indexes_entries(fake_redis):
+    import orjson
+    from redis_streamer import jsonindex
+    from redis_streamer.config import STREAM_META_PREFIX
+
+    async def main():
+        await ctx.r.set(f'{STREAM_META_PREFIX}:dets', orjson.dumps({'index': ['label']}))
+        r = relay.Relay('dets')
+        ids = r.publish([orjson.dumps({'label': 'car'}), orjson.dumps({'label': 'dog'})])
+        await r.persist()
+        assert [t for _, xs in await jsonindex.search('dets', ['label == car']) for t, _ in xs] == ids[:1]
+    asyncio.run(main())
+
+
+def test_broadcast_to_slow_subscribers():
+    latest, everything = asyncio.Queue(2), asyncio.Queue(2)
+    queues = {latest: True, everything: False}
+    for i in range(3):
+        relay.broadcast(queues, i)
+    assert [latest.get_nowait() for _ in range(2)] == [1, 2]
+    assert everything.get_nowait() is relay.BEHIND
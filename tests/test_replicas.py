@@ -0,0 +1,9 @@
+import pytest
+from redis_streamer.core import check_consistency
+
+
+def test_check_consistency():
+    check_consistency(None)
+    check_consistency('replica')
+    with pytest.raises(ValueError):
+        check_consistency('primay')
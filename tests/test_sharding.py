@@ -0,0 +1,60 @@
+from redis_streamer.sharding import HashRing, shard_key
+
+
+def test_device_streams_are_colocated():
+    assert shard_key('dev1:main') == shard_key('dev1:depth') == 'dev1'
+    assert shard_key('main') == 'main'
+
+
+def test_ring_balance_and_stability():
+    devices = [f'device{i}' for i in range(3000)]
+    ring = HashRing(['a', 'b', 'c'])
+    before = [ring.get(d) for d in devices]
+    for n in range(3):
+        assert 700 < before.count(n) < 1300
+
+    # adding a node should only move keys onto the new node
+    after = [HashRing(['a', 'b', 'c', 'd']).get(d) for d in devices]
+    moved = [(x, y) for x, y in zip(before, after) if x != y]
+    assert all(y == 3 for x, y in moved)
+    assert len(moved) < len(devices) / 3
+
+
+def test_ring_cache_is_bounded(monkeypatch):
+    from redis_streamer import sharding
+    monkeypatch.setattr(sharding, 'CACHE_SIZE', 10)
+    ring = HashRing(['a', 'b'])
+    for i in range(25):
+        ring.get(f'device{i}')
+    assert len(ring._cache) <= 10
+
+
+def test_sharded_read_keeps_waiting_reads(fake_redis):
+    import asyncio
+    from fakeredis import FakeAsyncRedis, FakeServer
+    from redis_streamer.core import ctx, Agent
+
+    async def main():
+        ctx.set_shards({'a': FakeAsyncRedis(server=FakeServer()), 'b': FakeAsyncRedis(server=FakeServer())})
+        sids = [next(f'dev{i}:x' for i in range(100) if ctx.shard(f'dev{i}:x') is r) for r in ctx.shards]
+        agent = Agent()
+        cursor = {s: '0-1' for s in sids}
+
+        async def write_later(sid, data):
+            await asyncio.sleep(0.05)
+            await ctx.shard(sid).xadd(sid, {'d': data})
+        writer = asyncio.create_task(write_later(sids[0], b'a'))
+        results, cursor = await agent.read(cursor, block=1000)
+        await writer
+        assert [(s, [x[b'd'] for _, x in xs]) for s, xs in results] == [(sids[0], [b'a'])]
+        # the read on the other shard is still waiting, and is picked up next time
+        (_, waiting), = agent._waiting.values()
+        assert not waiting.done()
+        writer = asyncio.create_task(write_later(sids[1], b'b'))
+        results, cursor = await agent.read(cursor, block=1000)
+        assert [(s, [x[b'd'] for _, x in xs]) for s, xs in results] == [(sids[1], [b'b'])]
+        assert waiting.done()
+        await writer
+        for _, task in agent._waiting.values():
+            task.cancel()
+    asyncio.run(main())
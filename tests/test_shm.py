@@ -0,0 +1,63 @@
+from redis_streamer.shm import Ring
+
+
+def test_ring_write_read_wrap(tmp_path):
+    ring = Ring.create(str(tmp_path / 'ring'), capacity=256)
+    reader = ring.reader()
+    for i in range(50):  # wraps around several times
+        ring.write(b'%02d' % i + b'x' * (i % 40))
+        [(view, pos)] = list(reader)
+        assert bytes(view[:2]) == b'%02d' % i
+        assert reader.valid(pos)
+        view.release()
+    assert ring.count == 50
+
+    # another process sees the same data
+    other = Ring.open(ring.path)
+    assert other.capacity == 256 and other.write_pos == ring.write_pos
+
+
+def test_ring_overrun(tmp_path):
+    ring = Ring.create(str(tmp_path / 'ring'), capacity=256)
+    slow = ring.reader(0)
+    for i in range(20):
+        ring.write(b'x' * 30)
+    assert slow.read() is None and slow.dropped == 1
+    ring.write(b'new')
+    view, pos = slow.read()
+    assert bytes(view) == b'new'
+
+
+def test_ring_reservation(tmp_path):
+    from redis_streamer.shm import RESERVE_POS, _u64
+    ring = Ring.create(str(tmp_path / 'ring'), capacity=256)
+    reader = ring.reader()
+    ring.write(b'x' * 30)
+    [(view, pos)] = list(reader)
+    assert reader.valid(pos)
+    # a writer lapping us has claimed the space but hasn't published the record yet
+    _u64.pack_into(ring.mm, RESERVE_POS, pos + 256 + 8)
+    assert ring.write_pos == pos + 40
+    assert not reader.valid(pos)
+    view.release()
+
+
+def test_drain_checks_tensor_spec(fake_redis, tmp_path):
+    import asyncio
+    import orjson
+    from redis_streamer import shm
+    from redis_streamer.core import ctx
+    from redis_streamer.config import STREAM_META_PREFIX
+
+    async def main():
+        await ctx.r.set(f'{STREAM_META_PREFIX}:depth', orjson.dumps({'dtype': 'uint8', 'shape': [4]}))
+        ring = Ring.create(str(tmp_path / 'ring'), capacity=256)
+        for data in [b'1234', b'123', b'5678']:
+            ring.write(data)
+        task = asyncio.create_task(shm.drain('depth', ring))
+        while ring.drain_pos != ring.write_pos:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        assert [x[b'd'] for _, x in await ctx.r.xrange('depth')] == [b'1234', b'5678']
+        assert shm.shm_rejected.values[('depth',)] == 1
+    asyncio.run(main())
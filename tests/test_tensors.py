@@ -0,0 +1,68 @@
+import asyncio
+import orjson
+import numpy as np
+import pytest
+from redis_streamer import tensors
+from redis_streamer.core import ctx
+from redis_streamer.config import STREAM_META_PREFIX
+
+
+def test_parse_spec():
+    assert tensors.parse_spec({'format': 'mp4'}) is None
+    spec = tensors.parse_spec({'dtype': 'float32', 'shape': [2, 3]})
+    assert spec == ('<f4', (2, 3), 24)
+    for meta in [{'dtype': 'float32'}, {'dtype': 'nope', 'shape': [1]}, {'dtype': 'O', 'shape': [1]}, {'dtype': 'u1', 'shape': [-1]}]:
+        with pytest.raises(ValueError):
+            tensors.parse_spec(meta)
+
+
+def test_validate_and_stack(fake_redis):
+    async def main():
+        await ctx.r.set(f'{STREAM_META_PREFIX}:depth', orjson.dumps({'dtype': 'uint16', 'shape': [2, 2]}))
+        await tensors.validate([('depth', b'\0' * 8), ('other', b'x')])
+        with pytest.raises(ValueError):
+            await tensors.validate([('depth', b'\0' * 7)])
+        with pytest.raises(ValueError):
+            await tensors.stack_spec(['depth', 'other'])
+        spec = await tensors.stack_spec(['depth'])
+        results = [('depth', [('1-0', {b'd': np.arange(4, dtype=np.uint16).tobytes()}), ('2-0', {b'd': b'old'})])]
+        results = tensors.fitting(results, spec)
+        header = tensors.stack_header(spec, [('depth', t, 8 * (i + 1)) for i, (t, _) in enumerate(results[0][1])])
+        assert header['shape'] == [1, 2, 2]
+        x = np.frombuffer(results[0][1][0][1][b'd'], dtype=header['dtype']).reshape(header['shape'])
+        assert x[0, 1, 1] == 3
+    asyncio.run(main())
+
+
+def test_validate_stale(fake_redis, monkeypatch):
+    from redis.exceptions import ConnectionError
+    from redis_streamer import streammeta
+    monkeypatch.setattr(streammeta, 'STREAM_META_WAIT', 0.01)
+
+    class Down:
+        async def mget(self, keys):
+            raise ConnectionError('down')
+
+    class Stalled:
+        async def mget(self, keys):
+            await asyncio.sleep(10)
+
+    async def main():
+        await ctx.r.set(f'{STREAM_META_PREFIX}:depth', orjson.dumps({'dtype': 'uint8', 'shape': [4]}))
+        await tensors.validate([('depth', b'\0' * 4)])
+        # expired and redis is down: the cached spec is still used and refreshed in the background
+        tensors._specs.items = {sid: (0, spec) for sid, (_, spec) in tensors._specs.items.items()}
+        ctx.set_shards({'fake': Down()})
+        with pytest.raises(ValueError):
+            await tensors.validate([('depth', b'\0' * 3)], stale=True)
+        await tensors.validate([('new', b'x')], stale=True)  # not cached yet: not checked
+        await asyncio.sleep(0)
+        assert 'new' not in tensors._specs.items
+        with pytest.raises(ConnectionError):
+            await tensors.validate([('depth', b'\0' * 4)])
+        # a stalled redis doesn't hold up writes either (one load per stream at a time)
+        ctx.set_shards({'fake': Stalled()})
+        await asyncio.wait_for(tensors.validate([('new', b'x')], stale=True), 1)
+        await asyncio.wait_for(tensors.validate([('new', b'x'), ('depth', b'\0' * 4)], stale=True), 1)
+        assert len(set(tensors._specs._loading.values())) == 2
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+import os
+import asyncio
+import pytest
+from redis_streamer import wal
+from redis_streamer.core import ctx, Agent
+
+
+def test_log(tmp_path, monkeypatch):
+    monkeypatch.setattr(wal, 'WAL_SEGMENT_SIZE', 256)
+
+    async def main():
+        log = wal.WriteAheadLog(str(tmp_path / 'w'))
+        with pytest.raises(BlockingIOError):
+            wal.WriteAheadLog(str(tmp_path / 'w'))  # locked
+        log.append([('a', None, None, b'x' * 100), ('b', '5-1', {'keyframe': True}, b'y'), ('a', b'', None, b'z' * 300)])
+        assert [os.path.basename(s.path) for s in log.segments] == ['00000001.wal', '00000002.wal']
+        records, position = log.read(2)
+        assert records == [('a', None, None, b'x' * 100), ('b', '5-1', {'keyframe': True}, b'y')]
+        log.commit(position)
+        assert log.backlog == log.segments[-1].end
+        log.close()
+
+        # reopened (e.g. by another worker), it picks up after the last commit
+        log = wal.WriteAheadLog(str(tmp_path / 'w'))
+        records, position = log.read(10)
+        assert records == [('a', None, None, b'z' * 300)]
+        log.commit(position)
+        assert len(log.segments) == 1 and not log.backlog
+        log.close()
+    asyncio.run(main())
+
+
+def test_torn_write(tmp_path):
+    async def main():
+        log = wal.WriteAheadLog(str(tmp_path))
+        log.append([('a', None, None, b'1'), ('a', None, None, b'2')])
+        seg = log.segments[0]
+        seg.mm[seg.end - 1:seg.end] = b'!'  # the second record didn't make it
+        log.close()
+        log = wal.WriteAheadLog(str(tmp_path))
+        assert log.read(10)[0] == [('a', None, None, b'1')]
+        log.close()
+    asyncio.run(main())
+
+
+def test_drain(fake_redis, tmp_path, monkeypatch):
+    monkeypatch.setattr(wal, 'WAL_DIR', str(tmp_path))
+
+    async def main():
+        await ctx.r.xadd('b', {'d': b'old'}, '9-0')
+        log = wal.WriteAheadLog(str(tmp_path / 'dead-worker'))
+        log.append([('a', '7-0', None, b'1'), ('b', '5-0', None, b'too old'), ('a', None, None, b'2')])
+        log.close()
+        await wal.recover()
+        assert [(t, x[b'd']) for t, x in await ctx.r.xrange('a')][0] == (b'7-0', b'1')
+        assert [x[b'd'] for _, x in await ctx.r.xrange('a')] == [b'1', b'2']
+        # 9-0 was written outside the log, so redis rejects 5-0 on its own (and it isn't retried)
+        assert [x[b'd'] for _, x in await ctx.r.xrange('b')] == [b'old']
+        assert not os.path.exists(tmp_path / 'dead-worker')
+    asyncio.run(main())
+
+
+def test_recovery_goes_first(fake_redis, tmp_path, monkeypatch):
+    monkeypatch.setattr(wal, 'WAL_DIR', str(tmp_path))
+
+    async def main():
+        log = wal.WriteAheadLog(str(tmp_path / 'dead-worker'))
+        log.append([('e', '5-0', None, b'1'), ('e', '6-0', None, b'2')])
+        log.close()
+        wal.start()
+        try:
+            await wal.add_entries(Agent(), ['e', 'e'], ['9-0', None], [b'3', b'4'])
+            while wal._log.backlog or os.path.exists(tmp_path / 'dead-worker'):
+                await asyncio.sleep(0.01)
+            assert [x[b'd'] for _, x in await ctx.r.xrange('e')] == [b'1', b'2', b'3', b'4']
+        finally:
+            await wal.stop()
+    asyncio.run(main())
+
+
+def test_drain_groups(fake_redis, tmp_path, monkeypatch):
+    from redis_streamer import keyframes
+
+    async def main():
+        log = wal.WriteAheadLog(str(tmp_path))
+        monkeypatch.setattr(wal, '_log', log)
+        agent = Agent()
+        await wal.add_entries(agent, ['rgb'], [None], [b'1'])
+        assert await wal.add_group(['rgb', 'depth'], [b'2', b'22'], [{'keyframe': True}, None]) == [None, None]
+        await wal.add_entries(agent, ['rgb'], [None], [b'3'])
+        await wal.drain(log, until_empty=True)
+        rgb, depth = await ctx.r.xrange('rgb'), await ctx.r.xrange('depth')
+        assert [x[b'd'] for _, x in rgb] == [b'1', b'2', b'3']
+        assert [(t, x[b'd'], x[b'g']) for t, x in depth] == [(rgb[1][0], b'22', b'rgb+depth')]
+        assert await keyframes.last(['rgb']) == {'rgb': rgb[1][0].decode()}
+        log.close()
+    asyncio.run(main())
+
+
+def test_drain_retries_when_redis_refuses_writes(fake_redis, tmp_path, monkeypatch):
+    from redis import exceptions
+    monkeypatch.setattr(wal, 'WAL_RETRY_INTERVAL', 0)
+    add_entries = Agent.add_entries
+    failures = [exceptions.OutOfMemoryError('command not allowed'), exceptions.ResponseError('BUSY running a script'), RuntimeError('bug')]
+
+    async def flaky(self, *a, **kw):
+        if failures:
+            raise failures.pop(0)
+        return await add_entries(self, *a, **kw)
+    monkeypatch.setattr(Agent, 'add_entries', flaky)
+
+    async def main():
+        log = wal.WriteAheadLog(str(tmp_path))
+        log.append([('c', None, None, b'1'), ('c', None, None, b'2')])
+        await wal.supervise('draining', lambda: wal.drain(log, until_empty=True))
+        assert [x[b'd'] for _, x in await ctx.r.xrange('c')] == [b'1', b'2']
+        assert not failures and not log.backlog
+        log.close()
+    asyncio.run(main())
+    assert wal.unavailable(exceptions.ReadOnlyError('read only')) and not wal.unavailable(exceptions.ResponseError('ERR out of order'))